@@ -8,8 +8,7 @@ from math import cos, pi, sin
 import pandas as pd
 
 from config import NUM_PIXELS
-from height import HEIGHT
-from width import WIDTH
+from pipeline import PIPELINE
 
 
 class Plot:
@@ -87,9 +86,10 @@ def theta(i: int) -> float:
 def plot_model():
     plot = Plot()
     t = -4.287
+    height, width = PIPELINE.height, PIPELINE.width
     for i in range(NUM_PIXELS):
         t += theta(i)
-        plot.add_point(i, x(WIDTH[i], -t), y(WIDTH[i], -t), HEIGHT[i], 'tree')
+        plot.add_point(i, x(width[i], -t), y(width[i], -t), height[i], 'tree')
 
     # plot.add_reeks([74, 159, 234, 315, 380, 435, 512])
     plot.add_reeks([57, 142, 218, 296, 365, 424, 470, 490, 523, 549, 563, 590])
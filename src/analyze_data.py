@@ -1,12 +1,19 @@
 import json
 from functools import cached_property
-from math import sqrt
+from math import prod, sqrt
 import numpy as np
 from typing import Dict, Generator, List, Optional, Tuple
 
 from config import storage, NUM_PIXELS
 from cv2plot import DataPlot
-from model.led_info import LedInfo
+from model.center import CenterEstimate, estimate_center
+from model.led_info import CandidateTable, LedInfo
+from model.led_table import read_led_table
+from model.line_fit import LineFit
+
+
+MAX_EXACT_OPTIONS = 4096  # Strings with more coordinate combinations are optimized with a branch and bound search
+MAX_SEARCH_NODES = 20000  # Budget of the branch and bound search of 1 string, see StringSearch
 
 
 def distance(c1: Tuple[int, int], c2: Tuple[int, int]) -> float:
@@ -38,6 +45,29 @@ def dist_point_to_line(x, y, m, c):
     return abs(m*x - y + c) / sqrt(m**2 + 1)
 
 
+def line_fit_error(x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    least_squares_fit for each row of x and y at once, with the sum of the squared distances to the fitted line.
+    If all x in a row are equal, the minimum norm solution is returned, like np.linalg.lstsq does.
+    :param x: (K, N) x coordinates of K sets of N points
+    :param y: (K, N) y coordinates
+    :return: m, c and error, each (K)
+    """
+    x_mean = x.mean(axis=1)
+    y_mean = y.mean(axis=1)
+    dx = x - x_mean[:, None]
+    sxx = np.sum(dx * dx, axis=1)
+    sxy = np.sum(dx * (y - y_mean[:, None]), axis=1)
+
+    vertical = sxx == 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m = np.where(vertical, x_mean * y_mean / (x_mean ** 2 + 1), sxy / sxx)
+        c = np.where(vertical, y_mean / (x_mean ** 2 + 1), y_mean - m * x_mean)
+
+    err = np.sum((m[:, None] * x - y + c[:, None]) ** 2, axis=1) / (m ** 2 + 1)
+    return m, c, err
+
+
 class LedString:
     def __init__(self, leds: List[LedInfo] = None):
         """
@@ -91,10 +121,15 @@ class Estimation:
 class DataContainer:
     def __init__(self, snap_name):
         self.snap_name = snap_name
+        self.candidates: Optional[CandidateTable] = None
         self.data: Dict[int, LedInfo] = {}
 
         self._m = None
         self._c = None
+        self._center_method = 'mean'
+        self.center_estimate: Optional[CenterEstimate] = None  # Center and spread of Y - mX around the center line
+        self.line_fit: Optional[LineFit] = None  # Running fit through the coordinate of all leds
+        self._fit_coord: Dict[int, Tuple[int, int]] = {}  # Coordinate of each led in line_fit
 
         self.led_strings: List[LedString] = []
         self.estimate = Estimation()
@@ -103,11 +138,8 @@ class DataContainer:
         self.find_strings()
 
     def load_data(self):
-        for row in json.loads((storage / self.snap_name / 'data.txt').read_text()):
-            try:
-                self.data[row['led']].add_location(**row)
-            except KeyError:
-                self.data[row['led']] = LedInfo(**row)
+        self.candidates = CandidateTable.from_table(read_led_table(storage / self.snap_name))
+        self.data = {led_id: LedInfo(self.candidates, led_id) for led_id in self.candidates.ids.tolist()}
 
     @property
     def m(self):
@@ -117,7 +149,7 @@ class DataContainer:
         :return:
         """
         if not self._m:
-            self.center_line()
+            self.center_line(self._center_method)
         return self._m
 
     @property
@@ -128,12 +160,43 @@ class DataContainer:
         :return:
         """
         if not self._c:
-            self.center_line()
+            self.center_line(self._center_method)
         return self._c
 
-    def center_line(self):
-        x, y = self.vectorize_led_coord(list(self.data.keys()))
-        (self._m, self._c) = least_squares_fit(x, y)
+    def center_line(self, method='mean'):
+        """
+        Fit the center line Y = mx + c through all leds.
+        The slope is a least squares fit. The offset c is the center of Y - mX, estimated with method and
+        stored in center_estimate. With the mean this is the least squares fit, median and trimmed are robust
+        against outliers.
+        The least squares fit is kept up to date by update_led. Refitting after a led moved is O(1) for the mean,
+        which is taken from the running sums. Median and trimmed need a pass over all leds, O(N).
+        :param method: see model.center.estimate_center
+        """
+        self._center_method = method
+        if self.line_fit is None:
+            self.line_fit = LineFit()
+            for led_id, led in self.data.items():
+                self._fit_coord[led_id] = led.coord
+                self.line_fit.add(*led.coord)
+        self._m = self.line_fit.m
+        if method == 'mean':
+            self.center_estimate = CenterEstimate(*self.line_fit.offset(self._m))
+        else:
+            x, y = self.vectorize_led_coord(list(self.data.keys()))
+            self.center_estimate = estimate_center(np.array(y) - self._m * np.array(x), method)
+        self._c = self.center_estimate.center
+
+    def update_led(self, led: LedInfo):
+        """
+        Move a led in the center line fit after its selected coordinate changed.
+        The center line is refitted on the next use of m or c.
+        """
+        if self.line_fit is None or self._fit_coord[led.led_id] == led.coord:
+            return
+        self.line_fit.swap(self._fit_coord[led.led_id], led.coord)
+        self._fit_coord[led.led_id] = led.coord
+        self._m = self._c = None
 
     def vectorize_led_coord(self, id_list: List[int]) -> Tuple[List[int], List[int]]:
         """
@@ -146,8 +209,7 @@ class DataContainer:
         return x, y
 
     def calc_led_center_distance(self):
-        for led in self.data.values():
-            led.calculate_center_distance(self.m, self.c)
+        self.candidates.calculate_center_distance(self.m, self.c)
         self._m = None
 
     def find_strings(self, max_gap=4):
@@ -233,23 +295,6 @@ def extract_most_likely_leds(holding: DataContainer):
         print(led)
 
 
-def all_coord_options(leds: List[LedInfo]) -> Generator[List[Tuple[LedInfo, int]], None, None]:
-    """
-    Generate a table with unique rows.
-    Each row contains a list of all leds. Each led is combined with an index.
-    The index is the index of a potential coord of the led.
-    The full table contains all possible combinations for the provided LedInfo List.
-    """
-    for i in range(len(leds[0].all_coord)):
-        if not leds[0].coord_id_active(i):
-            continue
-        if len(leds) == 1:
-            yield [(leds[0], i)]
-            continue
-        for entry in all_coord_options(leds[1:]):
-            yield [(leds[0], i)] + entry
-
-
 def get_neighbour_distance(coord: List[Tuple[int, int]]) -> List[float]:
     """
     Calculate the average distance to the neighbouring coord.
@@ -268,57 +313,322 @@ def get_neighbour_distance(coord: List[Tuple[int, int]]) -> List[float]:
     return dist
 
 
-def optimize_led_strings(holding: DataContainer) -> None:
-    holding.find_strings()  # Find strings with active leds
-    disabled = False
-
-    for string in holding.led_strings:
-        best: List[Tuple[LedInfo, int]] = []
-        score = None
-
-        for row in all_coord_options(string.leds):
-            string_coord = [entry[0].all_coord[entry[1]] for entry in row]
-
-            x = [c[0] for c in string_coord]
-            y = [c[1] for c in string_coord]
-
-            m, c = least_squares_fit(x, y)
-
-            """
-            Calculate the error for the fitted line through the option.
-            """
-            err = 0
-            for p in string_coord:
-                err = err + dist_point_to_line(p[0], p[1], m, c)**2
-
-            dist = 0
-            for i in range(len(string_coord) - 1):
-                dist += distance(string_coord[i], string_coord[i+1])
-
-            err = err * dist
-            if not score or err < score:
-                score = err
-                best = row
-                string.m = m
-                string.c = c
-                string.coord = string_coord
-
-        distances = np.array(get_neighbour_distance(string.coord))
-
-        if np.max(distances) > 2 * np.average(distances):
-            a = np.where(distances == np.max(distances))[0][0]
-            best[a][0].mark_incorrect(best[a][1])
-            disabled = True
-        else:
-            for led, index in best:
-                if index not in led.in_string:
-                    led.in_string.append(index)
+def string_candidates(leds: List[LedInfo]) -> List[np.ndarray]:
+    """
+    :return: For each led the index of all coordinates not marked incorrect
+    """
+    return [np.array([i for i in range(len(led.all_coord)) if led.coord_id_active(i)], dtype=int) for led in leds]
+
+
+def string_fit(x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Fit K options for the coordinates of a string.
+    The score of an option is error * length, lower is better.
+    :param x: (K, N) x coordinates of the N leds in the string
+    :param y: (K, N) y coordinates
+    :return: m, c, squared error to the fitted line and string length, each (K)
+    """
+    m, c, err = line_fit_error(x, y)
+    length = np.sum(np.hypot(np.diff(x, axis=1), np.diff(y, axis=1)), axis=1)
+    return m, c, err, length
+
+
+def first_best(score: np.ndarray) -> int:
+    """
+    Index of the lowest score. The first option wins on equal scores.
+    An option with score 0 is replaced by the next option, as in the original enumeration.
+    """
+    if score.min() > 0:
+        return int(np.argmin(score))
+    best = 0
+    for i in range(1, len(score)):
+        if not score[best] or score[i] < score[best]:
+            best = i
+    return best
+
+
+def exact_string_option(coords: List[np.ndarray]) -> np.ndarray:
+    """
+    Score all combinations of candidate coordinates at once.
+    The combinations are ordered like nested loops with the first led in the outer loop.
+    :param coords: For each led a (C, 2) array with its candidate coordinates
+    :return: Index of the best candidate of each led
+    """
+    choice = np.stack(np.meshgrid(*[np.arange(len(c)) for c in coords], indexing='ij'), axis=-1)
+    choice = choice.reshape(-1, len(coords))
+    x = np.stack([c[choice[:, i], 0] for i, c in enumerate(coords)], axis=1)
+    y = np.stack([c[choice[:, i], 1] for i, c in enumerate(coords)], axis=1)
+    _, _, err, length = string_fit(x, y)
+    return choice[first_best(err * length)]
+
 
-    if disabled:
+class StringState:
+    """
+    Selected candidate coordinate of each led in a string, with an incremental line fit and the segment lengths.
+    Moving 1 led to another candidate is O(1).
+    """
+    def __init__(self, coords: List[np.ndarray], choice: np.ndarray):
+        self.coords = coords
+        self.choice = np.array(choice)
+        self.points = np.array([c[i] for c, i in zip(coords, choice)])
+        self.fit = LineFit()
+        for x, y in self.points:
+            self.fit.add(x, y)
+        self.segments = np.hypot(*np.diff(self.points, axis=0).T)
+        self.length = float(self.segments.sum())
+
+    @property
+    def score(self) -> float:
+        return self.fit.error * self.length
+
+    def move(self, led: int, candidate: int):
+        new = self.coords[led][candidate]
+        self.fit.swap(self.points[led], new)
+        self.points[led] = new
+        self.choice[led] = candidate
+        for segment in (led - 1, led):
+            if 0 <= segment < len(self.segments):
+                length = float(np.hypot(*(self.points[segment + 1] - self.points[segment])))
+                self.length += length - self.segments[segment]
+                self.segments[segment] = length
+
+    def improve(self, max_sweeps=10):
         """
-        Strings led to disabled leds. Rerun
+        Move single leds to another candidate as long as the score improves
         """
-        return optimize_led_strings(holding)
+        for _ in range(max_sweeps):
+            improved = False
+            for led, candidates in enumerate(self.coords):
+                current = self.choice[led]
+                best, best_score = current, self.score
+                for candidate in range(len(candidates)):
+                    if candidate == current:
+                        continue
+                    self.move(led, candidate)
+                    if self.score < best_score:
+                        best, best_score = candidate, self.score
+                self.move(led, best)
+                improved |= best != current
+            if not improved:
+                return
+
+
+def viterbi_string_option(coords: List[np.ndarray], choice: np.ndarray, iterations=20) -> np.ndarray:
+    """
+    Iterative search for a good, not necessarily the best, option of a string. Used as start of the StringSearch.
+    For a fixed line, error times length is approximated by error / current error + length / current length.
+    This is a sum of a cost per led and a cost per pair of neighbouring leds, minimized exactly with the Viterbi
+    algorithm. The line is refitted to the new choice and the search is repeated until the score does not improve.
+    Finally single leds are moved to other candidates while the score improves.
+    :param coords: For each led a (C, 2) array with its candidate coordinates
+    :param choice: Initial index of the candidate of each led
+    :return: Index of the best candidate of each led
+    """
+    state = StringState(coords, choice)
+    for _ in range(iterations):
+        m, c = state.fit.line
+        err, length = max(state.fit.error, 1e-9), max(state.length, 1e-9)
+
+        cost = (m * coords[0][:, 0] - coords[0][:, 1] + c) ** 2 / (m ** 2 + 1) / err
+        back = []
+        for prev, cur in zip(coords[:-1], coords[1:]):
+            step = np.hypot(prev[:, None, 0] - cur[None, :, 0], prev[:, None, 1] - cur[None, :, 1]) / length
+            total = cost[:, None] + step
+            back.append(np.argmin(total, axis=0))
+            cost = total[back[-1], np.arange(len(cur))] + (m * cur[:, 0] - cur[:, 1] + c) ** 2 / (m ** 2 + 1) / err
+
+        option = [int(np.argmin(cost))]
+        for pointers in reversed(back):
+            option.append(int(pointers[option[-1]]))
+        option = option[::-1]
+
+        previous, score = state.choice.copy(), state.score
+        for led in np.flatnonzero(option != previous):
+            state.move(led, option[led])
+        if state.score >= score:
+            for led in np.flatnonzero(option != previous):
+                state.move(led, previous[led])
+            break
+
+    state.improve()
+    return state.choice
+
+
+class StringSearch:
+    """
+    Search for strings with too many combinations to score them all.
+    The combinations are visited in the order of exact_string_option, leds with 1 candidate are fixed.
+    A branch is skipped if a lower bound of its score is above the best score found so far:
+    the error to the closest line of the fixed and selected points times the length of the segments between
+    selected points plus the shortest possible length of the other segments.
+
+    The search stops after visiting max_nodes branches, which bounds its time for any string.
+    The result is exact if the search completes. Otherwise it is the best option found so far, at least as good
+    as the start option, which can differ from exact_string_option. This happens when many candidates are so
+    close together that the bound can not skip them, see benchmark.bench_optimize_strings.
+    """
+    margin = 1e-9  # Relative margin on the bound for rounding errors
+
+    def __init__(self, coords: List[np.ndarray], max_nodes: int = MAX_SEARCH_NODES):
+        """
+        :param coords: For each led a (C, 2) array with its candidate coordinates
+        :param max_nodes: Maximum number of branches to visit
+        """
+        self.coords = coords
+        self.max_nodes = max_nodes
+        self.nodes = 0
+        self.free = [led for led, candidates in enumerate(coords) if len(candidates) > 1]
+        self.fit = LineFit()
+        for candidates in coords:
+            if len(candidates) == 1:
+                self.fit.add(*candidates[0])
+        # Length of each segment for every pair of candidates of the 2 leds
+        self.steps = [np.hypot(a[:, None, 0] - b[None, :, 0], a[:, None, 1] - b[None, :, 1])
+                      for a, b in zip(coords[:-1], coords[1:])]
+        self.choice = np.zeros(len(coords), dtype=int)
+        self.limit = np.inf
+
+    def score(self, choice: np.ndarray) -> float:
+        """
+        Score of 1 option, calculated like exact_string_option
+        """
+        points = np.array([c[i] for c, i in zip(self.coords, choice)])
+        _, _, err, length = string_fit(points[None, :, 0], points[None, :, 1])
+        return float(err[0] * length[0])
+
+    @property
+    def complete(self) -> bool:
+        """
+        The search visited all branches that could hold a better option
+        """
+        return self.nodes <= self.max_nodes
+
+    def _options(self, depth: int, length: float, after: Optional[np.ndarray],
+                 reverse: bool) -> Generator[np.ndarray, None, None]:
+        """
+        Options with a lower bound not above limit, for the free leds from depth onwards.
+        :param length: Lower bound of the string length for the leds selected so far
+        :param after: Only options after this option. None if the selected leds are already after it.
+        :param reverse: Visit the options in reversed order
+        """
+        self.nodes += 1
+        if not self.complete:
+            return
+        # The error of the running sums scales with the sums of the squared coordinates
+        error = self.fit.min_error - self.margin * 1e-3 * (self.fit.sxx + self.fit.syy)
+        if error * length > self.limit * (1 + self.margin):
+            return
+        if depth == len(self.free):
+            if after is None:
+                yield self.choice.copy()
+            return
+
+        led = self.free[depth]
+        candidates = range(len(self.coords[led]))
+        for candidate in (reversed(candidates) if reverse else candidates):
+            if after is not None and candidate < after[led]:
+                continue
+            step = length
+            if led > 0:
+                step += self.steps[led - 1][self.choice[led - 1], candidate] - self.steps[led - 1].min()
+            if led + 1 < len(self.coords) and len(self.coords[led + 1]) == 1:
+                step += self.steps[led][candidate, 0] - self.steps[led].min()
+            self.choice[led] = candidate
+            self.fit.add(*self.coords[led][candidate])
+            yield from self._options(depth + 1, step, after if after is not None and candidate == after[led] else None,
+                                     reverse)
+            self.fit.remove(*self.coords[led][candidate])
+        self.choice[led] = 0
+
+    def options(self, limit: float, after: Optional[np.ndarray] = None,
+                reverse=False) -> Generator[np.ndarray, None, None]:
+        """
+        All options with a score that can be below or equal to limit. The limit can be lowered while iterating.
+        """
+        self.limit = limit
+        # Segments with 2 fixed leds have their exact length, the others their shortest possible length
+        length = float(sum(step.min() for step in self.steps))
+        yield from self._options(0, length, after, reverse)
+
+    def first_best(self, start: np.ndarray) -> np.ndarray:
+        """
+        The option exact_string_option selects, see first_best. If the search is not complete, the best option
+        found before the search stopped.
+        :param start: A good option to start the search with
+        """
+        best, best_score = np.array(start), self.score(start)
+        for option in self.options(best_score):
+            score = self.score(option)
+            if score < best_score or (score == best_score and tuple(option) < tuple(best)):
+                best, best_score = option, score
+                self.limit = score
+        if best_score > 0:
+            return best
+
+        # The option after the last option with score 0 is selected, followed by the first lowest score after it
+        last_zero = next((option for option in self.options(0, reverse=True) if self.score(option) == 0), None)
+        if last_zero is None:
+            return best
+        best, best_score = last_zero, np.inf
+        for option in self.options(np.inf, after=last_zero):
+            score = self.score(option)
+            if score < best_score:
+                best, best_score = option, score
+                self.limit = score
+        return best
+
+
+def optimize_string(leds: List[LedInfo]) -> Tuple[List[Tuple[LedInfo, int]], float, float, List[Tuple[int, int]]]:
+    """
+    Select the coordinate of each led in a string that fits best on a straight line, with the shortest string length.
+    :return: (led, coordinate index) for each led, m and c of the fitted line and the selected coordinates
+    """
+    candidates = string_candidates(leds)
+    coords = [np.array([led.all_coord[i] for i in index], dtype=float) for led, index in zip(leds, candidates)]
+
+    if prod(len(index) for index in candidates) <= MAX_EXACT_OPTIONS:
+        choice = exact_string_option(coords)
+    else:
+        start = [int(np.flatnonzero(index == led.best_match)[0]) if led.best_match in index else 0
+                 for led, index in zip(leds, candidates)]
+        choice = StringSearch(coords).first_best(viterbi_string_option(coords, np.array(start)))
+
+    best = [(led, int(index[i])) for led, index, i in zip(leds, candidates, choice)]
+    string_coord = [entry[0].all_coord[entry[1]] for entry in best]
+    m, c = least_squares_fit([p[0] for p in string_coord], [p[1] for p in string_coord])
+    return best, m, c, string_coord
+
+
+def optimize_led_strings(holding: DataContainer) -> None:
+    """
+    Select the coordinate of each led in all led strings.
+    If the selected coordinate of a led is far from its neighbours, the coordinate is marked incorrect
+    and all strings are optimized again. Strings that did not change reuse their previous result.
+    """
+    results = {}
+    disabled = True
+    while disabled:
+        holding.find_strings()  # Find strings with active leds
+        disabled = False
+
+        for string in holding.led_strings:
+            key = tuple((led.led_id, tuple(index)) for led, index in zip(string.leds, string_candidates(string.leds)))
+            if key not in results:
+                results[key] = optimize_string(string.leds)
+            best, string.m, string.c, string.coord = results[key]
+
+            distances = np.array(get_neighbour_distance(string.coord))
+
+            if np.max(distances) > 2 * np.average(distances):
+                a = np.where(distances == np.max(distances))[0][0]
+                best[a][0].mark_incorrect(best[a][1])
+                holding.update_led(best[a][0])
+                disabled = True
+            else:
+                for led, index in best:
+                    if index not in led.in_string:
+                        led.mark_in_string(index)
+                        holding.update_led(led)
 
 
 def export_led_positions(snap_name: str, data):
@@ -329,5 +639,3 @@ def export_led_positions(snap_name: str, data):
 if __name__ == "__main__":
     d = DataContainer('Buur')
     optimize_led_strings(d)
-
-
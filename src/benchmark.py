@@ -0,0 +1,362 @@
+"""
+Benchmarks for the slow steps in the led detection and mapping pipeline.
+Each benchmark runs on the snap series available in the storage folder.
+
+Usage: python benchmark.py [series_name ...]
+Without series names, all series in storage are used.
+"""
+import contextlib
+import hashlib
+import io
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Generator, List, Tuple
+
+import cv2
+import numpy as np
+import pandas as pd
+from numpy import zeros
+
+from config import storage, NUM_PIXELS, NUM_SNAP_FRAMES
+from calc_pixels import Cluster
+from analyze_data import DataContainer, least_squares_fit, dist_point_to_line, distance, get_neighbour_distance, \
+    optimize_led_strings
+from model.led_info import CandidateTable, LedInfo
+from model.led_table import convert_series, read_led_table
+from model.snap import RawSnapData
+from pipeline import Pipeline
+from webcam import create_stack, store_im
+
+
+def legacy_fill_data(cluster: Cluster):
+    """
+    Per pixel fill of the data array, as used before the frame stack was vectorized.
+    Only used as a reference for the benchmark.
+    """
+    data = zeros((cluster.X * cluster.Y, cluster.num_frames), dtype=int)
+    dataxy = zeros((cluster.X * cluster.Y, cluster.num_frames + 2), dtype=int)
+    counter = 0
+    for i in range(cluster.X):
+        for j in range(cluster.Y):
+            data[counter] = [cluster.images[_][i][j] for _ in range(cluster.num_frames)]
+            dataxy[counter] = [i, j, *data[counter]]
+            counter += 1
+    return data, dataxy
+
+
+def bench_fill_data(series_name, legacy=True):
+    """
+    Time loading a series and building the frame stack.
+    """
+    start = time.time()
+    cluster = Cluster(series_name)
+    load_fill = time.time() - start
+
+    start = time.time()
+    cluster.fill_data()
+    fill = time.time() - start
+    print(f"{series_name.name}: load + fill {load_fill:.2f}s, fill {fill:.3f}s")
+
+    if legacy:
+        start = time.time()
+        data, _ = legacy_fill_data(cluster)
+        print(f"{series_name.name}: legacy fill {time.time() - start:.2f}s")
+        if not (data == cluster.data).all():
+            raise RuntimeError('Legacy and vectorized frame stack differ')
+
+
+def legacy_all_coord_options(leds: List[LedInfo]) -> Generator[List[Tuple[LedInfo, int]], None, None]:
+    """
+    Recursive enumeration of all coordinate combinations, as used before the string optimizer.
+    Only used as a reference for the benchmark.
+    """
+    for i in range(len(leds[0].all_coord)):
+        if not leds[0].coord_id_active(i):
+            continue
+        if len(leds) == 1:
+            yield [(leds[0], i)]
+            continue
+        for entry in legacy_all_coord_options(leds[1:]):
+            yield [(leds[0], i)] + entry
+
+
+def legacy_optimize_led_strings(holding: DataContainer) -> None:
+    """
+    Exhaustive string optimization, as used before the string optimizer.
+    Only used as a reference for the benchmark.
+    """
+    holding.find_strings()
+    disabled = False
+
+    for string in holding.led_strings:
+        best: List[Tuple[LedInfo, int]] = []
+        score = None
+
+        for row in legacy_all_coord_options(string.leds):
+            string_coord = [entry[0].all_coord[entry[1]] for entry in row]
+            m, c = least_squares_fit([p[0] for p in string_coord], [p[1] for p in string_coord])
+
+            err = 0
+            for p in string_coord:
+                err = err + dist_point_to_line(p[0], p[1], m, c)**2
+
+            dist = 0
+            for i in range(len(string_coord) - 1):
+                dist += distance(string_coord[i], string_coord[i+1])
+
+            err = err * dist
+            if not score or err < score:
+                score = err
+                best = row
+                string.m = m
+                string.c = c
+                string.coord = string_coord
+
+        distances = np.array(get_neighbour_distance(string.coord))
+
+        if np.max(distances) > 2 * np.average(distances):
+            a = np.where(distances == np.max(distances))[0][0]
+            best[a][0].mark_incorrect(best[a][1])
+            disabled = True
+        else:
+            for led, index in best:
+                if index not in led.in_string:
+                    led.mark_in_string(index)
+
+    if disabled:
+        return legacy_optimize_led_strings(holding)
+
+
+def synthetic_strings(folder: Path, num_strings: int, string_length: int, duplicates: float, seed=0,
+                      spread=25.0) -> Path:
+    """
+    Write a data.txt with straight led strings. A fraction of the leds gets a second, wrong, detection.
+    :param spread: Standard deviation in pixels of the wrong detection around the led
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for s in range(num_strings):
+        start = np.array([rng.uniform(0, 480), rng.uniform(0, 640)])
+        direction = rng.normal(size=2)
+        direction *= 8 / np.linalg.norm(direction)
+        for i in range(string_length):
+            led = s * (string_length + 6) + i
+            x, y = start + i * direction + rng.normal(0, 0.7, 2)
+            rows.append({'x': int(x), 'y': int(y), 'led': led, 'bit': '', 'score': int(rng.integers(0, 40))})
+            if rng.random() < duplicates:
+                x, y = start + i * direction + rng.normal(0, spread, 2)
+                rows.append({'x': int(x), 'y': int(y), 'led': led, 'bit': '', 'score': int(rng.integers(0, 40))})
+    folder.mkdir(parents=True, exist_ok=True)
+    (folder / 'data.txt').write_text(json.dumps(rows))
+    return folder
+
+
+def bench_optimize_strings(num_strings=20, string_length=30, duplicates=0.2, legacy=True, seed=0, spread=25.0):
+    """
+    Time the string optimizer on synthetic strings, and compare the outcome with the exhaustive enumeration.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        series = synthetic_strings(Path(folder) / 'strings', num_strings, string_length, duplicates, seed, spread)
+
+        holding = DataContainer(series)
+        start = time.time()
+        optimize_led_strings(holding)
+        print(f"{num_strings} strings of {string_length} leds, {duplicates:.0%} duplicates: "
+              f"optimize {time.time() - start:.3f}s")
+
+        if legacy:
+            reference = DataContainer(series)
+            start = time.time()
+            legacy_optimize_led_strings(reference)
+            print(f"legacy optimize {time.time() - start:.3f}s")
+            for led_id, led in holding.data.items():
+                other = reference.data[led_id]
+                if led.in_string != other.in_string or led.incorrect != other.incorrect:
+                    raise RuntimeError(f'Legacy and new optimizer differ for led {led_id}')
+
+
+def bench_led_table(num_strings=40, string_length=100, duplicates=0.3, repeat=20):
+    """
+    Time reading the detected leds of a series from data.txt and from the binary data.npz.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        series = synthetic_strings(Path(folder) / 'strings', num_strings, string_length, duplicates)
+        start = time.time()
+        for _ in range(repeat):
+            json_table = read_led_table(series)
+        json_time = (time.time() - start) / repeat
+
+        convert_series(series, remove_json=True)
+        start = time.time()
+        for _ in range(repeat):
+            table = read_led_table(series)
+        print(f"{len(table['led'])} detected leds: data.txt {json_time * 1000:.1f}ms, "
+              f"data.npz {(time.time() - start) / repeat * 1000:.1f}ms")
+        if any((table[column] != json_table[column]).any() for column in json_table):
+            raise RuntimeError('JSON and binary led table differ')
+
+
+def check_legacy_worst_score():
+    """
+    Convert a data.txt with the int64 maximum score, the worst score of detections before bit_info.WORST_SCORE.
+    The score has to survive the conversion and stay the worst candidate of its led.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        series = Path(folder) / 'legacy'
+        series.mkdir()
+        rows = [{'x': 10, 'y': 20, 'led': 0, 'bit': '', 'score': int(np.iinfo(np.int64).max)},
+                {'x': 30, 'y': 40, 'led': 0, 'bit': '', 'score': 5}]
+        (series / 'data.txt').write_text(json.dumps(rows))
+        json_table = read_led_table(series)
+        convert_series(series, remove_json=True)
+        table = read_led_table(series)
+        if any((table[column] != json_table[column]).any() for column in json_table):
+            raise RuntimeError('JSON and binary led table differ for the legacy worst score')
+        if CandidateTable.from_table(table).best_rows[0] != 1:
+            raise RuntimeError('The legacy worst score is not the worst candidate')
+
+
+def synthetic_series(folder: Path, num_leds=60, seed=0):
+    """
+    Write a small snap series of blinking leds twice: as png images in folder / 'png' and as frame stack
+    in folder / 'stack'. Half of the leds are faint, close to the threshold of Cluster.filter_ground_all.
+    :return: The png and the stack series
+    """
+    rng = np.random.default_rng(seed)
+    numbers = rng.choice(np.arange(16, 2 ** NUM_SNAP_FRAMES), num_leds, replace=False)
+    ground = rng.integers(0, 30, (120, 160, 3), dtype=np.uint8)
+    position = np.stack([rng.integers(5, 115, num_leds), rng.integers(5, 155, num_leds)], axis=1)
+    color = np.where(np.arange(num_leds)[:, None] % 2, [[200, 200, 200]], rng.integers(5, 15, (num_leds, 3)))
+
+    def draw(on: np.ndarray) -> np.ndarray:
+        image = ground.copy()
+        for (x, y), led_color in zip(position[on], color[on]):
+            image[x - 1:x + 2, y - 1:y + 2] = np.minimum(ground[x - 1:x + 2, y - 1:y + 2] + led_color, 255)
+        return image
+
+    images = {'ground': ground, 'all': draw(np.ones(num_leds, dtype=bool))}
+    for n in range(NUM_SNAP_FRAMES):
+        images[str(n)] = draw((numbers >> n) & 1 == 1)
+
+    png, frames = folder / 'png', folder / 'stack'
+    png.mkdir(parents=True)
+    layers = create_stack(str(frames), ground.shape[:2], NUM_SNAP_FRAMES)
+    layers[..., 0] = cv2.cvtColor(ground, cv2.COLOR_BGR2GRAY)
+    layers[..., 1] = cv2.cvtColor(images['all'], cv2.COLOR_BGR2GRAY)
+    for n in range(NUM_SNAP_FRAMES):
+        store_im(f'{png}/{n}', images[str(n)])
+        # The stack holds the highest bit first
+        difference = cv2.absdiff(images[str(n)], ground)
+        layers[..., 2 + NUM_SNAP_FRAMES - 1 - n] = cv2.cvtColor(difference, cv2.COLOR_BGR2GRAY)
+    layers.flush()
+    del layers
+    store_im(f'{png}/ground', ground)
+    store_im(f'{png}/all', images['all'])
+    led_numbers = json.dumps({str(number): led for led, number in enumerate(numbers.tolist())})
+    for series in (png, frames):
+        (series / 'numbers.txt').write_text(led_numbers)
+    return png, frames
+
+
+def check_png_stack_detection():
+    """
+    Detect the leds of the same synthetic series stored as png images and as frame stack.
+    Both have to disable the same pixels and detect the same leds.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        clusters = []
+        for series in synthetic_series(Path(folder)):
+            cluster = Cluster(str(series))
+            cluster.filter_ground_all()
+            cluster.decode_bit_pattern()
+            clusters.append(cluster)
+        png, frames = clusters
+        if (png.pixels.disabled != frames.pixels.disabled).any():
+            raise RuntimeError('Png and stack series filter different pixels')
+        detected = [sorted((led.bit_info.bit_number, tuple(led.center)) for led in cluster.detected_led)
+                    for cluster in clusters]
+        if detected[0] != detected[1]:
+            raise RuntimeError('Png and stack series detect different leds')
+        print(f"Png and stack series: {len(detected[0])} leds detected, {png.pixels.disabled.sum()} pixels filtered")
+
+
+def check_extreme_led_ties(num_leds=60, seed=0):
+    """
+    Select the extreme leds of a snap whose leds have only a few distinct phi, stored in shuffled order.
+    Leds with equal phi have to keep the order of the data file, like the sort over the snap lines did.
+    """
+    rng = np.random.default_rng(seed)
+    rows = [{'x': 20 + 7 * led, 'y': int(rng.choice([100, 300, 500])), 'led': led, 'bit': '', 'score': 0}
+            for led in rng.permutation(num_leds).tolist()]
+    with tempfile.TemporaryDirectory() as folder:
+        (Path(folder) / 'data.txt').write_text(json.dumps(rows))
+        snap = RawSnapData(Path(folder))
+
+    reference = sorted([line for line in snap.snapl.values() if line.reliable], key=snap.pixel_phi)
+    expected = [line.id for line in reference[:5] + reference[-5:]]
+    if snap.arrays.ids[snap.extreme_leds()].tolist() != expected:
+        raise RuntimeError('Extreme leds with equal phi differ from the order of the data file')
+
+
+# Hash of the theta mapped by the baseline theta module for synthetic_pipeline(), see check_theta_mapping
+THETA_REFERENCE = '269c3b0e6706f7c83b43a7b61d61e6f736eb2006eb777ceb1555943ebe737cd7'
+
+
+def synthetic_pipeline(seed=3) -> Pipeline:
+    """
+    Pipeline with synthetic vertical positions, angles and width of 5 cameras around a tree with a led spiral.
+    """
+    rng = np.random.default_rng(seed)
+    step = 2 / 47.3  # Angle between 2 leds
+    cameras = rng.uniform(0, 2, 5)
+    angles = pd.DataFrame({f'cam{k}': np.where(rng.random(NUM_PIXELS) < 0.6,
+                                               step + rng.normal(0, 0.002, NUM_PIXELS), np.nan)
+                           for k in range(len(cameras))})
+    angles.iloc[540:] = step
+    angles['median'] = angles.median(axis=1).fillna(step)
+    rotations = np.arange(0, NUM_PIXELS * step / 2 + 1)
+    verticals = pd.DataFrame({f'cam{k}': pd.Series(position[position < NUM_PIXELS - 1])
+                              for k, position in enumerate((camera + 2 * rotations) / step for camera in cameras)})
+
+    pipeline = Pipeline()
+    pipeline.vertical_angles = (verticals, angles)
+    pipeline.width = pd.Series(np.ones(NUM_PIXELS))
+    return pipeline
+
+
+def check_theta_mapping():
+    """
+    Map theta for the synthetic pipeline and compare it with the theta the baseline module mapped.
+    """
+    pipeline = synthetic_pipeline()
+    with contextlib.redirect_stdout(io.StringIO()):
+        theta = np.array(pipeline.theta, dtype=float)
+    digest = hashlib.sha256((np.round(theta, 9) + 0.0).tobytes()).hexdigest()
+    if digest != THETA_REFERENCE:
+        raise RuntimeError(f'Theta of the synthetic pipeline differs from the baseline mapping: {digest}')
+
+
+def series_folders(names: List[str]):
+    if names:
+        return [storage / name for name in names]
+    return [folder for folder in storage.glob('*') if 'backup' not in folder.parts]
+
+
+if __name__ == "__main__":
+    for folder in series_folders(sys.argv[1:]):
+        bench_fill_data(folder)
+
+    bench_optimize_strings(string_length=30, duplicates=0.2)
+    # Strings with more options than MAX_EXACT_OPTIONS, seed 10 differed from the legacy optimizer with a Viterbi search
+    bench_optimize_strings(num_strings=4, string_length=16, duplicates=0.7, seed=10)
+    bench_optimize_strings(string_length=200, duplicates=0.3, legacy=False)
+    # Wrong detections within a pixel of the led: the bound skips nothing and the search stops at MAX_SEARCH_NODES
+    bench_optimize_strings(num_strings=2, string_length=60, duplicates=1.0, legacy=False, spread=1.0)
+    bench_led_table()
+    check_legacy_worst_score()
+    check_png_stack_detection()
+    check_extreme_led_ties()
+    check_theta_mapping()
@@ -1,13 +1,13 @@
 from math import cos, sin, inf, pi
-from typing import Dict, Tuple
+from typing import Dict, NamedTuple, Tuple
 
 import numpy
 import numpy as np
 from scipy.signal import argrelmax, find_peaks
 
 from model.snap import RawSnapData
-from model.positions import Pixel
-from model.transformations import rotate_xy
+from model.positions import PositionTable
+from model.transformations import rotate
 
 
 def get_intersection_coord(cam1: RawSnapData, cam2: RawSnapData, phi, led_id):
@@ -21,7 +21,7 @@ def get_intersection_coord(cam1: RawSnapData, cam2: RawSnapData, phi, led_id):
     :return:
     """
     pos1 = cam1.camera_pos.coord
-    pos2 = rotate_xy(cam2.camera_pos.coord, phi)
+    pos2 = rotate(cam2.camera_pos.coord, phi)
     """
     Line equation X cos(a) + Y sin(a) + c = 0
     aX + bY + c = 0
@@ -48,6 +48,69 @@ def get_intersection_coord(cam1: RawSnapData, cam2: RawSnapData, phi, led_id):
         return inf, inf
 
 
+def shared_led_angles(cam1: RawSnapData, cam2: RawSnapData, reliable=True) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Get the leds visible in both cameras, with the pixel phi of the led in each camera.
+    :param cam1: First camera
+    :param cam2: Second camera
+    :param reliable: Only use leds marked reliable in both cameras
+    :return: led id, pixel phi in cam1, pixel phi in cam2
+    """
+    ids, index1, index2 = np.intersect1d(cam1.arrays.ids, cam2.arrays.ids, assume_unique=True, return_indices=True)
+    if reliable:
+        both = cam1.arrays.reliable[index1] & cam2.arrays.reliable[index2]
+        ids, index1, index2 = ids[both], index1[both], index2[both]
+    return ids, cam1.phi[index1], cam2.phi[index2]
+
+
+def intersection_grid(cam1: RawSnapData, cam2: RawSnapData, phi: np.ndarray, alfa: np.ndarray, beta: np.ndarray) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized get_intersection_coord for many angles and many leds at once.
+    :param cam1: First camera
+    :param cam2: Seconds camera
+    :param phi: (A) Rotation angles between the cameras
+    :param alfa: (N) Pixel phi of the leds in cam1
+    :param beta: (N) Pixel phi of the leds in cam2
+    :return: x and y coordinate, both (A, N). Parallel lines give inf.
+    """
+    pos1 = cam1.camera_pos.coord
+    pos2 = rotate(cam2.camera_pos.coord, phi)
+    pos2_x, pos2_y = pos2[:, :1], pos2[:, 1:2]
+    phi = np.asarray(phi, dtype=float)[:, None]
+
+    a1 = np.sin(alfa)
+    b1 = np.cos(alfa)
+    c1 = -pos1[0] * a1 - pos1[1] * b1
+
+    a2 = np.sin(beta + phi)
+    b2 = np.cos(beta + phi)
+    c2 = -pos2_x * a2 - pos2_y * b2
+
+    # Solve Cramer's rule
+    det = a1 * b2 - a2 * b1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.where(det == 0, inf, (b1 * c2 - b2 * c1) / det)
+        y = np.where(det == 0, inf, (c1 * a2 - c2 * a1) / det)
+    return x, y
+
+
+def angle_scores(cam1: RawSnapData, cam2: RawSnapData, phi: np.ndarray, alfa: np.ndarray, beta: np.ndarray) \
+        -> np.ndarray:
+    """
+    Score how well all leds fit in the unity circle, for each angle phi between the cameras. Higher is better.
+    A led inside the unity circle adds 1, a led outside adds 1 / distance^2.
+    :return: (A) score for each angle
+    """
+    x, y = intersection_grid(cam1, cam2, phi, alfa, beta)
+
+    dist = x * x + y * y
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = np.where(dist < 1, 1.0, 1 / dist)
+    score[~np.isfinite(score)] = 0
+    return score.sum(axis=1)
+
+
 def angle_fit_data(cam1: RawSnapData, cam2: RawSnapData, num_test_angles=500) -> numpy.ndarray:
     """
     Generate data to test what is the most probable angle 2 cameras make with each other.
@@ -55,65 +118,112 @@ def angle_fit_data(cam1: RawSnapData, cam2: RawSnapData, num_test_angles=500) ->
       The first test is both camera's on the same side (phi = 0)
       For each step a score is calculated. This score represents how well all Pixels fit in the unity circle.
       A higher score is a better fit.
+    The intersections of all angles and all leds are calculated at once as a (num_test_angles, leds) grid.
     :param cam1: Base camera
     :param cam2: Data snap to test against.
     :param num_test_angles: the number of tests steps to take when making 1 full rotation
     :return: Array. Each element holds angle phi and a score for the fit of the angle
     """
-    result = np.ndarray(shape=(num_test_angles, 2), dtype=float)
-    for i in range(0, num_test_angles):
-        phi = i * 2 * pi / num_test_angles
-        result[i] = (phi, 0)
+    phi = np.arange(num_test_angles) * 2 * pi / num_test_angles
+    _, alfa, beta = shared_led_angles(cam1, cam2)
+    return np.stack([phi, angle_scores(cam1, cam2, phi, alfa, beta)], axis=1)
 
-        for led in cam1.snapl.values():
-            if led.reliable and led.id in cam2.snapl and cam2.snapl[led.id].reliable:
-                x, y = get_intersection_coord(cam1, cam2, phi, led.id)
 
-                dist = x*x + y*y
-                if dist < 1:
-                    result[i, 1] += 1
-                else:
-                    result[i, 1] += 1/dist
+class AngleEstimate(NamedTuple):
+    best: float  # Most likely angle between the cameras
+    second: float  # Second most likely angle
+    confidence: float  # 1 - score second / score best. 0 if both angles fit equally well.
+    width: float  # Width of the best peak. All angles within the width fit (almost) equally well.
 
-    return result
+
+def circular_peaks(values: np.ndarray) -> np.ndarray:
+    """
+    Find the index of all peaks in values, where values wrap around (the last value neighbours the first value).
+    """
+    peaks, _ = find_peaks(np.concatenate([values[-1:], values, values[:1]]))
+    return (peaks - 1) % len(values)
 
 
-def estimate_angle(cam1: RawSnapData, cam2: RawSnapData) -> Tuple[float, float]:
+def refine_peak(cam1: RawSnapData, cam2: RawSnapData, phi: np.ndarray, score: np.ndarray, index: int,
+                alfa: np.ndarray, beta: np.ndarray, tolerance=1e-3, num_test_angles=11, iterations=12) \
+        -> Tuple[float, float, float]:
+    """
+    Refine a peak found on the coarse grid phi.
+    The score often has a flat top: all leds fit in the unity circle for a range of angles.
+    The refined angle is therefore the center of the range of angles scoring within tolerance of the maximum.
+    1. The maximum is searched on a fine grid within 1 coarse step of the coarse peak.
+    2. The coarse grid is followed on both sides until the score drops below the maximum.
+    3. Both edges are located by bisection between the last coarse angle in range and the first one out of range.
+    :param phi: Coarse grid of angles, equally spaced over a full rotation
+    :param score: Score for each angle in phi
+    :param index: Index of the coarse peak
+    :return: Refined angle, score at the refined angle, width of the peak
+    """
+    step = phi[1] - phi[0]
+    test = phi[index] + np.linspace(-step, step, num_test_angles)
+    fine = angle_scores(cam1, cam2, test, alfa, beta)
+    top = test[np.argmax(fine)]
+    threshold = np.max(fine) - tolerance * abs(np.max(fine))
+
+    inside = np.array([top, top])
+    outside = np.zeros(2)
+    for side, direction in enumerate((-1, 1)):
+        k = 0
+        while score[(index + (k + 1) * direction) % len(score)] >= threshold and k < len(score) // 2:
+            k += 1
+            inside[side] = phi[index] + k * direction * step
+        outside[side] = phi[index] + (k + 1) * direction * step
+
+    for _ in range(iterations):
+        middle = (inside + outside) / 2
+        in_range = angle_scores(cam1, cam2, middle, alfa, beta) >= threshold
+        inside = np.where(in_range, middle, inside)
+        outside = np.where(in_range, outside, middle)
+
+    edges = (inside + outside) / 2
+    center = (edges[0] + edges[1]) / 2
+    return center, float(angle_scores(cam1, cam2, np.array([center]), alfa, beta)[0]), edges[1] - edges[0]
+
+
+def estimate_angle(cam1: RawSnapData, cam2: RawSnapData, num_test_angles=90, num_peaks=4) -> AngleEstimate:
     """
     Make an estimation of the most likely angles 2 camara positions make with each other.
+    First a coarse sweep is made over a full rotation. The best peaks are refined to sub degree precision.
     :param cam1: Base camera
     :param cam2: Second camera. The reported angle is the angle cam2 makes with cam1
-    :return: Tuple [best angle, second best angle.]
+    :param num_test_angles: Number of angles in the coarse sweep
+    :param num_peaks: Number of coarse peaks to refine
+    :return: AngleEstimate [best angle, second best angle, confidence, width]
     """
-    data = angle_fit_data(cam1, cam2)
-    peaks, _ = find_peaks(data[:, 1])
-    maxima = [data[p] for p in peaks]
-    sorted_max = sorted(maxima, key=lambda m: m[1], reverse=True)
+    _, alfa, beta = shared_led_angles(cam1, cam2)
+    phi = np.arange(num_test_angles) * 2 * pi / num_test_angles
+    score = angle_scores(cam1, cam2, phi, alfa, beta)
+
+    peaks = circular_peaks(score)
+    peaks = peaks[np.argsort(score[peaks])[::-1][:num_peaks]]
+    refined = sorted([refine_peak(cam1, cam2, phi, score, p, alfa, beta) for p in peaks],
+                     key=lambda m: m[1], reverse=True)
 
-    best = sorted_max[0][0]
-    second = sorted_max[1][0]
-    if best > pi:
-        best = best - 2 * pi
-    if second > pi:
-        second = second - 2 * pi
+    (best, best_score, width), (second, second_score, _) = refined[0], refined[1]
+    best = (best + pi) % (2 * pi) - pi
+    second = (second + pi) % (2 * pi) - pi
+    confidence = 1 - second_score / best_score if best_score > 0 else 0.0
 
-    return best, second
+    return AngleEstimate(best, second, confidence, width)
 
 
-def all_intersection(cam1: RawSnapData, cam2: RawSnapData, angle, max_dist=2) -> Dict[int, Pixel]:
+def all_intersection(cam1: RawSnapData, cam2: RawSnapData, angle, max_dist=2) -> PositionTable:
     """
     Calculate the coordinates of leds visible by 2 cameras with a given angle between the camera's.
     The coordinates are referenced to the frame of the first camera.
     :param cam1: LedData camera position
     :param cam2: other LedData camera position
     :param angle: desired angle between the 2 camera's
-    :param max_dist: only leds with coordinates smaller than max_dist are added in the returned dict
-    :return: Dict. Key is the led id, value is a tuple of x, y, z
-    """
-    data = {}
-    for key in cam1.snapl.keys():
-        if key in cam2.snapl:
-            x, y = get_intersection_coord(cam1, cam2, angle, key)
-            if -max_dist < x < max_dist and -max_dist < y < max_dist:
-                data[key] = Pixel(key, x, y, 0)
-    return data
+    :param max_dist: only leds with coordinates smaller than max_dist are added in the returned table
+    :return: Table with the x, y, z position of the leds
+    """
+    ids, alfa, beta = shared_led_angles(cam1, cam2, reliable=False)
+    x, y = intersection_grid(cam1, cam2, np.array([angle]), alfa, beta)
+    coord = np.stack([x[0], y[0], np.zeros(len(ids))], axis=1)
+    inside = (np.abs(coord[:, 0]) < max_dist) & (np.abs(coord[:, 1]) < max_dist)
+    return PositionTable.from_arrays(ids[inside], coord[inside])
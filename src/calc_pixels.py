@@ -1,56 +1,89 @@
-import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
 
 import cv2
 
-from typing import List, Union
-from numpy import zeros, array
+from typing import Dict, List, Optional, Tuple, Union
+from numpy import zeros, array, concatenate, indices, ndarray, stack
 import matplotlib.pyplot as plt
-from sklearn.cluster import KMeans
-from numpy import argwhere, average
-from webcam import read_im
-from config import storage, NUM_PIXELS, NUM_SNAP_FRAMES
-from model.bit_info import BitInfo
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from numpy import append, arange, argsort, average, empty, flatnonzero, full, int32, searchsorted, uint8, unique
+from webcam import read_im, read_stack, STACK_FILE
+from config import storage, DETECTION_METHOD, NUM_PIXELS, NUM_SNAP_FRAMES
+from model.bit_info import BitInfo, BitTable
+from detection_cache import DetectionCache
+from model.led_table import data_file, read_led_table, write_led_table
 
+RESULT_PLOT = 'results.png'
 
-class Pixel:
-    register: List['Pixel'] = []
 
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
-        self.group = 0
-        self.disabled = False
-        self.id = len(self.register)  # Id of pixel
-        self.register.append(self)
+class PixelStore:
+    """
+    PixelStore holds the state of every pixel in an image as columns.
+    The id of a pixel is the row of the pixel in Cluster.data: id = x * Y + y.
+    Instead of an object per pixel, all pixels share one array per property, which allows to disable
+    or group many pixels with a single index update.
+    """
+    def __init__(self, x_size: int, y_size: int):
+        xy = indices((x_size, y_size), dtype=int32).reshape(2, -1)
+        self.x = xy[0]
+        self.y = xy[1]
+        self.group = zeros(x_size * y_size, dtype=int32)
+        self.disabled = zeros(x_size * y_size, dtype=bool)
+
+    def __len__(self):
+        return len(self.disabled)
+
+    @property
+    def active(self) -> ndarray:
+        """
+        :return: Boolean mask of all pixels not disabled
+        """
+        return ~self.disabled
 
-    def disable(self):
-        self.disabled = True
-        self.group = -1
+    @property
+    def active_id(self) -> ndarray:
+        """
+        :return: The id of all pixels not disabled
+        """
+        return flatnonzero(~self.disabled)
 
+    def disable(self, pid: Union[int, ndarray, List[int]]):
+        """
+        Disable pixels for further calculations
+        :param pid: pixel id, list of pixel id or boolean mask
+        """
+        self.disabled[pid] = True
+        self.group[pid] = -1
 
-def make_pixel(x, y):
-    for i in range(x):
-        for j in range(y):
-            Pixel(i, j)
+    def center(self, pid: ndarray) -> List[int]:
+        return [int(self.x[pid].sum() / len(pid)), int(self.y[pid].sum() / len(pid))]
 
 
 class ClusterGroup:
     """
     A ClusterGroup represents a cluster of pixels with similar properties.
+    The raw values and bit information of the cluster are a row of the BitTable shared by all clusters of a run.
     """
-    def __init__(self, data: List, series_name):
-        self.data = data  # Raw values for each imag.
+    def __init__(self, table: BitTable, index: int, pixels: PixelStore):
+        self.bit_info = BitInfo(table, index)
         self._center = []
-        self.bit_info = BitInfo(self.data, series_name)
-        self.pixel_id = []
+        self.pixels = pixels
+        self.pixel_id = empty(0, dtype=int)
 
-    def add_pixel(self, pid: Union[int, List[int]]):
-        if isinstance(pid, int):
-            self.pixel_id.append(pid)
-        else:
-            self.pixel_id.extend(pid)
+    def add_pixel(self, pid: Union[int, ndarray, List[int]]):
+        self.pixel_id = append(self.pixel_id, pid)
         self._center = []
 
+    @property
+    def data(self) -> ndarray:
+        """
+        Raw values for each image
+        """
+        return self.bit_info.data
+
     @property
     def size(self):
         return len(self.pixel_id)
@@ -58,13 +91,7 @@ class ClusterGroup:
     @property
     def center(self) -> array:
         if not self._center:
-            x = 0
-            y = 0
-            for pid in self.pixel_id:
-                pixel = Pixel.register[pid]
-                x += pixel.x
-                y += pixel.y
-            self._center = [int(x/len(self.pixel_id)), int(y/len(self.pixel_id))]
+            self._center = self.pixels.center(self.pixel_id)
         return self._center
 
     def disable_pixels(self):
@@ -72,63 +99,117 @@ class ClusterGroup:
         Disable all pixels from cluster for further calculations
         :return:
         """
-        for pid in self.pixel_id:
-            Pixel.register[pid].disable()
+        self.pixels.disable(self.pixel_id)
 
 
 class Cluster:
-    def __init__(self, series_name, num_frames: int = NUM_SNAP_FRAMES, num_leds: int = NUM_PIXELS):
-        Pixel.register = []
+    def __init__(self, series_name, num_frames: int = NUM_SNAP_FRAMES, num_leds: int = NUM_PIXELS,
+                 mini_batch: bool = False, max_iter: int = 300, cache: Optional[DetectionCache] = None):
+        """
+        :param series_name: Name of the snap series
+        :param num_frames: Number of images with a blinked bit
+        :param num_leds: Number of leds in the tree. Also the number of clusters used by KMeans.
+        :param mini_batch: Use MiniBatchKMeans instead of KMeans. Less accurate, but much faster on large images.
+        :param max_iter: Maximum number of iterations for a single clustering run.
+        :param cache: Detection cache of the series. Cached difference images are used instead of the png files.
+        """
         self.series_name = series_name
         self.storage = storage
-        self.ground = read_im(f'{series_name}/ground')
-        self.all = read_im(f'{series_name}/all')
+        self.cache = cache
+        # If the series is stored as frame stack, all images are memory mapped views on the stack.
+        self.stack = read_stack(series_name)
+        if self.stack is not None:
+            self.ground = self.stack[..., 0]
+            self.all = self.stack[..., 1]
+        else:
+            self.ground = read_im(f'{series_name}/ground')
+            self.all = read_im(f'{series_name}/all')
         self.X = self.ground.shape[0]
         self.Y = self.ground.shape[1]
-        make_pixel(self.X, self.Y)
+        self.pixels = PixelStore(self.X, self.Y)
 
         self.num_frames = num_frames
         self.num_leds = num_leds
         self.images = self.load_images()
 
-        # Data contains a row for each pixel. Each row contains the raw value of the pixel in each image.
-        self.data = zeros((self.X * self.Y, num_frames), dtype=int)
-        # Dataxy, same as data, but x, and y coordinate are prepended.
-        self.dataxy = zeros((self.X * self.Y, num_frames+2), dtype=int)
+        # Dataxy contains a row for each pixel: the x and y coordinate followed by the raw value in each image.
+        self.dataxy: Optional[ndarray] = None
+        # Data contains the raw values of each pixel in each image. Data is a view on dataxy, not a copy.
+        self.data: Optional[ndarray] = None
 
         self.cluster_data: List[ClusterGroup] = []
+        self.bit_table: Optional[BitTable] = None  # Bit information of all clusters in cluster_data
+        self.mini_batch = mini_batch
+        self.max_iter = max_iter
+        # Cluster centers of the last clustering run. Used as start point (warm start) for the next run.
+        self.cluster_centers: Optional[ndarray] = None
 
         self.detected_led: List[ClusterGroup] = []  # Array to hold likely locations of leds.
-
-        self.disabled_pixels = {}  # This list excludes pixels from being grouped
+        self.low_variance: Optional[ndarray] = None  # Mask of pixels with a low variance
         self.fill_data()
 
     def load_images(self):
+        if self.stack is not None:
+            return [self.stack[..., 2 + n] for n in range(self.num_frames)]
+        if self.cache and (frames := self.cache.frames()) is not None:
+            return list(frames.transpose(2, 0, 1))
         images = [read_im(f'{self.series_name}/{self.num_frames-n-1}') for n in range(self.num_frames)]
         return [cv2.cvtColor(cv2.absdiff(_, self.ground), cv2.COLOR_BGR2GRAY) for _ in images]
 
     def fill_data(self):
-        counter = 0
-        for i in range(self.X):
-            for j in range(self.Y):
-                self.data[counter] = [self.images[_][i][j] for _ in range(self.num_frames)]
-                self.dataxy[counter] = [i, j, *self.data[counter]]
-                counter += 1
+        """
+        Stack all images into one (X, Y, frames + 2) array and flatten it to a row per pixel.
+        The rows are ordered as the pixels are, i * Y + j, so the pixel id equals the row number.
+        A frame stack already has this layout, data is then a view on the memory mapped stack and dataxy is not used.
+        """
+        if self.stack is not None:
+            self.data = self.stack.reshape(self.X * self.Y, self.num_frames + 2)[:, 2:]
+            return
 
-    def calc_kmeans(self):
-        data = self.data[[not p.disabled for p in Pixel.register]]
-        km = KMeans(n_clusters=int(self.num_leds)).fit(data)
-        self.cluster_data = [ClusterGroup(row, self.series_name) for row in km.cluster_centers_]
+        frames = stack(self.images, axis=-1)
+        xy = indices((self.X, self.Y)).transpose(1, 2, 0)
+        self.dataxy = concatenate((xy, frames), axis=-1, dtype=int).reshape(self.X * self.Y, self.num_frames + 2)
+        self.data = self.dataxy[:, 2:]
 
-        prediction = km.predict(data)
+    def calc_kmeans(self, warm_start: bool = True):
+        """
+        Cluster all active pixels.
+        :param warm_start: Start from the cluster centers of the previous run (if available) instead of a fresh
+                           k-means++ initialisation. The iterative filters only disable a few clusters per run,
+                           so the previous centers are already close to the new solution.
+        """
+        active_id = self.pixels.active_id
+        data = self.data[active_id]
 
-        counter = 0
-        for p in Pixel.register:
-            if p.disabled:
-                continue
-            p.group = prediction[counter]
-            self.cluster_data[prediction[counter]].add_pixel(p.id)
-            counter += 1
+        if warm_start and self.cluster_centers is not None:
+            init = self.cluster_centers
+        else:
+            init = 'k-means++'
+
+        if self.mini_batch:
+            km = MiniBatchKMeans(n_clusters=int(self.num_leds), init=init, n_init=1, max_iter=self.max_iter,
+                                 batch_size=4096)
+        else:
+            km = KMeans(n_clusters=int(self.num_leds), init=init, n_init=1, max_iter=self.max_iter)
+        km.fit(data)
+        self.cluster_centers = km.cluster_centers_
+        self.set_cluster_data(km.cluster_centers_)
+
+        prediction = km.labels_
+        self.pixels.group[active_id] = prediction
+
+        # Sort the pixels by group, each group is then a consecutive slice of the sorted pixel id.
+        order = argsort(prediction, kind='stable')
+        bounds = searchsorted(prediction[order], arange(len(self.cluster_data) + 1))
+        for group, cluster in enumerate(self.cluster_data):
+            cluster.add_pixel(active_id[order[bounds[group]:bounds[group + 1]]])
+
+    def set_cluster_data(self, centers: ndarray):
+        """
+        Replace the clusters by a new set of clusters, one for each row in centers.
+        """
+        self.bit_table = BitTable(centers, self.series_name)
+        self.cluster_data = [ClusterGroup(self.bit_table, i, self.pixels) for i in range(len(self.bit_table))]
 
     def biggest_cluster(self) -> ClusterGroup:
         """
@@ -136,16 +217,17 @@ class Cluster:
         """
         return max(self.cluster_data, key=lambda x: x.size)
 
-    def filter_ground_all(self):
-        """Filter out all pixels with a small difference between full on and off"""
-        diffim = cv2.absdiff(c.ground, c.all)
-
-        counter = 0
-        for i in range(self.X):
-            for j in range(self.Y):
-                weight = sum(diffim[i, j])
-                if weight < 21:
-                    Pixel.register[counter].disable()
+    def filter_ground_all(self, threshold: int = 7):
+        """
+        Filter out all pixels with a small difference between full on and off.
+        Both images are compared in gray, the frame stack only holds gray images. So a series gives the same
+        pixels for png images and for a frame stack.
+        :param threshold: Minimal gray difference. 7 is the former threshold of 21 on the sum of the 3 colors.
+        """
+        ground, all_on = (cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+                          for image in (self.ground, self.all))
+        diffim = cv2.absdiff(ground, all_on)
+        self.pixels.disable(diffim.reshape(self.X * self.Y) < threshold)
 
     def filter_by_biggest(self, max_cluster_size=100):
         while self.biggest_cluster().size > max_cluster_size:
@@ -158,7 +240,7 @@ class Cluster:
             print(f"LEN = {len(self.detected_led)}")
 
             self.calc_kmeans()
-            self.cluster_data.sort(key=lambda x: x.bit_info.score)
+            self.cluster_data = [self.cluster_data[i] for i in argsort(self.bit_table.score, kind='stable')]
             # Use the best scoring 20% of clusters
             smallest = self.cluster_data[0]
             largest = self.cluster_data[0]
@@ -175,9 +257,74 @@ class Cluster:
 
     def temp_filter(self):
         self.calc_kmeans()
-        for c in self.cluster_data:
-            if c.bit_info.led_key >= 0:
-                self.register_detected(c)
+        self.register_matching()
+
+    def register_matching(self):
+        """
+        Register all clusters matching a led as detected.
+        """
+        for i in flatnonzero(self.bit_table.led_key >= 0):
+            self.register_detected(self.cluster_data[i])
+
+    def decode_bit_pattern(self, threshold: Optional[int] = None, min_size: int = 2):
+        """
+        Find the leds by decoding the blinked bit pattern directly, as an alternative to clustering with KMeans.
+        Each frame is thresholded to on / off, which gives every pixel a bit code in a single pass.
+        Connected pixels sharing the same code form a blob. Each blob becomes a ClusterGroup holding the mean
+        pixel values, so the BitInfo (led key, score) and the stored data are the same as for KMeans clusters.
+        :param threshold: Pixel value separating on and off. If None, a threshold is calculated per frame (Otsu).
+        :param min_size: Minimum number of pixels in a blob
+        """
+        if threshold is None:
+            thresholds = array([cv2.threshold(im, 0, 1, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[0] for im in self.images])
+        else:
+            thresholds = full(self.num_frames, threshold)
+
+        # The first image holds the most significant bit
+        weights = 1 << arange(self.num_frames - 1, -1, -1)
+        codes = (self.data > thresholds) @ weights
+        codes[self.pixels.disabled] = 0
+
+        # Sort all pixels with a code, each code is then a consecutive slice of the sorted pixel id.
+        pixel_id = flatnonzero(codes)
+        pixel_id = pixel_id[argsort(codes[pixel_id], kind='stable')]
+        _, bounds = unique(codes[pixel_id], return_index=True)
+        bounds = append(bounds, len(pixel_id))
+
+        blobs: List[ndarray] = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if end - start < min_size:
+                continue
+            pid = pixel_id[start:end]
+            x = self.pixels.x[pid] - self.pixels.x[pid].min()
+            y = self.pixels.y[pid] - self.pixels.y[pid].min()
+            mask = zeros((x.max() + 1, y.max() + 1), dtype=uint8)
+            mask[x, y] = 1
+            num, labels = cv2.connectedComponents(mask)
+            label = labels[x, y]
+            for n in range(1, num):
+                blob = pid[label == n]
+                if len(blob) >= min_size:
+                    self.pixels.group[blob] = len(blobs)
+                    blobs.append(blob)
+
+        self.set_cluster_data(array([self.data[blob].mean(axis=0) for blob in blobs]).reshape(-1, self.num_frames))
+        for cluster, blob in zip(self.cluster_data, blobs):
+            cluster.add_pixel(blob)
+        self.register_matching()
+
+    def detect(self, method: str = DETECTION_METHOD):
+        """
+        Find the led positions in the series.
+        :param method: 'kmeans' to cluster the pixels with KMeans, 'decode' to decode the bit pattern of each pixel.
+        """
+        if method == 'kmeans':
+            self.filter_low_variance()
+            self.temp_filter()
+        elif method == 'decode':
+            self.decode_bit_pattern()
+        else:
+            raise RuntimeError(f'Detection method "{method}" not supported')
 
     def register_detected(self, cluster: ClusterGroup):
         for c in self.detected_led:
@@ -194,15 +341,16 @@ class Cluster:
         Disable all pixels with a low variance.
         Low variance pixels are pixels with the same value for all pictures.
         """
-        variance = self.data.var(axis=1)
+        if self.cache:
+            self.low_variance = self.cache.variance_mask()
+        if self.low_variance is None:
+            variance = self.data.var(axis=1)
+            self.low_variance = variance < average(variance) ** 2
 
-        for _ in argwhere(variance < average(variance) ** 2):
-            Pixel.register[_[0]].disable()
+        self.pixels.disable(self.low_variance)
 
     def show_plot(self):
-        data = zeros((self.X, self.Y))
-        for p in Pixel.register:
-            data[p.x, p.y] = p.group
+        data = self.pixels.group.reshape(self.X, self.Y)
         plt.clf()
         plt.imshow(data)
         self.plot_cluster_center()
@@ -245,52 +393,134 @@ class Cluster:
         self.plot_group_number()
         plt.show()
 
-    def write_data(self):
-        result = []
-        for row in self.detected_led:
-            result.append({'x': row.center[0], 'y': row.center[1],
-                           'led': row.bit_info.led_key,
-                           'bit': row.bit_info.bit_string,
-                           'random': row.bit_info.bit_number,
-                           'score': row.bit_info.score})
-            print(row.bit_info.score)
-
-        with (storage / self.series_name / 'data.txt') as file:
-            file.write_text(json.dumps(result))
+    def led_table(self) -> Dict[str, ndarray]:
+        """
+        :return: The detected leds as a table with a column for each key in LED_COLUMNS
+        """
+        return {'x': array([row.center[0] for row in self.detected_led], dtype=int),
+                'y': array([row.center[1] for row in self.detected_led], dtype=int),
+                'led': array([row.bit_info.led_key for row in self.detected_led], dtype=int),
+                'random': array([row.bit_info.bit_number for row in self.detected_led], dtype=int),
+                'score': array([row.bit_info.score for row in self.detected_led], dtype=int)}
 
-    def write_result_plot(self):
-        plt.clf()
-        plt.imshow(self.all)
-        with (storage / self.series_name / 'data.txt') as file:
-            data = json.loads(file.read_text())
+    def write_data(self):
+        write_led_table(storage / self.series_name, self.led_table(), self.num_frames)
 
-        for i in data:
-            try:
-                row = data[i]
-            except TypeError:
-                # Workaround for old data files.
-                row = i
-            plt.scatter(row['y'], row['x'], s=2, marker='*', edgecolors='blue')
-            if row['score'] > 50:
-                plt.text(row['y'], row['x'], row['led'], fontsize=6, color='red')
+    def store_cache(self):
+        """
+        Store the difference images, low variance mask and detected leds in the detection cache.
+        """
+        frames = stack(self.images, axis=-1) if self.stack is None else None
+        self.cache.store(frames=frames, variance_mask=self.low_variance, leds=self.led_table())
 
-        plt.savefig(storage / self.series_name / 'results.png')
+    def write_result_plot(self):
+        write_result_plot(storage / self.series_name, self.all)
 
     def store_results(self):
         self.write_data()
         self.write_result_plot()
 
 
-if __name__ == "__main__":
-    import time
+def read_all_image(series_name) -> ndarray:
+    """
+    :return: The image with all leds on, from the frame stack if the series is stored as stack
+    """
+    stack = read_stack(series_name)
+    if stack is not None:
+        return stack[..., 1]
+    return read_im(f'{series_name}/all')
+
 
+def write_result_plot(folder: Path, image: ndarray):
+    """
+    Plot the detected leds of a series over the image with all leds on, and store it as results.png.
+    """
+    plt.clf()
+    plt.imshow(image)
+    table = read_led_table(folder)
+    plt.scatter(table['y'], table['x'], s=2, marker='*', edgecolors='blue')
+    for i in flatnonzero(table['score'] > 50):
+        plt.text(table['y'][i], table['x'][i], table['led'][i], fontsize=6, color='red')
+
+    plt.savefig(folder / RESULT_PLOT)
+
+
+def series_inputs(folder: Path, num_frames: int = NUM_SNAP_FRAMES) -> List[Path]:
+    """
+    All files used as input for detecting the leds in a series.
+    """
+    if (folder / STACK_FILE).exists():
+        return [folder / 'numbers.txt', folder / STACK_FILE]
+    return [folder / 'numbers.txt', folder / 'ground.png', folder / 'all.png'] + \
+        [folder / f'{n}.png' for n in range(num_frames)]
+
+
+def is_up_to_date(folder: Path, num_frames: int = NUM_SNAP_FRAMES) -> bool:
+    """
+    A series is up to date if the detected leds are written after the last change of all input files.
+    """
+    file = data_file(folder)
+    if file is None:
+        return False
+    return all(source.stat().st_mtime <= file.stat().st_mtime for source in series_inputs(folder, num_frames))
+
+
+def detection_cache(folder: Path, method: str = DETECTION_METHOD, num_frames: int = NUM_SNAP_FRAMES,
+                    num_leds: int = NUM_PIXELS) -> DetectionCache:
+    """
+    Get the detection cache of a series, keyed on the input files and the detection parameters.
+    """
+    return DetectionCache(folder, series_inputs(folder, num_frames),
+                          method=method, num_frames=num_frames, num_leds=num_leds)
+
+
+def detect_series(folder: Path, method: str = DETECTION_METHOD, use_cache: bool = True) -> Tuple[str, float]:
+    """
+    Detect all leds in a single series and store the results.
+    If the detection cache holds leds for the same inputs and parameters, these are written without detecting.
+    The result plot is then only written if it is missing.
+    :return: name of the series and the time it took in seconds.
+    """
+    start = time.time()
+    cache = detection_cache(folder, method) if use_cache else None
+    if cache and (leds := cache.leds()) is not None:
+        write_led_table(folder, leds)
+        if not (folder / RESULT_PLOT).exists():
+            write_result_plot(folder, read_all_image(folder))
+        return folder.name, time.time() - start
+
+    c = Cluster(folder, cache=cache)
+    c.detect(method)
+    c.store_results()
+    if cache:
+        c.store_cache()
+    return folder.name, time.time() - start
+
+
+def detect_all(workers: Optional[int] = None, method: str = DETECTION_METHOD, force: bool = False):
+    """
+    Detect the leds in all series in storage. Each series is processed in its own process.
+    :param workers: Number of processes. If None, the number of cpu cores is used.
+    :param method: Detection method, see Cluster.detect
+    :param force: Also detect series which are up to date.
+    """
+    folders = []
     for folder in storage.glob('*'):
-        if 'backup' not in folder.parts:
-
-            start = time.time()
-            c = Cluster(folder)
-            c.filter_low_variance()
-            c.temp_filter()
-            print(time.time() - start)
-            c.write_data()
-            c.store_results()
+        if not folder.is_dir() or 'backup' in folder.parts or not series_inputs(folder)[1].exists():
+            continue
+        if not force and is_up_to_date(folder):
+            print(f"{folder.name} up to date")
+            continue
+        folders.append(folder)
+
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(detect_series, folder, method) for folder in folders]
+        for future in as_completed(futures):
+            name, duration = future.result()
+            print(f"{name} done in {duration:.1f} seconds")
+    print(f"Detected {len(folders)} series in {time.time() - start:.1f} seconds")
+
+
+if __name__ == "__main__":
+    detect_all(int(sys.argv[1]) if len(sys.argv) > 1 else None)
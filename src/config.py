@@ -15,3 +15,9 @@ NUM_SNAP_FRAMES == 12, has 4080 leds supported.
 """
 
 NUM_SNAP_FRAMES = 12
+
+"""
+Method used to find the led positions in a snap series.
+'kmeans' clusters all pixels with KMeans, 'decode' decodes the blinked bit pattern of each pixel directly.
+"""
+DETECTION_METHOD = 'kmeans'
@@ -0,0 +1,100 @@
+"""
+Persistent cache for the led detection of a snap series.
+
+The cache is stored as a single compressed numpy file in the series folder.
+It holds intermediate arrays (the grayscale difference images and the low variance mask) and the detected leds.
+The intermediate arrays are valid as long as the input images do not change.
+The detected leds are only valid for the same input images and the same detection parameters.
+"""
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+CACHE_FILE = 'detection_cache.npz'
+
+# Columns of the detected led table, as stored by model.led_table
+LED_COLUMNS = ('x', 'y', 'led', 'random', 'score')
+
+
+def hash_files(files: List[Path]) -> str:
+    """
+    Hash the name and content of all files.
+    """
+    sha = hashlib.sha256()
+    for file in files:
+        sha.update(file.name.encode())
+        sha.update(file.read_bytes())
+    return sha.hexdigest()
+
+
+class DetectionCache:
+    def __init__(self, folder: Path, files: List[Path], **params):
+        """
+        :param folder: Series folder
+        :param files: All input files of the detection
+        :param params: Detection parameters. The cached leds are only used if all parameters are equal.
+        """
+        self.file = folder / CACHE_FILE
+        self.input_key = hash_files(files)
+        self.key = hashlib.sha256((self.input_key + json.dumps(params, sort_keys=True)).encode()).hexdigest()
+        self._data: Optional[Dict[str, np.ndarray]] = None
+
+    @property
+    def data(self) -> Dict[str, np.ndarray]:
+        if self._data is None:
+            try:
+                with np.load(self.file) as file:
+                    self._data = dict(file)
+            except (FileNotFoundError, ValueError, OSError):
+                self._data = {}
+        return self._data
+
+    def _valid_inputs(self) -> bool:
+        return 'input_key' in self.data and str(self.data['input_key']) == self.input_key
+
+    def frames(self) -> Optional[np.ndarray]:
+        """
+        :return: Grayscale difference images as (X, Y, frames) array, None if not cached
+        """
+        if self._valid_inputs() and 'frames' in self.data:
+            return self.data['frames']
+        return None
+
+    def variance_mask(self) -> Optional[np.ndarray]:
+        """
+        :return: Boolean mask of pixels with a low variance, None if not cached
+        """
+        if self._valid_inputs() and 'variance_mask' in self.data:
+            return self.data['variance_mask']
+        return None
+
+    def leds(self) -> Optional[Dict[str, np.ndarray]]:
+        """
+        :return: Table with a column for each key in LED_COLUMNS, None if not cached
+        """
+        if 'key' in self.data and str(self.data['key']) == self.key:
+            return {column: self.data[column] for column in LED_COLUMNS}
+        return None
+
+    def store(self, frames: np.ndarray = None, variance_mask: np.ndarray = None,
+              leds: Dict[str, np.ndarray] = None):
+        """
+        Store the cache. Arrays not given are kept from the existing cache if the input images did not change.
+        """
+        data = {}
+        if self._valid_inputs():
+            data = {k: v for k, v in self.data.items() if k in ('frames', 'variance_mask')}
+        data['input_key'] = np.array(self.input_key)
+        if frames is not None:
+            data['frames'] = frames
+        if variance_mask is not None:
+            data['variance_mask'] = variance_mask
+        if leds is not None:
+            data['key'] = np.array(self.key)
+            data.update({column: np.asarray(leds[column]) for column in LED_COLUMNS})
+
+        np.savez_compressed(self.file, **data)
+        self._data = data
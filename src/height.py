@@ -6,13 +6,10 @@ import numpy as np
 
 from loader import load_all_data_container
 from config import NUM_PIXELS
-from pandas import DataFrame
+from pandas import DataFrame, Series
 
 from analyze_data import DataContainer
 
-# Optimize the data. This will lead to more accurate led detection, but will take quite some extra calculation time.
-OPTIMIZED = False
-
 
 def count_times_leds_occurs(snaps: List[DataContainer]):
     all_id = {}
@@ -92,22 +89,19 @@ def estimate_led_height(snaps: List[DataContainer], num_rotatations=2, median_wi
     return median_df
 
 
-SNAPS = load_all_data_container(OPTIMIZED)
-
-HEIGHT = estimate_led_height(SNAPS)['median']  # Typing hint index = int, value = float
-
-"""
-Fill the Height estimations in the snap containers.
-"""
-
-for cont in SNAPS:
-    for led in cont.data.values():
-        if HEIGHT[led.led_id] > cont.estimate.max_height:
-            cont.estimate.max_height = HEIGHT[led.led_id]
-            cont.estimate.top_led_x = led.x
-        if HEIGHT[led.led_id] < cont.estimate.min_height:
-            cont.estimate.min_height = HEIGHT[led.led_id]
-            cont.estimate.bot_led_x = led.x
+def fill_height_estimates(snaps: List[DataContainer], height: Series):
+    """
+    Fill the Height estimations in the snap containers.
+    :param height: Height of each led, see estimate_led_height
+    """
+    for cont in snaps:
+        for led in cont.data.values():
+            if height[led.led_id] > cont.estimate.max_height:
+                cont.estimate.max_height = height[led.led_id]
+                cont.estimate.top_led_x = led.x
+            if height[led.led_id] < cont.estimate.min_height:
+                cont.estimate.min_height = height[led.led_id]
+                cont.estimate.bot_led_x = led.x
 
 
 if __name__ == "__main__":
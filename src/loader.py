@@ -14,6 +14,7 @@ from typing import List
 import pandas as pd
 
 from analyze_data import DataContainer, optimize_led_strings
+from model.led_table import has_led_table
 
 
 def load_all_data_container(optimize=False) -> List[DataContainer]:
@@ -25,7 +26,7 @@ def load_all_data_container(optimize=False) -> List[DataContainer]:
 
     snaps = []
     for folder in (Path(__file__).parents[1] / 'snap').glob('*'):
-        if folder.stem in ('backup',):
+        if folder.stem in ('backup',) or not has_led_table(folder):
             continue
         snaps.append(DataContainer(folder))
         if optimize:
@@ -1,4 +1,4 @@
-from math import cos, sin, pi
+from math import pi
 import numpy as np
 from pandas import concat
 import plotly.express as px
@@ -9,35 +9,21 @@ from config import storage
 from model.snap import RawSnapData
 from caculations import all_intersection
 from model.triangulation import triangulate
+from model.angle_matrix import AngleMatrix
+from model.positions import PositionTable
+from model.transformations import rotate, rotation_matrix
 
 
-def rotation_matrix(phi) -> np.array:
-    return np.array([[cos(phi), -sin(phi), 0],
-                     [sin(phi), cos(phi), 0],
-                     [0, 0, 1]])
-
-
-def plot_led_3d(led_dict, color, angle):
-    x = []
-    y = []
-    z = []
-    text = []
-    col = []
-    for key, value in led_dict.items():
-        pos = np.inner(value, rotation_matrix(angle))
-        text.append(key)
-        x.append(pos[0])
-        y.append(pos[1])
-        z.append(pos[2])
-        col.append(color)
+def plot_led_3d(leds: PositionTable, color, angle):
+    pos = rotate(leds.coord[leds.valid], -angle)
 
     fig.add_trace(go.Scatter3d(
-        x=x,
-        y=y,
-        z=z,
+        x=pos[:, 0],
+        y=pos[:, 1],
+        z=pos[:, 2],
         mode="markers+text",
         name=f"{angle}",
-        text=text,
+        text=leds.ids,
         marker=dict(color=color),
         textposition="bottom center"
     ))
@@ -45,26 +31,25 @@ def plot_led_3d(led_dict, color, angle):
 
 if __name__ == "__main__":
 
-    block = {'f0': RawSnapData(storage / 'fiets_0_white'),
-             'f45': RawSnapData(storage / 'fiets_45'),
-             'f90': RawSnapData(storage / 'fiets_90_white'),
-             'f240': RawSnapData(storage / 'fiets_240_white'),
-             'f240_b': RawSnapData(storage / 'fiets_240_blue_1'),
-             'f270': RawSnapData(storage / 'fiets_270_white_floor')}
+    folders = [storage / name for name in ('fiets_0_white', 'fiets_45', 'fiets_90_white', 'fiets_240_white',
+                                           'fiets_240_blue_1', 'fiets_270_white_floor')]
+    matrix = AngleMatrix(folders)
+    block = {name: RawSnapData(storage / name) for name in matrix.best_triples()[0]}
+    c1, c2, c3 = block.values()
 
-    angles = triangulate(block['f0'], block['f45'], block['f240'])
+    angles = triangulate(c1, c2, c3, matrix)
     print(angles[0] / pi)
     print(angles[1] / pi)
     print(angles[2] / pi)
     print(sum(angles) / pi)
 
-    l1 = all_intersection(block['f0'], block['f45'], angles[0])
-    l2 = all_intersection(block['f45'], block['f240'], angles[1])
-    l3 = all_intersection(block['f0'], block['f240'], angles[2])
+    l1 = all_intersection(c1, c2, angles[0])
+    l2 = all_intersection(c2, c3, angles[1])
+    l3 = all_intersection(c1, c3, angles[2])
 
-    df = concat([block['f0'].dataframe,
-                 block['f45'].dataframe.dot(rotation_matrix(angles[0])),
-                 block['f240'].dataframe.dot(rotation_matrix(angles[2]))
+    df = concat([c1.dataframe,
+                 c2.dataframe.dot(rotation_matrix(angles[0])),
+                 c3.dataframe.dot(rotation_matrix(angles[2]))
                  ])
 
     fig = px.scatter_3d(df, x=0, y=1, z=2)
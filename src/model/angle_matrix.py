@@ -0,0 +1,154 @@
+"""
+Pairwise camera angle estimates between all snap series.
+
+Estimating the angle between 2 cameras is the slow step of the triangulation.
+The AngleMatrix estimates every pair once, spread over a process pool, and caches the result on disk.
+The cache is keyed on the detected leds of both series, so a pair is only recalculated
+when the led detection of one of the series changed.
+"""
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import combinations
+from math import pi
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config import storage
+from model.led_table import has_led_table, table_hash
+from model.snap import RawSnapData
+from caculations import AngleEstimate, estimate_angle
+
+ANGLE_CACHE = storage / 'angle_cache.json'
+
+
+@lru_cache(maxsize=None)
+def load_series(folder: Path) -> RawSnapData:
+    """
+    Load a snap series once per process
+    """
+    return RawSnapData(folder)
+
+
+def estimate_pair(folder1: Path, folder2: Path) -> Tuple[Path, Path, AngleEstimate]:
+    return folder1, folder2, estimate_angle(load_series(folder1), load_series(folder2))
+
+
+class AngleMatrix:
+    """
+    Angle estimates between all pairs of a list of snap series.
+    best[i, j] is the most likely angle series j makes with series i, second[i, j] the second most likely angle.
+    """
+    def __init__(self, folders: List[Path], workers: Optional[int] = None, cache_file: Path = ANGLE_CACHE):
+        """
+        :param folders: Snap series folders, each containing detected leds
+        :param workers: Number of processes. If None, the number of cpu cores is used.
+        :param cache_file: File to store the estimates. None disables the cache.
+        """
+        self.folders = folders
+        self.names = [folder.name for folder in folders]
+        self.cache_file = cache_file
+        self.hashes = [table_hash(folder) for folder in folders]
+
+        size = len(folders)
+        self.best = np.zeros((size, size))
+        self.second = np.zeros((size, size))
+        self.confidence = np.ones((size, size))
+        self.width = np.zeros((size, size))
+
+        self.calculate(workers)
+
+    def _read_cache(self) -> Dict[str, List[float]]:
+        if self.cache_file is None:
+            return {}
+        try:
+            return json.loads(self.cache_file.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_cache(self, cache: Dict[str, List[float]]):
+        if self.cache_file is not None:
+            self.cache_file.write_text(json.dumps(cache))
+
+    def _set(self, i: int, j: int, estimate: AngleEstimate):
+        """
+        Store the estimate of i -> j. The angle j -> i is the same estimate mirrored.
+        """
+        self.best[i, j], self.second[i, j], self.confidence[i, j], self.width[i, j] = estimate
+        self.best[j, i], self.second[j, i] = -estimate.best, -estimate.second
+        self.confidence[j, i], self.width[j, i] = estimate.confidence, estimate.width
+
+    def calculate(self, workers: Optional[int] = None):
+        """
+        Fill the matrix from the cache and estimate all missing pairs in a process pool.
+        Only pairs i < j are estimated, as estimate_angle(j, i) mirrors estimate_angle(i, j).
+        """
+        cache = self._read_cache()
+        index = {folder: i for i, folder in enumerate(self.folders)}
+
+        missing = []
+        for i, j in combinations(range(len(self.folders)), 2):
+            key = f"{self.hashes[i]}:{self.hashes[j]}"
+            if key in cache:
+                self._set(i, j, AngleEstimate(*cache[key]))
+            else:
+                missing.append((i, j))
+
+        if not missing:
+            return
+
+        start = time.time()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(estimate_pair, self.folders[i], self.folders[j]) for i, j in missing]
+            for future in as_completed(futures):
+                folder1, folder2, estimate = future.result()
+                i, j = index[folder1], index[folder2]
+                self._set(i, j, estimate)
+                cache[f"{self.hashes[i]}:{self.hashes[j]}"] = list(estimate)
+        print(f"Estimated {len(missing)} camera pairs in {time.time() - start:.1f} seconds")
+
+        self._write_cache(cache)
+
+    def estimate(self, name1: str, name2: str) -> AngleEstimate:
+        """
+        :return: Angle estimate of series name2 relative to series name1
+        """
+        i, j = self.names.index(name1), self.names.index(name2)
+        return AngleEstimate(self.best[i, j], self.second[i, j], self.confidence[i, j], self.width[i, j])
+
+    def closure_error(self, i: int, j: int, k: int) -> float:
+        """
+        Going round i -> j -> k -> i should add up to a full rotation.
+        The error is the smallest deviation over all combinations of best and second angle.
+        """
+        angles = np.array([[self.best[i, j], self.second[i, j]],
+                           [self.best[j, k], self.second[j, k]],
+                           [self.best[k, i], self.second[k, i]]])
+        total = angles[0][:, None, None] + angles[1][None, :, None] + angles[2][None, None, :]
+        return float(np.min(np.abs((total + pi) % (2 * pi) - pi)))
+
+    def triple_error(self, i: int, j: int, k: int) -> float:
+        """
+        Measure of how badly conditioned the triple i, j, k is: the closure error plus the
+        uncertainty of each angle (half the width of its peak). Lower is better.
+        """
+        widths = np.array([self.width[i, j], self.width[j, k], self.width[k, i]])
+        return self.closure_error(i, j, k) + float(np.sqrt(np.sum((widths / 2) ** 2)))
+
+    def best_triples(self, count: int = 1) -> List[Tuple[str, str, str]]:
+        """
+        :return: The count best conditioned triples of series names
+        """
+        triples = sorted(combinations(range(len(self.folders)), 3), key=lambda t: self.triple_error(*t))
+        return [tuple(self.names[i] for i in triple) for triple in triples[:count]]
+
+
+if __name__ == "__main__":
+    folders = [folder for folder in storage.glob('*') if 'backup' not in folder.parts and has_led_table(folder)]
+    matrix = AngleMatrix(folders)
+    print(np.round(np.degrees(matrix.best)).astype(int))
+    for triple in matrix.best_triples(5):
+        print(triple)
@@ -1,56 +1,99 @@
 import json
-from typing import List
-from numpy import mean
+
+import numpy as np
 
 from config import storage
 
+# Worst possible score. Bounded to the int32 range, older detections used the int64 maximum.
+WORST_SCORE = np.iinfo(np.int32).max
 
-class BitInfo:
-    _led_keys = {}  # Translation between real led id and random assigned numbers.
 
-    def __init__(self, data: List, series_name):
+class BitTable:
+    def __init__(self, data: np.ndarray, series_name):
         """
-        BitInfo takes a list of values a single pixel during a series of led detection images.
-        The values are converted to a bit string and number. These can be used to Identify the led the pixel belongs to.
-        :param data: list of pixel values
+        BitTable takes the values of many pixels (or cluster centers) during a series of led detection images.
+        Each row is converted to a bit number, score and led key at once, without a string round-trip per row.
+        :param data: 2D array, a row of pixel values for each pixel
+        :param series_name: Name of the snap series, used to look up the led keys
         """
-        self.data = data
+        self.data = np.atleast_2d(np.asarray(data, dtype=float))
         self.series_name = series_name
-        self._average = 0
-        self._bistring = ''
-        self._score = 0
+
+        self.average = self.data.mean(axis=1)
+        # A bit is high if the value is not below the average. The first value is the most significant bit.
+        self.bits = self.data >= self.average[:, None]
+        weights = 1 << np.arange(self.data.shape[1] - 1, -1, -1)
+        self.bit_number = self.bits.astype(int) @ weights
+
+        self.score = self.calc_score()
+        self.led_key = self.lookup_table()[self.bit_number]
+
+    def __len__(self):
+        return len(self.data)
+
+    def calc_score(self) -> np.ndarray:
+        """
+        Score how well each row follows a clean on / off pattern. Lower is better.
+        Rows without values both above and below the average get WORST_SCORE, other scores are clipped to it.
+        """
+        big = self.data > self.average[:, None]
+        small = self.data < self.average[:, None]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_big = (self.data * big).sum(axis=1) / big.sum(axis=1)
+            mean_small = (self.data * small).sum(axis=1) / small.sum(axis=1)
+            var_big = (((self.data - mean_big[:, None]) ** 2) * big).sum(axis=1)
+            var_small = (((self.data - mean_small[:, None]) ** 2) * small).sum(axis=1)
+            score = var_big + var_small / (mean_big - mean_small)
+
+        valid = np.isfinite(score)
+        result = np.full(len(score), WORST_SCORE, dtype=np.int64)
+        result[valid] = np.minimum(score[valid], WORST_SCORE).astype(np.int64)
+        return result
+
+    def lookup_table(self) -> np.ndarray:
+        """
+        Array translating a bit number to the real led id. Bit numbers not assigned to a led translate to -1.
+        """
+        with (storage / self.series_name / 'numbers.txt').open('r') as file:
+            numbers = json.loads(file.readline())
+        table = np.full(2 ** self.data.shape[1], -1, dtype=int)
+        for number, led in numbers.items():
+            table[int(number)] = led
+        return table
+
+
+class BitInfo:
+    def __init__(self, table: BitTable, index: int):
+        """
+        BitInfo is a view on a single row of a BitTable: the values of a single pixel during a series of led detection
+        images. The values are converted to a bit string and number. These can be used to Identify the led the pixel
+        belongs to.
+        :param table: BitTable holding the row
+        :param index: row in the table
+        """
+        self.table = table
+        self.index = index
+
+    @property
+    def data(self) -> np.ndarray:
+        return self.table.data[self.index]
 
     @property
     def average(self) -> float:
-        if not self._average:
-            self._average = mean(self.data)
-        return self._average
+        return self.table.average[self.index]
 
     @property
     def bit_string(self) -> str:
-        if not self._bistring:
-            self._bistring = "".join(['0' if e < self.average else '1' for e in self.data])
-        return self._bistring
+        return "".join(['1' if bit else '0' for bit in self.table.bits[self.index]])
 
     @property
     def bit_number(self) -> int:
-        return int(self.bit_string, 2)
+        return int(self.table.bit_number[self.index])
 
     @property
     def score(self) -> int:
-        if not self._score:
-            big = [e for e in self.data if e > self.average]
-            small = [e for e in self.data if e < self.average]
-            self._score = int(sum((big - mean(big))**2) + sum((small - mean(small))**2)/(mean(big) - mean(small)))
-            # self._score = int(sum((big - mean(big))**2) + sum((small - mean(small))**2))
-        return self._score
+        return int(self.table.score[self.index])
 
     @property
     def led_key(self) -> int:
-        if not self._led_keys:
-            with (storage / self.series_name / 'numbers.txt').open('r') as file:
-                self._led_keys = json.loads(file.readline())
-        try:
-            return self._led_keys[str(self.bit_number)]
-        except KeyError:
-            return -1
+        return int(self.table.led_key[self.index])
@@ -0,0 +1,248 @@
+"""
+Joint estimation of all camera positions and all led positions.
+
+Every camera looks at the origin of the tree from distance d, rotated phi around the z axis.
+A led at p is seen in the image of the camera at:
+    local = rotation_matrix(phi) . p
+    pixel y = origin_x + alfa * IMAGE[0] / LENS_ANGLE[0], alfa = atan2(local y, d - local x)
+    pixel x = origin_y - theta * IMAGE[1] / LENS_ANGLE[1], theta = atan2(local z, d - local x)
+This is the model used by RawSnapData.pixel_phi / pixel_theta and the intersections in caculations.
+
+The bundle adjustment minimizes the pixel error of all snapped leds in all cameras at once.
+Each residual only depends on 1 camera and 1 led, so the jacobian is very sparse.
+The first camera is the frame of reference: its position is not optimized.
+"""
+import time
+from typing import List, Optional
+
+import numpy as np
+from scipy.optimize import least_squares
+from scipy.sparse import coo_matrix, csr_matrix
+
+from config import IMAGE, LENS_ANGLE, storage
+from model.angle_matrix import AngleMatrix
+from model.led_table import has_led_table
+from model.positions import PositionTable, pixel_positions
+from model.snap import RawSnapData
+
+# Camera parameters: distance, phi, origin x pixel, origin y pixel
+NUM_CAMERA_PARAMS = 4
+
+
+class BundleAdjustment:
+    def __init__(self, cameras: List[RawSnapData], reliable=True):
+        """
+        :param cameras: All camera series. The first camera is the frame of reference.
+                        The camera positions (coord, phi_estimate, origin) are used as initial estimate.
+        :param reliable: Only use leds marked reliable
+        """
+        self.cameras = cameras
+
+        camera, led, x, y = [], [], [], []
+        for index, cam in enumerate(cameras):
+            use = cam.arrays.reliable | (not reliable)
+            camera.append(np.full(np.count_nonzero(use), index))
+            led.append(cam.arrays.ids[use])
+            x.append(cam.arrays.x[use])
+            y.append(cam.arrays.y[use])
+
+        # One entry per observation of a led in a camera
+        self.camera = np.concatenate(camera)
+        self.led_ids, self.led = np.unique(np.concatenate(led), return_inverse=True)
+        self.observed = np.stack([np.concatenate(y), np.concatenate(x)], axis=1)
+
+        self.camera_params = np.array([[cam.camera_pos.x, cam.camera_pos.phi_estimate, *cam.camera_pos.origin]
+                                       for cam in cameras], dtype=float)
+        self.points: Optional[np.ndarray] = None
+        self._index = self._jac_index()
+
+    @property
+    def num_leds(self) -> int:
+        return len(self.led_ids)
+
+    def project(self, camera_params: np.ndarray, points: np.ndarray) -> np.ndarray:
+        """
+        :param camera_params: (C, 4) distance, phi, origin_x, origin_y of all cameras
+        :param points: (L, 3) led positions
+        :return: (O, 2) pixel y, pixel x of each observation
+        """
+        d, phi, origin_x, origin_y = camera_params[self.camera].T
+        p = points[self.led]
+        cos, sin = np.cos(phi), np.sin(phi)
+        depth = d - (p[:, 0] * cos - p[:, 1] * sin)
+        alfa = np.arctan2(p[:, 0] * sin + p[:, 1] * cos, depth)
+        theta = np.arctan2(p[:, 2], depth)
+        return np.stack([origin_x + np.degrees(alfa) * IMAGE[0] / LENS_ANGLE[0],
+                         origin_y - np.degrees(theta) * IMAGE[1] / LENS_ANGLE[1]], axis=1)
+
+    def initial_points(self, camera_params: np.ndarray) -> np.ndarray:
+        """
+        Linear triangulation of all leds from the initial camera positions.
+        The xy position is the least squares intersection of the lines from all cameras through the led,
+        z is the average of the height the cameras see the led at.
+        """
+        d, phi, origin_x, origin_y = camera_params[self.camera].T
+        alfa = np.radians((self.observed[:, 0] - origin_x) * LENS_ANGLE[0] / IMAGE[0])
+        theta = np.radians((origin_y - self.observed[:, 1]) * LENS_ANGLE[1] / IMAGE[1])
+
+        # Line through camera position c with normal n: n . p = n . c
+        normal = np.stack([np.sin(alfa + phi), np.cos(alfa + phi)], axis=1)
+        position = np.stack([d * np.cos(phi), -d * np.sin(phi)], axis=1)
+        offset = np.sum(normal * position, axis=1)
+
+        a = np.zeros((self.num_leds, 2, 2))
+        b = np.zeros((self.num_leds, 2))
+        np.add.at(a, self.led, normal[:, :, None] * normal[:, None, :])
+        np.add.at(b, self.led, normal * offset[:, None])
+
+        points = np.zeros((self.num_leds, 3))
+        solvable = np.abs(np.linalg.det(a)) > 1e-9
+        points[solvable, :2] = np.linalg.solve(a[solvable], b[solvable][:, :, None])[:, :, 0]
+
+        p = points[self.led]
+        depth = d - (p[:, 0] * np.cos(phi) - p[:, 1] * np.sin(phi))
+        z = np.zeros(self.num_leds)
+        np.add.at(z, self.led, np.tan(theta) * depth)
+        points[:, 2] = z / np.bincount(self.led, minlength=self.num_leds)
+        return points
+
+    def _split(self, params: np.ndarray):
+        camera_params = self.camera_params.copy()
+        camera_params[1:] = params[:(len(self.cameras) - 1) * NUM_CAMERA_PARAMS].reshape(-1, NUM_CAMERA_PARAMS)
+        points = params[(len(self.cameras) - 1) * NUM_CAMERA_PARAMS:].reshape(-1, 3)
+        return camera_params, points
+
+    def residuals(self, params: np.ndarray) -> np.ndarray:
+        camera_params, points = self._split(params)
+        return (self.project(camera_params, points) - self.observed).ravel()
+
+    def _jac_index(self):
+        """
+        Row and column of all non zero elements of the jacobian.
+        Each observation gives 2 residuals, depending on the 4 parameters of its camera and the 3 of its led.
+        The first camera is fixed and has no columns.
+        """
+        observation = np.arange(len(self.camera))
+        moving = self.camera > 0
+        camera_col = (self.camera[moving] - 1) * NUM_CAMERA_PARAMS
+        led_col = (len(self.cameras) - 1) * NUM_CAMERA_PARAMS + 3 * self.led
+
+        rows, cols = [], []
+        for residual in range(2):
+            for k in range(NUM_CAMERA_PARAMS):
+                rows.append(2 * observation[moving] + residual)
+                cols.append(camera_col + k)
+            for k in range(3):
+                rows.append(2 * observation + residual)
+                cols.append(led_col + k)
+        return np.concatenate(rows), np.concatenate(cols)
+
+    @property
+    def _shape(self):
+        return 2 * len(self.camera), (len(self.cameras) - 1) * NUM_CAMERA_PARAMS + 3 * self.num_leds
+
+    def jacobian(self, params: np.ndarray) -> csr_matrix:
+        """
+        Analytic jacobian of the residuals, in the order of _jac_index
+        """
+        camera_params, points = self._split(params)
+        d, phi, _, _ = camera_params[self.camera].T
+        p = points[self.led]
+        cos, sin = np.cos(phi), np.sin(phi)
+        local_x = p[:, 0] * cos - p[:, 1] * sin
+        local_y = p[:, 0] * sin + p[:, 1] * cos
+        depth = d - local_x
+
+        # Derivatives of alfa to local y and depth, of theta to z and depth
+        alfa_y = depth / (local_y ** 2 + depth ** 2)
+        alfa_depth = -local_y / (local_y ** 2 + depth ** 2)
+        theta_z = depth / (p[:, 2] ** 2 + depth ** 2)
+        theta_depth = -p[:, 2] / (p[:, 2] ** 2 + depth ** 2)
+
+        scale_u = np.degrees(1) * IMAGE[0] / LENS_ANGLE[0]
+        scale_v = -np.degrees(1) * IMAGE[1] / LENS_ANGLE[1]
+        ones, zeros = np.ones(len(d)), np.zeros(len(d))
+        moving = self.camera > 0
+
+        u = [scale_u * alfa_depth, scale_u * (alfa_y * local_x + alfa_depth * local_y), ones, zeros]
+        v = [scale_v * theta_depth, scale_v * theta_depth * local_y, zeros, ones]
+        u_led = [scale_u * (alfa_y * sin - alfa_depth * cos), scale_u * (alfa_y * cos + alfa_depth * sin), zeros]
+        v_led = [-scale_v * theta_depth * cos, scale_v * theta_depth * sin, scale_v * theta_z]
+
+        values = np.concatenate([k[moving] for k in u] + u_led + [k[moving] for k in v] + v_led)
+        return csr_matrix((values, self._index), shape=self._shape)
+
+    def jac_sparsity(self) -> coo_matrix:
+        return coo_matrix((np.ones(len(self._index[0]), dtype=int), self._index), shape=self._shape)
+
+    def solve(self, points: Optional[np.ndarray] = None, loss='soft_l1', f_scale=5.0, ftol=1e-6, verbose=0, **kwargs):
+        """
+        Optimize all camera positions and led positions.
+        :param points: (L, 3) initial led positions in order of led_ids. If None, the leds are triangulated.
+        :param loss: Loss function of least_squares. The robust default limits the effect of wrongly detected leds.
+        :param f_scale: Pixel error at which the robust loss starts
+        :param ftol: Relative change of the cost to stop at
+        :param kwargs: Passed on to least_squares
+        :return: Result of least_squares
+        """
+        if points is None:
+            points = self.initial_points(self.camera_params)
+        params = np.concatenate([self.camera_params[1:].ravel(), points.ravel()])
+
+        start = time.time()
+        result = least_squares(self.residuals, params, jac=self.jacobian, x_scale='jac', method='trf', tr_solver='lsmr',
+                               loss=loss, f_scale=f_scale, ftol=ftol, verbose=verbose, **kwargs)
+        self.camera_params, self.points = self._split(result.x)
+        if verbose:
+            print(f"Bundle adjustment of {len(self.cameras)} cameras and {self.num_leds} leds "
+                  f"in {time.time() - start:.1f} seconds")
+        return result
+
+    def pixel_error(self) -> np.ndarray:
+        """
+        :return: (O) pixel distance between the snapped and the projected position of each observation
+        """
+        return np.linalg.norm(self.project(self.camera_params, self.points) - self.observed, axis=1)
+
+    def update_cameras(self):
+        """
+        Store the optimized camera positions in the cameras
+        """
+        for cam, (d, phi, origin_x, origin_y) in zip(self.cameras, self.camera_params):
+            cam.camera_pos.coord = [d, 0, 0]
+            cam.camera_pos.phi_estimate = phi
+            cam.camera_pos.origin = (origin_x, origin_y)
+
+    def positions(self) -> PositionTable:
+        return PositionTable.from_arrays(self.led_ids, self.points)
+
+
+def bundle_adjust(cameras: List[RawSnapData], positions: Optional[PositionTable] = None,
+                  verbose=0) -> PositionTable:
+    """
+    Optimize all cameras and leds together. The cameras are updated with the optimized position.
+    :param cameras: All camera series, with an initial estimate of phi (e.g. from the AngleMatrix)
+    :param positions: Initial led positions. Leds without a position are triangulated.
+    :return: Optimized led positions, in the frame of reference of the first camera
+    """
+    adjustment = BundleAdjustment(cameras)
+    points = adjustment.initial_points(adjustment.camera_params)
+    if positions is not None:
+        known = positions.resized(adjustment.led_ids.max() + 1).valid[adjustment.led_ids]
+        points[known] = positions.coord[adjustment.led_ids[known]]
+    adjustment.solve(points, verbose=verbose)
+    adjustment.update_cameras()
+    return adjustment.positions()
+
+
+if __name__ == "__main__":
+    folders = [folder for folder in storage.glob('*') if 'backup' not in folder.parts and has_led_table(folder)]
+    matrix = AngleMatrix(folders)
+    cameras = [RawSnapData(folder) for folder in folders]
+    for index, cam in enumerate(cameras):
+        cam.camera_pos.phi_estimate = matrix.best[0, index]
+
+    pixel_positions.push(bundle_adjust(cameras, verbose=1))
+    for cam in cameras:
+        print(f"{cam.name}: distance {cam.camera_pos.x:.2f}, phi {np.degrees(cam.camera_pos.phi_estimate):.1f}, "
+              f"origin {cam.camera_pos.origin[0]:.0f} {cam.camera_pos.origin[1]:.0f}")
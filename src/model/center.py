@@ -0,0 +1,45 @@
+"""
+Estimation of the center of a set of values, e.g. the pixel column of the tree center in a snap.
+
+The mean minimizes the sum of squared distances, but a few wrongly detected leds can move it far.
+The median and the trimmed mean are robust against these outliers.
+"""
+from typing import NamedTuple
+
+import numpy as np
+
+CENTER_METHODS = ('mean', 'median', 'trimmed')
+
+
+class CenterEstimate(NamedTuple):
+    center: float
+    spread: float  # Standard deviation, or a robust estimate of it for median and trimmed
+
+
+def estimate_center(values: np.ndarray, method='mean', trim=0.1) -> CenterEstimate:
+    """
+    Estimate the center and the spread of values.
+    :param values: Array of values
+    :param method: 'mean', 'median' (spread from the median absolute deviation) or
+                   'trimmed' (mean and standard deviation without the trim fraction of lowest and highest values)
+    :param trim: Fraction of values cut off at both ends for the trimmed mean
+    :return: CenterEstimate
+    """
+    values = np.asarray(values, dtype=float)
+    if values.size == 0:
+        raise ValueError('No values to estimate a center for')
+
+    if method == 'mean':
+        return CenterEstimate(float(values.mean()), float(values.std()))
+
+    if method == 'median':
+        center = np.median(values)
+        # Scale the median absolute deviation to the standard deviation of a normal distribution
+        return CenterEstimate(float(center), float(1.4826 * np.median(np.abs(values - center))))
+
+    if method == 'trimmed':
+        cut = int(trim * values.size)
+        kept = np.sort(values)[cut:values.size - cut]
+        return CenterEstimate(float(kept.mean()), float(kept.std()))
+
+    raise ValueError(f'Center method "{method}" not supported, use one of {CENTER_METHODS}')
@@ -1,68 +1,139 @@
-from typing import Generator, List, Tuple
+from typing import Dict, Generator, List, Optional, Tuple
 import numpy as np
 
+from model.led_table import led_bits
+
+
+class CandidateTable:
+    def __init__(self, led_id: np.ndarray, x: np.ndarray, y: np.ndarray, score: np.ndarray, bit: np.ndarray):
+        """
+        All possible locations (candidates) of all leds of a snap series in flat columns.
+        The rows are grouped per led, in order of led id. Within a led the candidates keep their original order,
+        candidate i of a led is row start + i of its group.
+        :param led_id: (N) Address id of the led of each candidate
+        :param x: (N) x pixel of each candidate
+        :param y: (N) y pixel of each candidate
+        :param score: (N) How close the led followed the bit pattern at the candidate. Lower is better.
+        :param bit: (N) Binary string used to blink the led
+        """
+        order = np.argsort(led_id, kind='stable')
+        self.led_id = np.asarray(led_id, dtype=int)[order]
+        self.x = np.asarray(x, dtype=int)[order]
+        self.y = np.asarray(y, dtype=int)[order]
+        self.score = np.asarray(score)[order]
+        self.center_distance = np.ones(len(order))  # How close is the candidate to the center of the tree
+        self.incorrect = np.zeros(len(order), dtype=bool)  # Candidate marked as incorrect
+        self.in_string = np.zeros(len(order), dtype=bool)  # Candidate considered to be in a string
+
+        # Group by led: ids[g] has candidates start[g] up to start[g] + count[g]
+        self.ids, self.start, self.count = np.unique(self.led_id, return_index=True, return_counts=True)
+        self.group = np.repeat(np.arange(len(self.ids)), self.count)
+        self.bit = np.asarray(bit)[order][self.start]
+        self._best: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_table(cls, table: Dict[str, np.ndarray]) -> 'CandidateTable':
+        """
+        :param table: Detected leds of a series, see model.led_table.read_led_table
+        """
+        return cls(table['led'], table['x'], table['y'], table['score'], led_bits(table))
+
+    def __len__(self):
+        return len(self.led_id)
+
+    def group_of(self, led_id: int) -> int:
+        group = int(np.searchsorted(self.ids, led_id))
+        if group == len(self.ids) or self.ids[group] != led_id:
+            raise KeyError(led_id)
+        return group
+
+    def _resolve(self, group: int) -> int:
+        """
+        Best candidate row of 1 led. See best_rows.
+        """
+        rows = slice(self.start[group], self.start[group] + self.count[group])
+        in_string = np.flatnonzero(self.in_string[rows])
+        if len(in_string) > 1:
+            raise RuntimeError('Only 1 id is expected in in_string')
+        if len(in_string):
+            return int(self.start[group] + in_string[0])
+        key = np.where(self.incorrect[rows], np.inf, self.score[rows])
+        return int(self.start[group] + np.argmin(key))
+
+    @property
+    def best_rows(self) -> np.ndarray:
+        """
+        Row of the most likely location of each led, in order of ids.
+        A candidate in a string is the best match. Otherwise the candidate with the lowest score that is not
+        marked incorrect; the first candidate if all are incorrect. Ties go to the first candidate.
+        """
+        if self._best is None:
+            if np.any(np.bincount(self.group, weights=self.in_string, minlength=len(self.ids)) > 1):
+                raise RuntimeError('Only 1 id is expected in in_string')
+            key = np.where(self.incorrect, np.inf, self.score)
+            order = np.lexsort((np.arange(len(self)), key, self.group))
+            best = order[self.start]
+            in_string = np.flatnonzero(self.in_string)
+            best[self.group[in_string]] = in_string
+            self._best = best
+        return self._best
+
+    def _changed(self, group: int):
+        if self._best is not None:
+            self._best[group] = self._resolve(group)
+
+    def mark_incorrect(self, group: int, coord_id: int):
+        self.incorrect[self.start[group] + coord_id] = True
+        self._changed(group)
+
+    def mark_in_string(self, group: int, coord_id: int):
+        self.in_string[self.start[group] + coord_id] = True
+        self._changed(group)
+
+    def calculate_center_distance(self, m: float, c: float):
+        """
+        Calculate the distance of every candidate to the center line
+        dist = abs(Y - mX +c)
+        """
+        self.center_distance = np.abs(self.y - m * self.x + c)
+
+    @property
+    def active(self) -> np.ndarray:
+        """
+        (L) A led is active if not all its candidates are marked incorrect
+        """
+        return np.bincount(self.group, weights=self.incorrect, minlength=len(self.ids)) < self.count
+
 
 class LedInfo:
-    def __init__(self, x: int, y: int, led: int, bit: str, score: int, **kwargs):
+    def __init__(self, table: CandidateTable, led_id: int):
         """
         A LedInfo contains 1 or multiple positions where the led is positioned.
         In case of multiple locations, each location gets a verification score.
         The positions with the highest score is considered to be the real location of the led.
-        :param x:
-        :param y:
-        :param led:
-        :param bit:
-        :param score:
-        :param kwargs:
-        """
-        self._x = [x]
-        self._y = [y]
-        self.led_id = led  # Address id of the led.
-        self.bit = bit  # Binary string used to blink the led
-        self._score = np.array(score)  # How close the led Followed the bit pattern in the images. Lower is better.
-        self._center_distance = np.array(1)  # How close is the led to the center of the tree
-        self._best_match = None
-        self._all_coord = []
-        self._incorrect = []  # List if indexes of coordinates marked as incorrect
-        self.in_string = []  # List of index id of coordinate considered  to be in string.
-
-    def add_location(self, x: int, y: int, score: int, **kwargs):
-        self._x.append(x)
-        self._y.append(y)
-        self._score = np.append(self._score, score)
-        self._center_distance = np.append(self._center_distance, 1)
-        self._best_match = None
-        self._all_coord = []
+        The LedInfo is a view on the rows of the led in a CandidateTable.
+        :param table: Candidates of all leds
+        :param led_id: Address id of the led
+        """
+        self.table = table
+        self.led_id = led_id  # Address id of the led.
+        self._group = table.group_of(led_id)
+        self._rows = slice(table.start[self._group], table.start[self._group] + table.count[self._group])
 
     @property
-    def best_match(self) -> int:
+    def bit(self) -> str:
         """
-        Calculate the most likely location of the led based on information of all possible led locations in the data.
-        :return:
+        Binary string used to blink the led
         """
-        if len(self.in_string) > 1:
-            raise RuntimeError('Only 1 id is expected in self.in_string')
-        try:
-            return self.in_string[0]
-        except IndexError:
-            pass
+        return str(self.table.bit[self._group])
 
-        if not self._best_match:
-            if self._score.size == 1:
-                self._best_match = 0
-            else:
-                min = None
-                for i in range(len(self._score)):
-                    if i not in self._incorrect:
-                        if not min or self._score[i] < min:
-                            min = self._score[i]
-
-                # scores = self._score/np.max(self._score) * self._center_distance/np.max(self._center_distance)
-                if min:
-                    self._best_match = np.where(self._score == min)[0][0]
-                else:
-                    self._best_match = 0
-        return self._best_match
+    @property
+    def best_match(self) -> int:
+        """
+        Most likely location of the led based on information of all possible led locations in the data.
+        :return: Index of the location
+        """
+        return int(self.table.best_rows[self._group] - self._rows.start)
 
     @property
     def active(self):
@@ -70,15 +141,15 @@ class LedInfo:
         A led is active if not all coordinates are marked invalid
         :return:
         """
-        return bool(len(self._incorrect) < len(self.all_coord))
+        return not np.all(self.table.incorrect[self._rows])
 
     @property
     def x(self):
-        return self._x[self.best_match]
+        return int(self.table.x[self.table.best_rows[self._group]])
 
     @property
     def y(self):
-        return self._y[self.best_match]
+        return int(self.table.y[self.table.best_rows[self._group]])
 
     @property
     def coord(self) -> Tuple[int, int]:
@@ -86,7 +157,21 @@ class LedInfo:
 
     @property
     def score(self):
-        return self._score[self.best_match]
+        return self.table.score[self.table.best_rows[self._group]]
+
+    @property
+    def in_string(self) -> List[int]:
+        """
+        :return: List of index id of coordinate considered to be in string.
+        """
+        return np.flatnonzero(self.table.in_string[self._rows]).tolist()
+
+    @property
+    def incorrect(self) -> List[int]:
+        """
+        :return: List of indexes of coordinates marked as incorrect
+        """
+        return np.flatnonzero(self.table.incorrect[self._rows]).tolist()
 
     def calculate_center_distance(self, m, c):
         """
@@ -94,8 +179,7 @@ class LedInfo:
         dist = abs(Y - mX +c)
         :return:
         """
-        self._center_distance = np.array([abs(self._y[i] - m * self._x[i] + c) for i in range(len(self._x))])
-        self._best_match = None
+        self.table.center_distance[self._rows] = np.abs(self.table.y[self._rows] - m * self.table.x[self._rows] + c)
 
     def get_alternative_coord(self):
         """
@@ -105,10 +189,10 @@ class LedInfo:
         return self.all_coord[1:]
 
     def mark_incorrect(self, coord_id: int):
-        if self.led_id == 590:
-            print()
-        self._incorrect.append(coord_id)
-        self._best_match = None
+        self.table.mark_incorrect(self._group, coord_id)
+
+    def mark_in_string(self, coord_id: int):
+        self.table.mark_in_string(self._group, coord_id)
 
     def coord_id_active(self, coord_id) -> bool:
         """
@@ -116,25 +200,24 @@ class LedInfo:
         :param coord_id:
         :return:
         """
-        return coord_id not in self._incorrect
+        return not self.table.incorrect[self._rows.start + coord_id]
 
     @property
     def all_coord(self) -> List[Tuple[int, int]]:
         """
         :return: List of tuples of all possible coord (x, y)
         """
-        if not self._all_coord:
-            self._all_coord = [(self._x[idx], self._y[idx]) for idx in range(len(self._x))]
-        return self._all_coord
+        return list(zip(self.table.x[self._rows].tolist(), self.table.y[self._rows].tolist()))
 
     def get_colored_coord(self) -> Generator[Tuple[Tuple[int, int], str], None, None]:
-        for i in range(len(self.all_coord)):
-            if i in self._incorrect:
-                yield self.all_coord[i], 'purple'
+        incorrect = self.incorrect
+        for i, coord in enumerate(self.all_coord):
+            if i in incorrect:
+                yield coord, 'purple'
             elif i == self.best_match:
-                yield self.all_coord[i], 'green'
+                yield coord, 'green'
             else:
-                yield self.all_coord[i], 'red'
+                yield coord, 'red'
 
     def __str__(self):
         return f"{self.led_id} ({self.x}, {self.y})"
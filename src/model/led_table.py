@@ -0,0 +1,133 @@
+"""
+On disk format of the detected leds of a snap series.
+
+The detected leds are stored as typed columns in data.npz in the series folder:
+    x, y: pixel of the led
+    led: id of the led, -1 if the bit code is not a led
+    random: bit code the led blinked
+    score: how close the pixels followed the bit code. Lower is better. Stored as int64, detections before
+           model.bit_info.WORST_SCORE used the int64 maximum as worst score.
+    num_frames: number of bits of the code
+Reading a series is a single np.load, instead of parsing a JSON row per led.
+
+Series detected before the binary format only have data.txt, a JSON list of rows with the same keys.
+These are read as fallback and can be converted once with convert_all.
+"""
+import hashlib
+import json
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from config import storage, NUM_SNAP_FRAMES
+from detection_cache import LED_COLUMNS
+
+DATA_FILE = 'data.npz'
+JSON_FILE = 'data.txt'
+COLUMN_TYPES = {'x': np.int32, 'y': np.int32, 'led': np.int32, 'random': np.int32, 'score': np.int64}
+
+
+def data_file(folder: Path) -> Optional[Path]:
+    """
+    :return: The file holding the detected leds of the series, the binary file if available. None if not detected.
+    """
+    for name in (DATA_FILE, JSON_FILE):
+        if (folder / name).exists():
+            return folder / name
+    return None
+
+
+def has_led_table(folder: Path) -> bool:
+    return data_file(folder) is not None
+
+
+def read_json_table(file: Path) -> Dict[str, np.ndarray]:
+    """
+    Read the detected leds from a data.txt file.
+    Old files have no random column, the code is then parsed from the bit string.
+    """
+    rows = json.loads(file.read_text())
+    if isinstance(rows, dict):
+        # Workaround for old data files.
+        rows = list(rows.values())
+    bits = [row.get('bit', '') for row in rows]
+    table = {column: np.array([row[column] for row in rows], dtype=COLUMN_TYPES[column])
+             for column in LED_COLUMNS if column != 'random'}
+    table['random'] = np.array([row['random'] if 'random' in row else int(bit or '0', 2)
+                                for row, bit in zip(rows, bits)], dtype=COLUMN_TYPES['random'])
+    table['num_frames'] = np.array(max((len(bit) for bit in bits), default=0) or NUM_SNAP_FRAMES)
+    return table
+
+
+def read_led_table(folder: Path) -> Dict[str, np.ndarray]:
+    """
+    :param folder: Series folder
+    :return: Table with a column for each key in LED_COLUMNS and the number of frames
+    """
+    file = data_file(folder)
+    if file is None:
+        raise FileNotFoundError(f'No detected leds in {folder}')
+    if file.name == JSON_FILE:
+        return read_json_table(file)
+    with np.load(file) as data:
+        return dict(data)
+
+
+def read_all_led_tables(folders: List[Path]) -> Dict[str, Dict[str, np.ndarray]]:
+    """
+    :return: The table of each series with detected leds, by series name
+    """
+    return {folder.name: read_led_table(folder) for folder in folders if has_led_table(folder)}
+
+
+def write_led_table(folder: Path, table: Dict[str, np.ndarray], num_frames: int = NUM_SNAP_FRAMES):
+    """
+    Write a table of detected leds to data.npz in the series folder.
+    """
+    columns = {column: np.asarray(table[column], dtype=COLUMN_TYPES[column]) for column in LED_COLUMNS}
+    np.savez(folder / DATA_FILE, num_frames=np.array(num_frames), **columns)
+
+
+def led_bits(table: Dict[str, np.ndarray]) -> np.ndarray:
+    """
+    :return: The bit code of each led as a string of num_frames bits
+    """
+    num_frames = int(table['num_frames'])
+    return np.array([format(code, f'0{num_frames}b') for code in table['random'].tolist()])
+
+
+def table_hash(folder: Path) -> str:
+    """
+    Hash of the detected leds of a series. Equal for the JSON and the binary file of the same detection.
+    """
+    table = read_led_table(folder)
+    sha = hashlib.sha256()
+    for column in LED_COLUMNS:
+        sha.update(np.ascontiguousarray(table[column], dtype=COLUMN_TYPES[column]).tobytes())
+    return sha.hexdigest()
+
+
+def convert_series(folder: Path, remove_json=False) -> bool:
+    """
+    Convert the data.txt of a series to data.npz.
+    :param remove_json: Remove data.txt after the conversion
+    :return: True if the series is converted
+    """
+    if not (folder / JSON_FILE).exists() or (folder / DATA_FILE).exists():
+        return False
+    table = read_json_table(folder / JSON_FILE)
+    write_led_table(folder, table, int(table['num_frames']))
+    if remove_json:
+        (folder / JSON_FILE).unlink()
+    return True
+
+
+def convert_all(root: Path = storage, remove_json=False):
+    converted = [folder.name for folder in sorted(root.glob('*'))
+                 if folder.is_dir() and convert_series(folder, remove_json)]
+    print(f"Converted {len(converted)} series: {', '.join(converted)}")
+
+
+if __name__ == "__main__":
+    convert_all()
@@ -0,0 +1,97 @@
+"""
+Least squares line fit Y = mX + c that is updated point by point.
+
+The fit only keeps the running sums n, sum x, sum y, sum xx, sum xy and sum yy.
+Adding, removing or moving a point is O(1), the line and its error are calculated from the sums.
+"""
+from math import sqrt
+from typing import Tuple
+
+
+class LineFit:
+    def __init__(self):
+        self.n = 0
+        self.sx = 0.0
+        self.sy = 0.0
+        self.sxx = 0.0
+        self.sxy = 0.0
+        self.syy = 0.0
+
+    def add(self, x: float, y: float):
+        self.n += 1
+        self.sx += x
+        self.sy += y
+        self.sxx += x * x
+        self.sxy += x * y
+        self.syy += y * y
+
+    def remove(self, x: float, y: float):
+        self.n -= 1
+        self.sx -= x
+        self.sy -= y
+        self.sxx -= x * x
+        self.sxy -= x * y
+        self.syy -= y * y
+
+    def swap(self, old: Tuple[float, float], new: Tuple[float, float]):
+        """
+        Move a point from old to new
+        """
+        self.remove(*old)
+        self.add(*new)
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def line(self) -> Tuple[float, float]:
+        """
+        :return: m, c of Y = mX + c.
+                 If all x are equal, the minimum norm solution is returned, like least_squares_fit does.
+        """
+        x_mean, y_mean = self.sx / self.n, self.sy / self.n
+        sxx = self.sxx - self.sx * x_mean
+        if sxx <= 0:
+            return x_mean * y_mean / (x_mean ** 2 + 1), y_mean / (x_mean ** 2 + 1)
+        m = (self.sxy - self.sx * y_mean) / sxx
+        return m, y_mean - m * x_mean
+
+    @property
+    def m(self) -> float:
+        return self.line[0]
+
+    @property
+    def c(self) -> float:
+        return self.line[1]
+
+    def offset(self, m: float) -> Tuple[float, float]:
+        """
+        :return: Mean and standard deviation of Y - mX over all points
+        """
+        mean = (self.sy - m * self.sx) / self.n
+        squared = (self.syy - 2 * m * self.sxy + m * m * self.sxx) / self.n
+        return mean, sqrt(max(squared - mean * mean, 0.0))
+
+    @property
+    def error(self) -> float:
+        """
+        Sum of the squared distances of all points to the line
+        """
+        m, c = self.line
+        # sum (mx + c - y)^2 expanded in the running sums
+        squared = (m * m * self.sxx + self.n * c * c + self.syy
+                   + 2 * m * c * self.sx - 2 * m * self.sxy - 2 * c * self.sy)
+        return max(squared, 0.0) / (m * m + 1)
+
+    @property
+    def min_error(self) -> float:
+        """
+        Sum of the squared distances of all points to the closest possible line (total least squares).
+        This is a lower bound of error, also for every larger set of points containing these points.
+        """
+        if self.n == 0:
+            return 0.0
+        cxx = self.sxx - self.sx * self.sx / self.n
+        cyy = self.syy - self.sy * self.sy / self.n
+        cxy = self.sxy - self.sx * self.sy / self.n
+        return max((cxx + cyy) / 2 - sqrt(((cxx - cyy) / 2) ** 2 + cxy ** 2), 0.0)
@@ -1,9 +1,11 @@
 import numpy as np
-from typing import Dict
+from typing import Dict, Generator, List, Optional, Tuple, Union
 import pandas as pd
 
+from config import NUM_PIXELS
 from model.camera import CameraPosition
 from model.spherical_coordinate import SphereCoord
+from model.transformations import rotate
 
 
 class Pixel(SphereCoord):
@@ -44,33 +46,141 @@ class CameraInfo:
         self.camera_pos = pd.concat(self.camera_pos, df)
 
 
+class PositionTable:
+    """
+    Positions of all leds as arrays. Row i holds the position of led i.
+    Leds without a known position are not valid.
+    """
+    def __init__(self, coord: np.ndarray, valid: Optional[np.ndarray] = None):
+        """
+        :param coord: (N, 3) x, y, z of led 0 .. N-1
+        :param valid: (N) True for leds with a known position. If None, all leds are valid.
+        """
+        self.coord = coord
+        self.valid = np.ones(len(coord), dtype=bool) if valid is None else valid
+
+    @classmethod
+    def from_arrays(cls, ids: np.ndarray, coord: np.ndarray, size=NUM_PIXELS) -> 'PositionTable':
+        """
+        :param ids: (K) led ids
+        :param coord: (K, 3) position of each led in ids
+        :param size: Minimum number of rows. The table grows if ids contains a bigger id.
+        """
+        ids = np.asarray(ids, dtype=int)
+        size = max(size, ids.max() + 1) if len(ids) else size
+        table = cls(np.zeros((size, 3)), np.zeros(size, dtype=bool))
+        table.coord[ids] = coord
+        table.valid[ids] = True
+        return table
+
+    @classmethod
+    def from_dict(cls, data: Dict[int, Pixel], size=NUM_PIXELS) -> 'PositionTable':
+        return cls.from_arrays(np.array(list(data.keys()), dtype=int),
+                               np.array([pixel.coord for pixel in data.values()]).reshape(-1, 3), size)
+
+    @property
+    def ids(self) -> np.ndarray:
+        """
+        Ids of all valid leds
+        """
+        return np.flatnonzero(self.valid)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.valid))
+
+    def __contains__(self, led_id) -> bool:
+        return 0 <= led_id < len(self.valid) and bool(self.valid[led_id])
+
+    def __getitem__(self, led_id) -> Pixel:
+        if led_id not in self:
+            raise KeyError(led_id)
+        return Pixel(led_id, *self.coord[led_id])
+
+    def items(self) -> Generator[Tuple[int, Pixel], None, None]:
+        for led_id in self.ids:
+            yield int(led_id), Pixel(int(led_id), *self.coord[led_id])
+
+    def to_dict(self) -> Dict[int, Pixel]:
+        return dict(self.items())
+
+    def resized(self, size: int) -> 'PositionTable':
+        """
+        Copy of the table with size rows. Added rows are not valid.
+        """
+        table = PositionTable(np.zeros((size, 3)), np.zeros(size, dtype=bool))
+        rows = min(size, len(self.valid))
+        table.coord[:rows] = self.coord[:rows]
+        table.valid[:rows] = self.valid[:rows]
+        return table
+
+    def rotated(self, phi: float) -> 'PositionTable':
+        """
+        Return the same positions in a rotated frame of reference. Rotation takes place in the xy plane.
+        """
+        return PositionTable(rotate(self.coord, phi), self.valid.copy())
+
+    def scale(self):
+        """
+        Scale x and y of all valid leds to values between -1 and 1
+        """
+        scale = np.abs(self.coord[self.valid, :2]).max()
+        print(f"SCALE {scale}")
+        self.coord[:, :2] /= scale
+
+    @staticmethod
+    def average(tables: List['PositionTable']) -> 'PositionTable':
+        """
+        Average position of each led over all tables in which the led is valid
+        """
+        size = max(len(table.valid) for table in tables)
+        tables = [table.resized(size) for table in tables]
+        valid = np.stack([table.valid for table in tables])
+        coord = np.stack([table.coord for table in tables])
+
+        count = valid.sum(axis=0)
+        total = np.where(valid[:, :, None], coord, 0).sum(axis=0)
+        return PositionTable(total / np.maximum(count, 1)[:, None], count > 0)
+
+
 class PixelPositions:
-    def __init__(self):
-        self.iteration = 0
-        self.data: Dict[int, Dict[int, Pixel]] = {}
+    """
+    History of the estimated led positions. Each iteration is a layer in the stacked arrays.
+    """
+    def __init__(self, size=NUM_PIXELS):
+        self.coord = np.zeros((0, size, 3))  # (iteration, led, xyz)
+        self.valid = np.zeros((0, size), dtype=bool)  # (iteration, led)
+
+    @property
+    def iteration(self) -> int:
+        return len(self.coord)
+
+    def push(self, data: Union[PositionTable, Dict[int, Pixel]]):
+        if not isinstance(data, PositionTable):
+            data = PositionTable.from_dict(data)
+
+        size = max(self.coord.shape[1], len(data.valid))
+        if size > self.coord.shape[1]:
+            grow = size - self.coord.shape[1]
+            self.coord = np.pad(self.coord, ((0, 0), (0, grow), (0, 0)))
+            self.valid = np.pad(self.valid, ((0, 0), (0, grow)))
+        data = data.resized(size)
+
+        self.coord = np.concatenate([self.coord, data.coord[None]])
+        self.valid = np.concatenate([self.valid, data.valid[None]])
 
-    def push(self, data: Dict[int, Pixel]):
-        self.data[self.iteration] = data
-        self.iteration += 1
+    def __getitem__(self, iteration) -> PositionTable:
+        """
+        Positions of an iteration. The table is a view: changes to the table change the history.
+        """
+        return PositionTable(self.coord[iteration], self.valid[iteration])
 
-    def latest(self) -> Dict[int, Pixel]:
+    def latest(self) -> PositionTable:
         if self.iteration == 0:
             raise LookupError('No positions are available')
-        return self.data[self.iteration-1]
+        return self[self.iteration - 1]
 
     def scale(self, iteration):
-        all_x = []
-        all_y = []
-        for pixel in pixel_positions.data[iteration].values():
-            all_x.append(abs(pixel.x))
-            all_y.append(abs(pixel.y))
-
-        scale = max(all_x + all_y)
-        print(f"SCALE {scale}")
-
-        for pixel in pixel_positions.data[iteration].values():
-            pixel.x = pixel.x / scale
-            pixel.y = pixel.y / scale
+        self[iteration].scale()
 
 
 pixel_positions = PixelPositions()
@@ -1,14 +1,15 @@
-import json
 from math import radians, sin, sqrt
 from statistics import median
-from typing import Dict, Optional, List, Tuple
+from typing import Dict, NamedTuple, Optional, List, Tuple
 
+import numpy as np
 from pandas import DataFrame
 
 from config import IMAGE, LENS_ANGLE
 from model.camera import CameraPosition
+from model.center import CenterEstimate, estimate_center
+from model.led_table import read_led_table
 from model.positions import pixel_positions
-from model.transformations import rotate_xy, rotate_pixel_dict
 
 
 class SnapLine:
@@ -78,6 +79,36 @@ class SnapLine:
 
 
 
+def neighbour_distance(ids: np.ndarray, x: np.ndarray, y: np.ndarray,
+                       ref_ids: np.ndarray, ref_x: np.ndarray, ref_y: np.ndarray) -> np.ndarray:
+    """
+    Vectorized SnapLine.average_neighbour_dist: the average distance of each led to the leds with id - 1 and id + 1.
+    :param ids, x, y: Leds to calculate the distance for
+    :param ref_ids, ref_x, ref_y: Neighbouring leds, sorted by unique id
+    :return: Average distance for each led. nan if no neighbour is available or all distances are 0.
+    """
+    total = np.zeros(len(ids))
+    count = np.zeros(len(ids))
+    for offset in (-1, 1):
+        index = np.minimum(np.searchsorted(ref_ids, ids + offset), len(ref_ids) - 1)
+        found = ref_ids[index] == ids + offset
+        total += np.where(found, np.hypot(x - ref_x[index], y - ref_y[index]), 0)
+        count += found
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total > 0, total / count, np.nan)
+
+
+class SnapArrays(NamedTuple):
+    """
+    All snap lines of a series as arrays, sorted by led id
+    """
+    ids: np.ndarray
+    x: np.ndarray
+    y: np.ndarray
+    reliable: np.ndarray
+    position: np.ndarray  # Position of each led in snapl, the order of the leds in the data file
+
+
 class RawSnapData:
     """
     RawSnapData data holds all raw information regarding a snap series
@@ -85,43 +116,108 @@ class RawSnapData:
     This Camera position is later refined based on combining data from multiple snaps.
     RawSnapData will produce data based on the last update of the camera position.
     """
+    center_method = 'mean'  # Estimator for the tree center, see model.center.estimate_center
+
     def __init__(self, data_file):
         self.snapl: Dict[int, SnapLine] = {}
         self.name = data_file.name
         self._median: Optional[float] = None
-        self._tree_center: Optional[int] = None
+        self._tree_center: Optional[CenterEstimate] = None
         self._angle_extremes = None
+        self._arrays: Optional[SnapArrays] = None
+        self._angles_origin: Optional[Tuple[float, float]] = None  # Origin used to calculate _phi and _theta
+        self._phi: Optional[np.ndarray] = None
+        self._theta: Optional[np.ndarray] = None
 
-        self.load_data(data_file / 'data.txt')
+        self.load_data(data_file)
         self.mark_reliable()
 
         self.camera_pos = CameraPosition(self.camera_distance_estimation(), 0, 0,
                                          self.name, self.tree_center, IMAGE[1] / 2)
 
-    def load_data(self, file):
-        duplicates = []
-        for led in json.loads(file.read_text()):
-            if led['led'] == -1:
-                continue
-            if led['led'] in self.snapl:
-                duplicates.append(SnapLine(led['x'], led['y'], led['led'], self))
-            else:
-                self.snapl[int(led['led'])] = SnapLine(led['x'], led['y'], led['led'], self)
-
-        for led in duplicates:
-            if led.average_neighbour_dist() and \
-                    led.average_neighbour_dist() < self.snapl[led.id].average_neighbour_dist():
-                self.snapl[led.id] = led
+    def load_data(self, folder):
+        """
+        Load all detected leds. If a led is detected more than once, the detection closest to its neighbours is kept.
+        The neighbours are the first detections of the leds with id - 1 and id + 1.
+        """
+        table = read_led_table(folder)
+        detected = table['led'] != -1
+        if not np.any(detected):
+            return
+        ids = table['led'][detected].astype(int)
+        x = table['x'][detected].astype(float)
+        y = table['y'][detected].astype(float)
+
+        # First detection of each led, sorted by id
+        first_ids, first = np.unique(ids, return_index=True)
+        dist = neighbour_distance(ids, x, y, first_ids, x[first], y[first])
+
+        # Per led the detection with the smallest distance. On equal distance the first detection in the file wins.
+        order = np.lexsort((np.arange(len(ids)), np.nan_to_num(dist, nan=np.inf), ids))
+        best = order[np.searchsorted(ids[order], first_ids)]
+
+        # Keep the leds in order of their first detection
+        for row in best[np.argsort(first)].tolist():
+            self.snapl[int(ids[row])] = SnapLine(int(x[row]), int(y[row]), int(ids[row]), self)
 
     def mark_reliable(self):
-        for key, led in self.snapl.items():
-            if not led.average_neighbour_dist() or led.average_neighbour_dist() > self.median * 2:
-                led.reliable = False
+        """
+        A led is unreliable if it has no neighbours, or if the distance to its neighbours is more than twice the median.
+        """
+        self._arrays = None
+        ids, x, y = self.arrays.ids, self.arrays.x, self.arrays.y
+        dist = neighbour_distance(ids, x, y, ids, x, y)
+        with np.errstate(invalid='ignore'):
+            unreliable = np.isnan(dist) | (dist > self.median * 2)
+        for led_id in ids[unreliable]:
+            self.snapl[int(led_id)].reliable = False
+        self._arrays = None
 
     def improve(self):
         for key in list(self.snapl.keys()):
             if not self.snapl[key].reliable:
                 del self.snapl[key]
+        self._arrays = None
+
+    @property
+    def arrays(self) -> SnapArrays:
+        """
+        Snap lines as arrays. Rebuilt after the snap lines changed in mark_reliable or improve.
+        """
+        if self._arrays is None:
+            position = {led_id: i for i, led_id in enumerate(self.snapl)}
+            leds = sorted(self.snapl.values(), key=lambda led: led.id)
+            self._arrays = SnapArrays(np.array([led.id for led in leds], dtype=int),
+                                      np.array([led.x for led in leds], dtype=float),
+                                      np.array([led.y for led in leds], dtype=float),
+                                      np.array([led.reliable for led in leds], dtype=bool),
+                                      np.array([position[led.id] for led in leds], dtype=int))
+            self._angles_origin = None
+        return self._arrays
+
+    def _update_angles(self):
+        origin = (self.image_center_x, self.image_center_y)
+        arrays = self.arrays
+        if self._angles_origin != origin:
+            self._phi = np.radians((arrays.y - origin[0]) * LENS_ANGLE[0] / IMAGE[0])
+            self._theta = np.radians((origin[1] - arrays.x) * LENS_ANGLE[1] / IMAGE[1])
+            self._angles_origin = origin
+
+    @property
+    def phi(self) -> np.ndarray:
+        """
+        pixel_phi of all snap lines, in the order of arrays. Recalculated when the origin changes.
+        """
+        self._update_angles()
+        return self._phi
+
+    @property
+    def theta(self) -> np.ndarray:
+        """
+        pixel_theta of all snap lines, in the order of arrays. Recalculated when the origin changes.
+        """
+        self._update_angles()
+        return self._theta
 
     @property
     def image_center_x(self) -> float:
@@ -147,29 +243,26 @@ class RawSnapData:
             return self.camera_pos.origin[1]
         return IMAGE[1] / 2
 
+    @property
+    def tree_center_estimate(self) -> CenterEstimate:
+        """
+        Center and spread of the horizontal position of the reliable leds, estimated with center_method.
+        """
+        if self._tree_center is None:
+            self._tree_center = estimate_center(self.arrays.y[self.arrays.reliable], self.center_method)
+        return self._tree_center
+
     @property
     def tree_center(self) -> int:
         """
         Get the pixel in which the tree center is expected.
-        This pixel has the lowest mean error when checking distances to active leds. (most in the middle pixel)
+        With the default mean, this pixel has the lowest mean error when checking distances to active leds.
+        (most in the middle pixel)
         This function is only used to estimate the origin in the raw data.
         As soon as a camera position is available the camera center estimation should be used.
         :return:
         """
-        if not self._tree_center:
-            coord = [led.y for led in self.snapl.values() if led.reliable]
-            last_err: Optional[int] = None
-            for i in range(min(coord), max(coord)):
-                err = 0
-                for val in coord:
-                    err += (val - i)**2
-
-                if last_err and err > last_err:
-                    self._tree_center = i - 1
-                    break
-                last_err = err
-
-        return self._tree_center
+        return int(np.floor(self.tree_center_estimate.center + 0.5))
 
     @property
     def distances(self) -> List[float]:
@@ -177,16 +270,14 @@ class RawSnapData:
         List of relative led distances based on the raw image.
         :return:
         """
-        data = []
-        for led in self.snapl.values():
-            if led.next():
-                data.append(led.distance(led.next()))
-        return data
+        ids, x, y = self.arrays.ids, self.arrays.x, self.arrays.y
+        consecutive = np.diff(ids) == 1
+        return np.hypot(np.diff(x), np.diff(y))[consecutive].tolist()
 
     @property
     def median(self) -> float:
         if not self._median:
-            self._median = median(self.distances)
+            self._median = float(np.median(self.distances))
         return self._median
 
     @property
@@ -214,12 +305,10 @@ class RawSnapData:
         Get the outer angles in de picture (in radians)
         :return: ((x_min, y_min), (x_max, y_max))
         """
-        leds = [led for led in self.snapl.values() if led.reliable]
         if not self._angle_extremes:
-            self._angle_extremes = ((min([self.pixel_phi(led) for led in leds]),
-                                     min([self.pixel_theta(led) for led in leds])),
-                                    ((max([self.pixel_phi(led) for led in leds]),
-                                      max([self.pixel_theta(led) for led in leds]))))
+            reliable = self.arrays.reliable
+            phi, theta = self.phi[reliable], self.theta[reliable]
+            self._angle_extremes = ((phi.min(), theta.min()), (phi.max(), theta.max()))
         return self._angle_extremes
 
     def camera_distance_estimation(self) -> float:
@@ -235,34 +324,41 @@ class RawSnapData:
         Use the model of pixels to determine what the origin in the image should be.
         :return:
         """
-        pixels = rotate_pixel_dict(pixel_positions.latest(), self.camera_pos.phi_estimate)
-        positive = [pixels[p] for p in pixels if pixels[p].y >= 0 and p in self.snapl]
-        negative = [pixels[p] for p in pixels if pixels[p].y <= 0 and p in self.snapl]
-        upper = min(positive, key=lambda p: p.y)
-        lower = max(negative, key=lambda p: p.y)
-
-        a = self.snapl[upper.id]
-        b = self.snapl[lower.id]
+        pixels = pixel_positions.latest().rotated(self.camera_pos.phi_estimate)
+        ids = np.array([key for key in self.snapl if key in pixels], dtype=int)
+        y = pixels.coord[ids, 1]
+        upper = ids[y >= 0][np.argmin(y[y >= 0])]
+        lower = ids[y <= 0][np.argmax(y[y <= 0])]
+
+        a = self.snapl[upper]
+        b = self.snapl[lower]
         self.camera_pos.origin = ((a.y + b.y) / 2, self.camera_pos.origin[1])
 
+    def extreme_leds(self, amount=5) -> np.ndarray:
+        """
+        Reliable leds with the smallest and the biggest phi. Leds with equal phi keep the order of snapl.
+        :param amount: Number of leds on each side of the tree
+        :return: Row in arrays of the amount leds with the smallest phi followed by the amount with the biggest
+        """
+        rows = np.flatnonzero(self.arrays.reliable)
+        order = rows[np.lexsort((self.arrays.position[rows], self.phi[rows]))]
+        return np.concatenate([order[:amount], order[-amount:]])
+
     def refit_camera(self):
         self.refit_center_pixel()
 
-        pixels = rotate_pixel_dict(pixel_positions.latest(), self.camera_pos.phi_estimate)
+        pixels = pixel_positions.latest().rotated(self.camera_pos.phi_estimate)
 
-        snap = [snap for snap in self.snapl.values() if snap.reliable]
         """
         Find 5 snapped pixels on both sides of the tree with most extreme (biggest) angles.
         Esta the camera distance based on these leds 
         """
-        extremes = sorted(snap, key=lambda s: self.pixel_phi(s))
+        ids, phi = self.arrays.ids, self.phi
 
         distances = []
-        for snap in extremes[:5] + extremes[-5:]:
-            try:
-                pixel = pixels[snap.id].coord
-                distances.append(pixel[0] + pixel[1] / self.pixel_phi(snap))
-            except LookupError:
-                pass
+        for index in self.extreme_leds():
+            if ids[index] in pixels:
+                pixel = pixels.coord[ids[index]]
+                distances.append(pixel[0] + pixel[1] / phi[index])
 
         self.camera_pos.coord = [median(distances), 0, 0]
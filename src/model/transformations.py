@@ -1,46 +1,117 @@
+"""
+Rotations and translations of positions.
+
+Positions are row vectors: a single (3) vector, or (N, 3) arrays of positions.
+A rotation over angle is applied as position . rotation_matrix(angle), matching rotate_xy.
+All functions accept many angles at once: rotating (N, 3) positions over (A) angles gives (A, N, 3).
+"""
+from functools import lru_cache
 from math import cos, sin
-from typing import Dict, Union
+from typing import Optional, Union
 
 import numpy as np
 
-from model.positions import Pixel
+from model.spherical_coordinate import SphereCoord
 
 
+@lru_cache(maxsize=1024)
 def rotation_matrix(angle: float, axis='z') -> np.array:
+    """
+    Rotation matrix around axis. The matrices are cached and read only.
+    """
     if axis == 'z':
-        return np.array([[cos(angle), -sin(angle), 0],
-                         [sin(angle), cos(angle), 0],
-                         [0, 0, 1]])
-    if axis == 'x':
-        return np.array([[1, 0, 0],
-                         [0, cos(angle), -sin(angle)],
-                         [0, sin(angle), cos(angle)]])
+        matrix = np.array([[cos(angle), -sin(angle), 0],
+                           [sin(angle), cos(angle), 0],
+                           [0, 0, 1]])
+    elif axis == 'x':
+        matrix = np.array([[1, 0, 0],
+                           [0, cos(angle), -sin(angle)],
+                           [0, sin(angle), cos(angle)]])
 
-    if axis == 'y':
-        return np.array([[cos(angle), 0, sin(angle)],
-                         [0, 1, 0],
-                         [-sin(angle), 0, cos(angle)]])
+    elif axis == 'y':
+        matrix = np.array([[cos(angle), 0, sin(angle)],
+                           [0, 1, 0],
+                           [-sin(angle), 0, cos(angle)]])
+    else:
+        raise RuntimeError(f'Rotation "{axis}" not supported')
 
-    raise RuntimeError(f'Rotation "{axis}" not supported')
+    matrix.flags.writeable = False
+    return matrix
 
 
-def rotate_xy(vector: Union[np.ndarray, Pixel], angle: float) -> np.ndarray:
-    if isinstance(vector, Pixel):
+def rotation_matrices(angles: np.ndarray, axis='z') -> np.ndarray:
+    """
+    Rotation matrices for many angles at once.
+    :param angles: (A) angles in radians
+    :return: (A, 3, 3) matrices, matrix i equal to rotation_matrix(angles[i], axis)
+    """
+    angles = np.asarray(angles, dtype=float)
+    c, s = np.cos(angles), np.sin(angles)
+    one, zero = np.ones_like(angles), np.zeros_like(angles)
+    if axis == 'z':
+        rows = [[c, -s, zero], [s, c, zero], [zero, zero, one]]
+    elif axis == 'x':
+        rows = [[one, zero, zero], [zero, c, -s], [zero, s, c]]
+    elif axis == 'y':
+        rows = [[c, zero, s], [zero, one, zero], [-s, zero, c]]
+    else:
+        raise RuntimeError(f'Rotation "{axis}" not supported')
+    return np.moveaxis(np.array(rows), (0, 1), (-2, -1))
+
+
+def rotate(positions: np.ndarray, angle: Union[float, np.ndarray], axis='z') -> np.ndarray:
+    """
+    Rotate positions.
+    :param positions: (3) or (N, 3) positions
+    :param angle: Single angle, or (A) angles
+    :return: Positions with the same shape as the input for a single angle, (A, N, 3) or (A, 3) for many angles
+    """
+    if np.ndim(angle) == 0:
+        return np.asarray(positions) @ rotation_matrix(float(angle), axis)
+    return np.einsum('...j,ajk->a...k', positions, rotation_matrices(angle, axis))
+
+
+def rotate_xy(vector: Union[np.ndarray, SphereCoord], angle: float) -> np.ndarray:
+    if isinstance(vector, SphereCoord):
         vector = vector.coord
     if len(vector) != 3:
         raise RuntimeError(f'Vector "{vector}" should represent x, y, z')
-    return np.dot(vector, rotation_matrix(angle))
+    return rotate(vector, angle)
 
 
-def rotate_pixel_dict(data: Dict[int, Pixel], phi: float) -> Dict[int, Pixel]:
+class Transformation:
     """
-    Return the same data in a rotated frame of reference
-    :param data: Dict of pixels
-    :param phi: rotations angle. Rotation takes place in xy, frame
-    :return:
+    Rotation followed by a translation: position . rotation + translation.
+    Transformations are composed with then: a.then(b) first applies a, then b.
     """
-    result = {}
-    for key, pix in data.items():
-        rot = rotate_xy(pix, phi)
-        result[key] = Pixel(key, rot[0], rot[1], rot[2])
-    return result
+    def __init__(self, rotation: Optional[np.ndarray] = None, translation: Optional[np.ndarray] = None):
+        self.rotation = np.eye(3) if rotation is None else np.asarray(rotation, dtype=float)
+        self.translation = np.zeros(3) if translation is None else np.asarray(translation, dtype=float)
+
+    @classmethod
+    def rotation_around(cls, angle: float, center: Optional[np.ndarray] = None, axis='z') -> 'Transformation':
+        """
+        Rotation over angle around center (default the origin)
+        """
+        rotation = rotation_matrix(float(angle), axis)
+        if center is None:
+            return cls(rotation)
+        center = np.asarray(center, dtype=float)
+        return cls(rotation, center - center @ rotation)
+
+    @classmethod
+    def shift(cls, translation: np.ndarray) -> 'Transformation':
+        return cls(translation=translation)
+
+    def then(self, other: 'Transformation') -> 'Transformation':
+        return Transformation(self.rotation @ other.rotation, self.translation @ other.rotation + other.translation)
+
+    def inverse(self) -> 'Transformation':
+        rotation = self.rotation.T
+        return Transformation(rotation, -self.translation @ rotation)
+
+    def __call__(self, positions: np.ndarray) -> np.ndarray:
+        """
+        :param positions: (3) or (N, 3) positions
+        """
+        return np.asarray(positions) @ self.rotation + self.translation
@@ -1,21 +1,31 @@
 from math import pi
-from typing import Dict, Tuple, List
+from typing import Tuple, List, Optional
 
 from model.snap import RawSnapData
-from model.positions import Pixel
-from caculations import estimate_angle, all_intersection
-from model.transformations import rotate_xy, rotate_pixel_dict
-from config import NUM_PIXELS
+from model.positions import PositionTable
+from caculations import AngleEstimate, estimate_angle, all_intersection
+from model.angle_matrix import AngleMatrix
 
 
-def calc_best_right_angle(c1, c2, c3):
+def pair_estimates(cam1: RawSnapData, cam2: RawSnapData, cam3: RawSnapData, matrix: Optional[AngleMatrix] = None) \
+        -> Tuple[AngleEstimate, AngleEstimate, AngleEstimate]:
+    """
+    Angle estimates cam1 -> cam2, cam2 -> cam3, cam3 -> cam1.
+    Taken from the matrix when given, otherwise estimated.
+    """
+    if matrix is not None:
+        return (matrix.estimate(cam1.name, cam2.name),
+                matrix.estimate(cam2.name, cam3.name),
+                matrix.estimate(cam3.name, cam1.name))
+    return estimate_angle(cam1, cam2), estimate_angle(cam2, cam3), estimate_angle(cam3, cam1)
+
+
+def calc_best_right_angle(c1, c2, c3, matrix: Optional[AngleMatrix] = None):
     """
     get the most probable angles between the 3 inputs
     return c1 -> c2, c2 -> c3, c3 -> c1
     """
-    a = estimate_angle(c1, c2)
-    b = estimate_angle(c2, c3)
-    c = estimate_angle(c3, c1)
+    a, b, c = pair_estimates(c1, c2, c3, matrix)
 
     angles = {}
 
@@ -28,7 +38,7 @@ def calc_best_right_angle(c1, c2, c3):
     return angles[min(angles.keys())]
 
 
-def intersection_in_sphere_frame(cam1: RawSnapData, cam2: RawSnapData):
+def intersection_in_sphere_frame(cam1: RawSnapData, cam2: RawSnapData) -> PositionTable:
     """
     Get the intersections between cam1 and cam2.
     The coordinates of the response are based on the standard sphere reference frame.
@@ -38,10 +48,10 @@ def intersection_in_sphere_frame(cam1: RawSnapData, cam2: RawSnapData):
     :return:
     """
     data = all_intersection(cam1, cam2, cam2.camera_pos.phi_estimate - cam1.camera_pos.phi_estimate)
-    return rotate_pixel_dict(data, -cam1.camera_pos.phi_estimate)
+    return data.rotated(-cam1.camera_pos.phi_estimate)
 
 
-def triangulate_angled(cam1: RawSnapData, cam2: RawSnapData, cam3: RawSnapData) -> Dict[int, Pixel]:
+def triangulate_angled(cam1: RawSnapData, cam2: RawSnapData, cam3: RawSnapData) -> PositionTable:
     """
     Make a triangulated estimation of the pixel positions
     :param cam1: Raw ImageData object
@@ -50,35 +60,22 @@ def triangulate_angled(cam1: RawSnapData, cam2: RawSnapData, cam3: RawSnapData)
     :return: Array with calculated led positions.
     """
 
-    d = [intersection_in_sphere_frame(cam1, cam2),
-         intersection_in_sphere_frame(cam2, cam3),
-         intersection_in_sphere_frame(cam1, cam3)]
-
-    data = {}
-    for key in range(NUM_PIXELS):
-        p = Pixel(key, 0, 0, 0)
-        num = 0
-        for data_points in d:
-            if key in data_points:
-                p += data_points[key]
-                num += 1
-        if num > 0:
-            data[key] = p / num
-
-    return data
+    return PositionTable.average([intersection_in_sphere_frame(cam1, cam2),
+                                  intersection_in_sphere_frame(cam2, cam3),
+                                  intersection_in_sphere_frame(cam1, cam3)])
 
 
-def triangulate(cam1: RawSnapData, cam2: RawSnapData, cam3: RawSnapData) -> Tuple[float, float, float]:
+def triangulate(cam1: RawSnapData, cam2: RawSnapData, cam3: RawSnapData, matrix: Optional[AngleMatrix] = None) \
+        -> Tuple[float, float, float]:
     """
     Make a triangulated estimate of the estimated angles between 3 camera positions
     :param cam1: Raw ImageData object
     :param cam2: Raw ImageData object
     :param cam3: Raw ImageData object
+    :param matrix: Precalculated pair estimates. If None, the 3 pairs are estimated.
     :return: cam1 -> cam2, cam2 -> cam3, cam1 cam3.
     """
-    a = estimate_angle(cam1, cam2)
-    b = estimate_angle(cam2, cam3)
-    c = estimate_angle(cam3, cam1)
+    a, b, c = pair_estimates(cam1, cam2, cam3, matrix)
 
     dif = 2 * pi
     data = (0.0, 0.0, 0.0)
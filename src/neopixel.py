@@ -85,9 +85,20 @@ class NeoPixels:
         return{"rgb": [p.json() for p in NeoPixels.pixels]}
 
     @staticmethod
-    def send_by_wifi():
+    def frame() -> Frame:
+        """
+        Create a Frame with the current colors of all pixels
+        """
         f = Frame()
         for i in range(len(NeoPixels.pixels)):
             col = NeoPixels.pixels[i].color
             f.leds[i] = [col.red, col.green, col.blue]
-        pixelTree.send_frame(f, False)
+        return f
+
+    @staticmethod
+    def send_by_wifi(frame: Optional[Frame] = None):
+        """
+        Send a frame to the tree
+        :param frame: Frame to send. If None, a frame with the current colors of all pixels is sent.
+        """
+        pixelTree.send_frame(frame or NeoPixels.frame(), False)
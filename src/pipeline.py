@@ -0,0 +1,86 @@
+"""
+Pipeline of the mapping stages, computed on request instead of at import time.
+
+snaps -> height -> width
+vertical positions -> angles -> initial rotation -> theta
+
+Every stage is a cached property: it is computed on first use, pulling in only the stages it depends on,
+and reused afterwards. The stage modules (height, width, vertical_align, theta) are only imported when
+a stage needs them, so importing this file or any stage module does no calculation.
+"""
+from functools import cached_property
+from typing import TYPE_CHECKING, List, Tuple
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from analyze_data import DataContainer
+    from theta import FullRotation, Theta
+
+# Optimize the data. This will lead to more accurate led detection, but will take quite some extra calculation time.
+OPTIMIZED = False
+
+
+class Pipeline:
+    def __init__(self, optimized: bool = OPTIMIZED):
+        """
+        :param optimized: Optimize the led strings of all snaps, see loader.load_all_data_container
+        """
+        self.optimized = optimized
+
+    @cached_property
+    def snaps(self) -> List['DataContainer']:
+        from loader import load_all_data_container
+        return load_all_data_container(self.optimized)
+
+    @cached_property
+    def height(self) -> 'pd.Series':
+        """
+        Height of each led, scaled between 0 and 1. The height estimates of the snaps are filled as well.
+        """
+        from height import estimate_led_height, fill_height_estimates
+        height = estimate_led_height(self.snaps)['median']
+        fill_height_estimates(self.snaps, height)
+        return height
+
+    @cached_property
+    def width(self) -> 'pd.Series':
+        """
+        Smoothed distance of each led to the trunk of the tree
+        """
+        from width import estimate_led_width
+        return estimate_led_width(self.snaps, self.height)
+
+    @cached_property
+    def vertical_angles(self) -> Tuple['pd.DataFrame', 'pd.DataFrame']:
+        from vertical_align import angles_dataframe
+        return angles_dataframe()
+
+    @property
+    def verticals(self) -> 'pd.DataFrame':
+        """
+        Each column contains a list of led id's which are vertical aligned in a snap
+        """
+        return self.vertical_angles[0]
+
+    @property
+    def angles(self) -> 'pd.DataFrame':
+        """
+        Each column contains an estimate of the angle each led rotates around the tree
+        """
+        return self.vertical_angles[1]
+
+    @cached_property
+    def initial_rotation(self) -> 'FullRotation':
+        from theta import find_rotatation_with_smalest_variance
+        return find_rotatation_with_smalest_variance(self.angles)
+
+    @cached_property
+    def theta(self) -> 'Theta':
+        """
+        Angle of each led around the tree, mapped with the stages of this pipeline
+        """
+        from theta import map_led_angles_using_camera
+        return map_led_angles_using_camera(self)
+
+
+PIPELINE = Pipeline()
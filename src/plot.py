@@ -10,7 +10,7 @@ from math import pi
 from model.snap import RawSnapData
 from model.positions import Pixel
 from caculations import all_intersection
-from model.transformations import rotation_matrix, rotate_xy
+from model.transformations import rotate
 
 
 def plotly_circle(fig: go.Figure):
@@ -62,22 +62,20 @@ def plotly_led_lines(fig: go.Figure, snap: RawSnapData, phi: float, color):
     :return:
     """
     cam = deepcopy(snap.camera_pos)
-    campos = np.dot(cam.coord, rotation_matrix(phi))
+    campos = rotate(cam.coord, phi)
 
     cam.coord = campos
 
     plotly_point(fig, campos[0], campos[1], color, cam.name)
 
-    vector = rotate_xy(np.array([-2, 0, 0]), phi)  # Vector is used as endpoint for the line.
-    for led in snap.snapl.values():
-        if not led.reliable:
-            continue
+    vector = rotate(np.array([-2, 0, 0]), phi)  # Vector is used as endpoint for the line.
+    reliable = snap.arrays.reliable
 
-        angle = snap.pixel_phi(led)
+    # The end point of each line is the vector rotated around the camera over the pixel angle of the led
+    led_pos = rotate(vector - cam.coord, snap.phi[reliable]) + cam.coord
 
-        led_pos = np.dot(vector - cam.coord, rotation_matrix(angle)) + cam.coord
-
-        plotly_line(fig, cam.coord, led_pos, color, led.id)
+    for led_id, pos in zip(snap.arrays.ids[reliable].tolist(), led_pos):
+        plotly_line(fig, cam.coord, pos, color, led_id)
 
 
 def plotly_intersection(fig, cam1: RawSnapData, cam2: RawSnapData, angle, color='black'):
@@ -1,5 +1,5 @@
-from calc_pixels import Cluster, storage, Pixel
-from numpy import median, average, argwhere
+from calc_pixels import Cluster, storage
+from numpy import median, average
 import time
 
 if __name__ == "__main__":
@@ -8,8 +8,7 @@ if __name__ == "__main__":
     variance = data.var(axis=1)
 
     start = time.time()
-    for _ in argwhere(variance < average(variance)**2):
-        Pixel.register[_[0]].disable()
+    c.pixels.disable(variance < average(variance)**2)
 
     c.calc_kmeans()
     print(f"done {time.time() - start} seconds")
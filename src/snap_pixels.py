@@ -2,11 +2,12 @@ import json
 import time
 import random
 import numpy
-from typing import Union
-from cv2 import absdiff
+from typing import Dict, List, Optional, Union
+from cv2 import absdiff, cvtColor, COLOR_BGR2GRAY
 from neopixel import NeoPixels, Color
+from communication.wifi import Frame
 # from communication.esp_serial import esp
-from webcam import Webcam, read_im, store_im
+from webcam import ImageWriter, Webcam, create_stack, read_im, store_im
 from config import storage, NUM_PIXELS, NUM_SNAP_FRAMES
 
 np = NeoPixels(NUM_PIXELS)
@@ -20,38 +21,137 @@ class Snapper:
     Next for each bit the pixel is turned on in case the bit is high, turned off if the bit is low.
     When making images, first a base image is created with all leds off. The sequence of images representing the bit
     is shot after, and from each image the base image is subtracted to make maximum contrast betwwen led on and led off.
+
+    Images are stored as png files, as a single memory mapped frame stack (see webcam.py), or both.
+
+    By default a fixed time is waited after sending a led frame before snapping the image.
+    In adaptive mode, the image is snapped as soon as the new led frame is visible and the image is stable.
+    The time between sending the frame and storing the image is recorded per image in latency.json.
+
+    In pipelined mode, the webcam is read continuously in the background to avoid stale buffered images,
+    and png images are encoded and written in the background while the next led frame is sent and snapped.
+
+    To reduce sensor noise, multiple images can be snapped per led frame and reduced to 1 image (mean or median),
+    or merged from a series of exposures (hdr). Exposure and white balance are locked during a series.
     """
-    def __init__(self, series_name: str, snap_color: Union[Color, str] = 'white', num_pixels=NUM_PIXELS):
+    def __init__(self, series_name: str, snap_color: Union[Color, str] = 'white', num_pixels=NUM_PIXELS,
+                 store_png: bool = True, store_stack: bool = False, adaptive: bool = False, pipelined: bool = False,
+                 images_per_frame: int = 1, reduce: str = 'mean', hdr_exposures: Optional[List[float]] = None):
+        if not store_png and not store_stack:
+            raise RuntimeError('Store the images as png, as frame stack or both')
         self.series_name = series_name
         self.snap_color = snap_color
         self.num_pixels = num_pixels
+        self.store_png = store_png
+        self.store_stack = store_stack
+        self.ground: Optional[numpy.ndarray] = None
+        self.stack: Optional[numpy.memmap] = None
+        self.adaptive = adaptive
+        self.last_image: Optional[numpy.ndarray] = None
+        self.latency: Dict[str, float] = {}  # Time from sending the led frame until the image is snapped
+        self.sent = 0.0  # Time the last led frame was sent
+        self.pipelined = pipelined
+        self.writer: Optional[ImageWriter] = None
+        self.images_per_frame = images_per_frame
+        self.reduce = reduce
+        self.hdr_exposures = hdr_exposures
 
         (storage / series_name).mkdir(exist_ok=True, parents=True)
 
-    def snap_monochrome(self, name: str, color: Union[Color, str]):
+    def store_image(self, name: str, image: numpy.ndarray, layer: int):
+        """
+        Store a snapped image.
+        :param name: Name of the png image
+        :param image: Snapped image
+        :param layer: Layer in the frame stack. Layer 0 is ground, 1 is all, the bit images are stored as difference
+                      with ground from layer 2.
+        """
+        if self.store_png:
+            if self.writer:
+                self.writer.put(f'{self.series_name}/{name}', image)
+            else:
+                store_im(f'{self.series_name}/{name}', image)
+        if not self.store_stack:
+            return
+
+        if layer == 0:
+            self.ground = image
+            self.stack = create_stack(self.series_name, image.shape[:2], NUM_SNAP_FRAMES)
+        elif layer > 1:
+            image = absdiff(image, self.ground)
+        self.stack[..., layer] = cvtColor(image, COLOR_BGR2GRAY)
+        self.stack.flush()
+
+    def send(self, frame: Frame, repeat: int = 1):
+        """
+        Send a led frame to the tree.
+        :param frame: Frame to send
+        :param repeat: Number of times the frame is sent in fixed sleep mode
+        """
+        # esp.write()
+        for _ in range(1 if self.adaptive else repeat):
+            NeoPixels.send_by_wifi(frame)
+        # send_by_wifi returns after the controller acknowledged the frame, from here the camera is watched.
+        self.sent = time.time()
+
+    def snap(self, name: str, layer: int):
+        """
+        Snap an image of the last sent led frame, as soon as it is visible, and store it.
+        :param name: Name of the image
+        :param layer: Layer in the frame stack
+        """
+        if self.adaptive:
+            image, settled = Webcam.snap_settled(self.last_image)
+            if not settled:
+                print(f"Image {name} did not settle")
+            after = time.time()
+        else:
+            # Hardcoded sleep. Use adaptive mode to wait the exact time it takes to render the frame.
+            time.sleep(max(0.0, 0.2 - (time.time() - self.sent)))
+            image = None
+            after = self.sent
+
+        if self.hdr_exposures:
+            image = Webcam.snap_hdr(self.hdr_exposures, after)
+        elif self.images_per_frame > 1:
+            image = Webcam.snap_average(self.images_per_frame, self.reduce, after)
+        elif image is None:
+            image = Webcam.snap(after)
+        self.latency[name] = time.time() - self.sent
+        self.last_image = image
+        self.store_image(name, image, layer)
+
+    def store_latency(self):
+        """
+        Store the latency of each image and print a summary.
+        """
+        values = list(self.latency.values())
+        print(f"Latency min {min(values):.3f}s, mean {sum(values) / len(values):.3f}s, max {max(values):.3f}s, "
+              f"total {sum(values):.1f}s")
+        with (storage / self.series_name / 'latency.json').open('w') as file:
+            file.write(json.dumps(self.latency))
+
+    def snap_monochrome(self, name: str, color: Union[Color, str], layer: int):
         """
         Create an image in which all the pixels have the same color.
         :param name: Name of the image
         :param color: 1 Color to use for all the pixels in the tree.
+        :param layer: Layer in the frame stack
         :return:
         """
         for pixel in NeoPixels.pixels:
             pixel.color = color
 
-        # esp.write()
-        NeoPixels.send_by_wifi()
-        # Hardcoded sleep for now. This sleep could be replaced by some code calculating
-        # and waiting the exact time it takes to render the frame.
-        time.sleep(0.2)
-        store_im(f'{self.series_name}/{name}', Webcam.snap())
+        self.send(NeoPixels.frame())
+        self.snap(name, layer)
 
     def snap_ground(self):
         """Snap a pixture with all leds off."""
-        self.snap_monochrome('ground', 'black')
+        self.snap_monochrome('ground', 'black', 0)
 
     def snap_full_on(self):
         """Snap a pixture with all leds on"""
-        self.snap_monochrome('all', Color(100, 100, 100))
+        self.snap_monochrome('all', Color(100, 100, 100), 1)
 
     def snap_leds(self):
         """Snap N pixtures. In each pixture all leds turn either on or off, depending on their "foto number".
@@ -60,25 +160,37 @@ class Snapper:
         This pattern is the binary representation of the foto number of the led.
         :return:
         """
+        frame = self.bit_frame(0)
         for n in range(NUM_SNAP_FRAMES):
-            for pixel in NeoPixels.pixels:
-                if pixel.bit_n_set(n):
-                    pixel.color = self.snap_color
-                else:
-                    pixel.color = 'black'
-            # esp.write()
-            NeoPixels.send_by_wifi()
-            NeoPixels.send_by_wifi()
-            time.sleep(0.2)
-            store_im(f'{self.series_name}/{n}', Webcam.snap())
+            self.send(frame, repeat=2)
+            if n + 1 < NUM_SNAP_FRAMES:
+                # Prepare the next pattern while the tree renders the current one.
+                frame = self.bit_frame(n + 1)
+            # The stack holds the highest bit first
+            self.snap(str(n), 2 + NUM_SNAP_FRAMES - 1 - n)
+
+    def bit_frame(self, n: int) -> Frame:
+        """
+        Create the led frame for bit n. Leds with bit n set in their foto number are on.
+        """
+        for pixel in NeoPixels.pixels:
+            if pixel.bit_n_set(n):
+                pixel.color = self.snap_color
+            else:
+                pixel.color = 'black'
+        return NeoPixels.frame()
 
     def make_example(self):
         """
-        Create an example image showing all snapped foto's in 1 images
+        Create an example image showing all snapped foto's in 1 images.
+        Each foto is shown as gray difference with ground, as stored in the frame stack.
         :return:
         """
-        ground = read_im(f'{self.series_name}/ground')
-        images = [absdiff(read_im(f'{self.series_name}/{n}'), ground) for n in range(8)]
+        if self.store_png:
+            ground = read_im(f'{self.series_name}/ground')
+            images = [cvtColor(absdiff(read_im(f'{self.series_name}/{n}'), ground), COLOR_BGR2GRAY) for n in range(8)]
+        else:
+            images = [self.stack[..., 2 + NUM_SNAP_FRAMES - 1 - n] for n in range(8)]
 
         store_im(f'{self.series_name}/example', numpy.concatenate(
             (numpy.concatenate((images[0], images[1], images[2], images[3]), axis=1),
@@ -102,11 +214,28 @@ class Snapper:
         """
         Run the sequence needed to measure 1 side of the tree
         """
-        self.assign_pixel_id()
-        self.snap_ground()
-        self.snap_full_on()
-        self.snap_leds()
+        start = time.time()
+        Webcam.lock_exposure()
+        if self.pipelined:
+            Webcam.start_grabber()
+            self.writer = ImageWriter()
+            self.writer.start()
+
+        try:
+            self.assign_pixel_id()
+            self.snap_ground()
+            self.snap_full_on()
+            self.snap_leds()
+        finally:
+            if self.pipelined:
+                Webcam.stop_grabber()
+                self.writer.close()
+                self.writer = None
+            Webcam.unlock_exposure()
+        print(f"Series {self.series_name} captured in {time.time() - start:.2f} seconds")
+
         self.make_example()
+        self.store_latency()
 
 
 if __name__ == "__main__":
@@ -11,8 +11,7 @@ import pandas as pd
 import statistics
 
 from config import NUM_PIXELS
-from vertical_align import angles_dataframe
-from width import WIDTH
+from pipeline import PIPELINE, Pipeline
 
 class Theta(UserList):
     """
@@ -35,19 +34,20 @@ class Theta(UserList):
         except TypeError:
             raise ValueError('Theta not found')
 
-THETA: Theta[Optional[float]] = Theta(None for i in range(NUM_PIXELS))
-
 @dataclass
 class FullRotation:
     start: int  # Led ID of start of rotation
     end: int  # Led ID of end of rotation
     variance: float  # Sum of the variance of detection. (lower is more accurate)
 
-    def angles(self) -> List[float]:
-        angles = [0.0]
+    def angles(self, angles: pd.DataFrame) -> List[float]:
+        """
+        :param angles: Angle estimates of all leds in all images, see vertical_align.angles_dataframe
+        """
+        rotation = [0.0]
         for i in range(self.end - self.start - 1):
-            angles.append(angles[i] + ANGLES['median'][self.start + i])
-        return angles
+            rotation.append(rotation[i] + angles['median'][self.start + i])
+        return rotation
 
     def get_angle_of_led(self, pos: float):
         """
@@ -71,9 +71,6 @@ class CamPos:
         return sum([(_ - self.angle) ** 2 for _ in self.fits]) / len(self.fits)
 
 
-campos: Dict[str, CamPos] = {}
-
-
 def x(r: float, theta: float) -> float:
     return r * cos(theta + 2.9)
 
@@ -93,10 +90,8 @@ def uni_theta(theta: float) -> float:
         return theta + 2
     return theta - 2
 
-verticals, ANGLES = angles_dataframe()
 
-
-def find_rotatation_with_smalest_variance(threshold=30) -> FullRotation:
+def find_rotatation_with_smalest_variance(angles: pd.DataFrame, threshold=30) -> FullRotation:
     """
     Find the led rotation with the smalest variance.
     A led rotation is a increasing series of leds making 1 full loop around the tree.
@@ -104,16 +99,17 @@ def find_rotatation_with_smalest_variance(threshold=30) -> FullRotation:
     To filter, the threshold should be given as a percentage.
     Only rotations seen in more than threshold percent of the images are considered for this function.
 
+    :param angles: Angle estimates of all leds in all images, see vertical_align.angles_dataframe
     :param threshold: percentage of images required to contain data for detection.
     """
     # Take only rows with appear in at least 30 % of the images.
-    sums = ANGLES.isna().sum(axis=1)
-    sums[sums > (100 - threshold) / 100 * len(ANGLES.columns)] = 0
+    sums = angles.isna().sum(axis=1)
+    sums[sums > (100 - threshold) / 100 * len(angles.columns)] = 0
 
     if np.count_nonzero(sums) / NUM_PIXELS < 0.5:
         warn('Rotation estimation filtering more then 50% of the leds. Try lowering the threshold.')
 
-    variance = ANGLES.var(axis=1) * sums * abs(2/ANGLES['median'])
+    variance = angles.var(axis=1) * sums * abs(2/angles['median'])
 
     rotation_info: List[FullRotation] = []
     for led in range(NUM_PIXELS):
@@ -122,7 +118,7 @@ def find_rotatation_with_smalest_variance(threshold=30) -> FullRotation:
         while angle < 2:
             if sums[current] == 0:
                 break  # Not possible to get the full rotation with enough camera's
-            angle += abs(ANGLES['median'][current])  # increase the angle
+            angle += abs(angles['median'][current])  # increase the angle
             current += 1
         if angle < 2:
             continue
@@ -133,21 +129,18 @@ def find_rotatation_with_smalest_variance(threshold=30) -> FullRotation:
     return best_rotation
 
 
-INITIAL_ROTATION: Optional[FullRotation] = find_rotatation_with_smalest_variance()
-
-
-def plot_led_angles():
+def plot_led_angles(pipeline: Pipeline, theta: Theta, campos: Dict[str, CamPos]):
     c_x = []
     c_y = []
     for i in range(NUM_PIXELS):
-        r = WIDTH[i]
-        if THETA[i]:
-            theta = THETA[i]
+        r = pipeline.width[i]
+        if theta[i]:
+            angle = theta[i]
         else:
-            theta = 0
+            angle = 0
 
-        c_x.append(x(r, theta * pi))
-        c_y.append(y(r, theta * pi))
+        c_x.append(x(r, angle * pi))
+        c_y.append(y(r, angle * pi))
 
     fig, ax = plt.subplots()
     ax.scatter(c_x, c_y, s=1)
@@ -159,7 +152,7 @@ def plot_led_angles():
              'lantaarn': 'y',
              'woonkamer': 'k'}
 
-    for series_name, series in verticals.items():
+    for series_name, series in pipeline.verticals.items():
         if series_name not in color.keys():
             continue
         for i in range(len(series)):
@@ -181,15 +174,16 @@ def plot_led_angles():
     plt.show()
 
 
-def rank_cameras():
+def rank_cameras(pipeline: Pipeline, campos: Dict[str, CamPos]):
     """
     Make a list of camera's. The first camera in the list matches the rotation best.
     """
     precision = {}
     rank = {}
     low_rank = {}
+    rotation = pipeline.initial_rotation
 
-    for series_name in verticals.keys():
+    for series_name in pipeline.verticals.keys():
         try:
             if not (precis := campos[str(series_name)].precision()) is None:
                 precision[series_name] = precis
@@ -197,8 +191,8 @@ def rank_cameras():
         except KeyError:
             pass
 
-        diff = (ANGLES[series_name][INITIAL_ROTATION.start:INITIAL_ROTATION.end]-
-                ANGLES['median'][INITIAL_ROTATION.start:INITIAL_ROTATION.end])
+        diff = (pipeline.angles[series_name][rotation.start:rotation.end]-
+                pipeline.angles['median'][rotation.start:rotation.end])
         score = sum(diff.abs())
 
         if not isnan(score):
@@ -207,8 +201,8 @@ def rank_cameras():
 
         # For series not having enough data in the correct window, we calculate a low_rank.
         # This rank involves all the rows, and is scaled to the number of rows to compare series of different length
-        series = ANGLES[series_name]
-        diff = series[series.notna()] - ANGLES['median'][series.notna()]
+        series = pipeline.angles[series_name]
+        diff = series[series.notna()] - pipeline.angles['median'][series.notna()]
         low_rank[series_name] = sum(diff.abs()) / len(series.notna())
 
 
@@ -238,11 +232,11 @@ def between_index(lower: Union[int, float], upper: Union[int, float], series: pd
     return [_[0] for _ in series.items() if lower < _[1] < upper]
 
 
-def get_led_id_angle_from_theta(led_id: float) -> float:
+def get_led_id_angle_from_theta(theta: Theta, led_id: float) -> float:
     """
-    Interprolate the angle of a given led_id in the THETA array to calculate the angle.
+    Interprolate the angle of a given led_id in the theta array to calculate the angle.
     """
-    return THETA[math.floor(led_id)] + led_id % 1 * (THETA[math.ceil(led_id)] - THETA[math.floor(led_id)])
+    return theta[math.floor(led_id)] + led_id % 1 * (theta[math.ceil(led_id)] - theta[math.floor(led_id)])
 
 def distance_on_unity_circle(point_a: float, point_b: float) -> float:
     """
@@ -259,17 +253,17 @@ def distance_on_unity_circle(point_a: float, point_b: float) -> float:
     return abs(point_a + 2 - point_b)
 
 
-def fit_all_camera(threshold = 0.1):
+def fit_all_camera(pipeline: Pipeline, theta: Theta, campos: Dict[str, CamPos], threshold = 0.1):
     """
-    Find most likely camera angle based on the current data in THETA
+    Find most likely camera angle based on the current data in theta
     :param threshold: The threshold is a value between 0 and 1 on how much distance 2 angles are allowed to deviate
                       before the estimation is no longer considers the points as 2 valid inputs.
     """
-    for series_name, series in verticals.items():
+    for series_name, series in pipeline.verticals.items():
         detected_angles = []
         for value in series.dropna():
             try:
-                detected_angles.append(THETA.interpolate(value))
+                detected_angles.append(theta.interpolate(value))
             except ValueError:
                 pass
 
@@ -292,37 +286,38 @@ def fit_all_camera(threshold = 0.1):
         campos[str(series_name)] = CamPos(angle=statistics.mean(filtered), fits=filtered)
 
 
-def make_initial_rotation(camera_name: str):
+def make_initial_rotation(pipeline: Pipeline, theta: Theta, camera_name: str):
     """
     Find the rotation of the first camera close to the full rotation, and fill 1 rotation of leds.
     """
 
-    center_pixels = verticals[camera_name].dropna()
+    center_pixels = pipeline.verticals[camera_name].dropna()
+    rotation = pipeline.initial_rotation
 
     # Find the closest crossing to the start and the end of the rotation
-    start = center_pixels.iloc[(center_pixels - INITIAL_ROTATION.start).abs().argsort()[:1]].index[0]
-    end = center_pixels.iloc[(center_pixels - INITIAL_ROTATION.end).abs().argsort()[:1]].index[0]
+    start = center_pixels.iloc[(center_pixels - rotation.start).abs().argsort()[:1]].index[0]
+    end = center_pixels.iloc[(center_pixels - rotation.end).abs().argsort()[:1]].index[0]
 
     if start == end:
         # Rare occurrence, but the best fit is somewhere in the middle of the rotation.
         # Chang the start or end to make a rotation.
         warn('Fist Camera fit unreliable')
-        if abs(center_pixels[start] - INITIAL_ROTATION.start) < abs(center_pixels[end] - INITIAL_ROTATION.end):
+        if abs(center_pixels[start] - rotation.start) < abs(center_pixels[end] - rotation.end):
             end += 1
         else:
             start -= 1
 
 
     angle = 2 / (center_pixels[end] - center_pixels[start])
-    if sum(ANGLES['median'][INITIAL_ROTATION.start: INITIAL_ROTATION.end]) < 0:
+    if sum(pipeline.angles['median'][rotation.start: rotation.end]) < 0:
         angle = -angle # Make angle match the correct direction
 
     sum_angle = 0
     for i in range(math.floor(center_pixels[start]), math.ceil(center_pixels[end]) + 1 ):
-        THETA[i] = sum_angle
+        theta[i] = sum_angle
         sum_angle = uni_theta(sum_angle + angle)
 
-def print_campos():
+def print_campos(campos: Dict[str, CamPos]):
     for key, cam in campos.items():
         print(f'{key} {cam.angle:.2f}')
 
@@ -355,7 +350,7 @@ def calculate_increasing_angle(direction:float,
     return ang_diff / num_leds
 
 
-def map_downwards(freedom_percentage = 40):
+def map_downwards(pipeline: Pipeline, theta: Theta, campos: Dict[str, CamPos], freedom_percentage = 40):
     """
     Fill Theta downwards.
     :param freedom_percentage: Percentage the estimated angle may differ from the angle of the camera.
@@ -363,47 +358,47 @@ def map_downwards(freedom_percentage = 40):
                                 rather high to compensate for a bad first fit.
                                 The percentage should also be high if just a few leds make up a full circle
     """
-    # print_campos()
+    # print_campos(campos)
     # Find upper. This is the highest located led in the tree.
     for upper in range(NUM_PIXELS):
-        if not THETA[upper] is None:
+        if not theta[upper] is None:
             break
 
     for led_id in range(upper - 1, 0, -1):
-        for cam_name in rank_cameras():
+        for cam_name in rank_cameras(pipeline, campos):
             if upper == led_id:
                 continue
             if cam_name not in campos:
                 continue
-            idx = between_index(led_id, led_id + 1, verticals[cam_name])
+            idx = between_index(led_id, led_id + 1, pipeline.verticals[cam_name])
 
             if idx:
-                expected = statistics.fmean(ANGLES['median'][led_id: upper])
+                expected = statistics.fmean(pipeline.angles['median'][led_id: upper])
 
                 angle_per_led = calculate_increasing_angle(expected,
-                                                           verticals[cam_name][idx[0]], upper,
-                                                           campos[cam_name].angle, THETA[upper])
+                                                           pipeline.verticals[cam_name][idx[0]], upper,
+                                                           campos[cam_name].angle, theta[upper])
 
                 if (1-freedom_percentage/100) < abs(angle_per_led / expected) < (1+freedom_percentage/100):
                     for i in range(upper, led_id, -1):
-                        led_angle = uni_theta(THETA[i] - angle_per_led)
-                        THETA[i-1] = led_angle
+                        led_angle = uni_theta(theta[i] - angle_per_led)
+                        theta[i-1] = led_angle
                     upper = led_id
-                    fit_all_camera()  # refit the camera's with the extra data.
+                    fit_all_camera(pipeline, theta, campos)  # refit the camera's with the extra data.
                     print(f'{cam_name} used')
 
     # Fill in the remaining leds with the last detected angle
     for upper in range(NUM_PIXELS):
-        if not THETA[upper] is None:
+        if not theta[upper] is None:
             break
     for i in range(upper, 0 , -1):
-        if not pd.isna(val:=ANGLES['median'][i]):
-            THETA[i - 1] = THETA[i] - val
+        if not pd.isna(val:=pipeline.angles['median'][i]):
+            theta[i - 1] = theta[i] - val
         else:
-            THETA[i-1] = uni_theta(2 * THETA[i] - THETA[i + 1])
+            theta[i-1] = uni_theta(2 * theta[i] - theta[i + 1])
 
 
-def map_upwards(freedom_percentage = 40):
+def map_upwards(pipeline: Pipeline, theta: Theta, campos: Dict[str, CamPos], freedom_percentage = 40):
     """
     Fill Theta downwards.
     :param freedom_percentage: Percentage the estimated angle may differ from the angle of the camera.
@@ -411,58 +406,66 @@ def map_upwards(freedom_percentage = 40):
                                 rather high to compensate for a bad first fit.
                                 The percentage should also be high if just a few leds make up a full circle
     """
-    # print_campos()
+    # print_campos(campos)
     # Find lower. This is the last located led in the tree with increasing id.
     for lower in range(NUM_PIXELS - 1, 0, -1):
-        if not THETA[lower] is None:
+        if not theta[lower] is None:
             break
 
     for led_id in range(lower, NUM_PIXELS):
-        for cam_name in rank_cameras():
+        for cam_name in rank_cameras(pipeline, campos):
             if lower == led_id:
                 continue
             if cam_name not in campos:
                 continue
-            idx = between_index(led_id -1, led_id, verticals[cam_name])
+            idx = between_index(led_id -1, led_id, pipeline.verticals[cam_name])
 
             if idx:
-                expected = statistics.fmean(ANGLES['median'][lower : led_id])
+                expected = statistics.fmean(pipeline.angles['median'][lower : led_id])
 
                 angle_per_led = calculate_increasing_angle(expected,
-                                                           lower, verticals[cam_name][idx[0]],
-                                                           THETA[lower], campos[cam_name].angle)
+                                                           lower, pipeline.verticals[cam_name][idx[0]],
+                                                           theta[lower], campos[cam_name].angle)
 
                 if (1-freedom_percentage/100) < abs(angle_per_led / expected) < (1+freedom_percentage/100):
                     for i in range(lower, led_id):
-                        led_angle = uni_theta(THETA[i] + angle_per_led)
-                        THETA[i+1] = led_angle
+                        led_angle = uni_theta(theta[i] + angle_per_led)
+                        theta[i+1] = led_angle
                     lower = led_id
-                    fit_all_camera()  # refit the camera's with the extra data.
+                    fit_all_camera(pipeline, theta, campos)  # refit the camera's with the extra data.
                     print(f'{cam_name} used')
 
     # Fill in the remaining leds with the last detected angle
     for lower in range(NUM_PIXELS - 1, 0, -1):
-        if not THETA[lower] is None:
+        if not theta[lower] is None:
             break
 
     for i in range(lower, NUM_PIXELS -1):
-        if not pd.isna(val:=ANGLES['median'][i]):
-            THETA[i + 1] = THETA[i] + val
+        if not pd.isna(val:=pipeline.angles['median'][i]):
+            theta[i + 1] = theta[i] + val
         else:
-            THETA[i + 1] = uni_theta(2 * THETA[i] - THETA[i - 1])
+            theta[i + 1] = uni_theta(2 * theta[i] - theta[i - 1])
 
 
-def map_led_angles_using_camera():
-    ranked_camera = rank_cameras()
+def map_led_angles_using_camera(pipeline: Pipeline, campos: Optional[Dict[str, CamPos]] = None) -> Theta:
+    """
+    Map the angle of each led around the tree with the stages of the pipeline.
+    :param campos: Filled with the fitted camera positions, if given
+    :return: The angle of each led
+    """
+    theta: Theta[Optional[float]] = Theta(None for i in range(NUM_PIXELS))
+    campos = {} if campos is None else campos
+    ranked_camera = rank_cameras(pipeline, campos)
     print(ranked_camera)
 
-    make_initial_rotation(ranked_camera[0])
-    fit_all_camera()
+    make_initial_rotation(pipeline, theta, ranked_camera[0])
+    fit_all_camera(pipeline, theta, campos)
 
-    map_downwards(40)
-    map_upwards(40)
+    map_downwards(pipeline, theta, campos, 40)
+    map_upwards(pipeline, theta, campos, 40)
+    return theta
 
 
 if __name__ == "__main__":
-    map_led_angles_using_camera()
-    plot_led_angles()
+    camera_positions: Dict[str, CamPos] = {}
+    plot_led_angles(PIPELINE, map_led_angles_using_camera(PIPELINE, camera_positions), camera_positions)
@@ -1,24 +1,245 @@
-from cv2 import VideoCapture, imwrite, imread, imshow, waitKey, destroyWindow
-from numpy import ndarray
+import time
+from queue import Queue
+from threading import Condition, Lock, Thread
+from typing import Dict, List, Optional, Tuple
+
+from cv2 import VideoCapture, absdiff, createMergeMertens, cvtColor, imwrite, imread, imshow, waitKey, \
+    destroyWindow, COLOR_BGR2GRAY, CAP_PROP_AUTO_EXPOSURE, CAP_PROP_AUTO_WB, CAP_PROP_EXPOSURE
+from numpy import clip, count_nonzero, load, mean, median, ndarray, memmap, stack, uint8
+from numpy.lib.format import open_memmap
 
 from config import storage
 
 """
 Methods to use the webcam, create, store and read back images.
+
+Besides separate png images, a series can be stored as a single frame stack (stack.npy).
+The stack is a (X, Y, frames + 2) uint8 array, holding a column of values for each image pixel:
+[ground, all, difference images]. Ground and all are grayscale images.
+The difference images are the grayscale difference with ground, ordered from the highest bit to the lowest bit.
+This is the same order Cluster uses, so the stack can be used as Cluster data without copying.
 """
 
+STACK_FILE = 'stack.npy'
+
+
+class FrameGrabber(Thread):
+    def __init__(self, cam: VideoCapture):
+        """
+        FrameGrabber reads images from the webcam continuously in a background thread.
+        OpenCV buffers images in the camera driver, so a single read can return an image made before the leds changed.
+        By draining the buffer all the time, the grabber can hand out an image which was made after a given moment.
+        VideoCapture is not thread safe: while the grabber runs, camera properties are changed through the grabber.
+        """
+        super().__init__(daemon=True)
+        self.cam = cam
+        self.cam_lock = Lock()  # Held while the camera is used
+        self.condition = Condition()
+        self.image: Optional[ndarray] = None
+        self.timestamp = 0.0  # Time the read of the latest image started
+        self.running = True
+
+    def run(self):
+        while self.running:
+            with self.cam_lock:
+                start = time.time()
+                success, image = self.cam.read()
+            if not success:
+                continue
+            with self.condition:
+                self.image = image
+                self.timestamp = start
+                self.condition.notify_all()
+
+    def snap(self, after: Optional[float] = None, timeout: float = 2.0) -> ndarray:
+        """
+        Return the first image read after a given moment.
+        :param after: Time stamp. If None, the current time is used.
+        :param timeout: Maximum time to wait for the image
+        """
+        after = time.time() if after is None else after
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.timestamp >= after, timeout):
+                raise RuntimeError('Something went wrong while making image')
+            return self.image
+
+    def get(self, prop: int) -> float:
+        with self.cam_lock:
+            return self.cam.get(prop)
+
+    def set(self, prop: int, value: float):
+        """
+        Change a camera property between 2 reads of the grabber
+        """
+        with self.cam_lock:
+            self.cam.set(prop, value)
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+
+class ImageWriter(Thread):
+    def __init__(self):
+        """
+        ImageWriter encodes and stores png images in a background thread, so snapping can continue meanwhile.
+        """
+        super().__init__(daemon=True)
+        self.queue: Queue = Queue()
+
+    def run(self):
+        while (item := self.queue.get()) is not None:
+            store_im(*item)
+
+    def put(self, name, image: ndarray):
+        self.queue.put((name, image))
+
+    def close(self):
+        """
+        Wait until all queued images are stored.
+        """
+        self.queue.put(None)
+        self.join()
+
 
 class Webcam:
     cam_port = 0
     cam = VideoCapture(cam_port)
+    grabber: Optional[FrameGrabber] = None
+    locked: Dict[int, float] = {}  # Camera properties before locking exposure and white balance
 
     @staticmethod
-    def snap() -> ndarray:
+    def get_property(prop: int) -> float:
+        if Webcam.grabber:
+            return Webcam.grabber.get(prop)
+        return Webcam.cam.get(prop)
+
+    @staticmethod
+    def set_property(prop: int, value: float):
+        """
+        Change a camera property. With a running grabber the change is made between 2 reads of the grabber.
+        """
+        if Webcam.grabber:
+            Webcam.grabber.set(prop, value)
+        else:
+            Webcam.cam.set(prop, value)
+
+    @staticmethod
+    def lock_exposure():
+        """
+        Fix the exposure and white balance at the current values, so all images in a series are comparable.
+        The property values are backend dependant. 0.25 is manual exposure for V4L2, the most common webcam backend.
+        """
+        for prop in (CAP_PROP_AUTO_EXPOSURE, CAP_PROP_AUTO_WB, CAP_PROP_EXPOSURE):
+            Webcam.locked[prop] = Webcam.get_property(prop)
+        Webcam.set_property(CAP_PROP_AUTO_EXPOSURE, 0.25)
+        Webcam.set_property(CAP_PROP_AUTO_WB, 0)
+        Webcam.set_property(CAP_PROP_EXPOSURE, Webcam.locked[CAP_PROP_EXPOSURE])
+
+    @staticmethod
+    def unlock_exposure():
+        """
+        Restore exposure and white balance settings from before lock_exposure
+        """
+        for prop, value in Webcam.locked.items():
+            Webcam.set_property(prop, value)
+        Webcam.locked = {}
+
+    @staticmethod
+    def start_grabber():
+        """
+        Keep reading images in the background. From now on snap returns images made after the call to snap.
+        """
+        if not Webcam.grabber:
+            Webcam.grabber = FrameGrabber(Webcam.cam)
+            Webcam.grabber.start()
+
+    @staticmethod
+    def stop_grabber():
+        if Webcam.grabber:
+            Webcam.grabber.stop()
+            Webcam.grabber = None
+
+    @staticmethod
+    def snap(after: Optional[float] = None) -> ndarray:
+        """
+        Snap an image.
+        :param after: Only used with a running grabber. The image is made after this time stamp.
+        """
+        if Webcam.grabber:
+            return Webcam.grabber.snap(after)
         success, image = Webcam.cam.read()
         if not success:
             raise RuntimeError('Something went wrong while making image')
         return image
 
+    @staticmethod
+    def snap_average(count: int, method: str = 'mean', after: Optional[float] = None) -> ndarray:
+        """
+        Snap multiple images and reduce them to 1 image with less sensor noise.
+        :param count: Number of images
+        :param method: 'mean' or 'median' of each pixel
+        :param after: Only used with a running grabber. The first image is made after this time stamp.
+        """
+        images = stack([Webcam.snap(after if i == 0 else None) for i in range(count)])
+        if method == 'mean':
+            return mean(images, axis=0).round().astype(uint8)
+        if method == 'median':
+            return median(images, axis=0).astype(uint8)
+        raise RuntimeError(f'Reduce method "{method}" not supported')
+
+    @staticmethod
+    def snap_hdr(exposures: List[float], after: Optional[float] = None) -> ndarray:
+        """
+        Snap an image for each exposure and merge them to 1 image (Mertens exposure fusion).
+        Bright leds are taken from the short exposures, the dark tree and background from the long exposures.
+        The exposure is restored afterwards. With a running grabber, the exposure is changed between 2 reads.
+        :param exposures: Camera exposure values (CAP_PROP_EXPOSURE, backend dependant)
+        :param after: Only used with a running grabber. The first image is made after this time stamp.
+        """
+        exposure = Webcam.get_property(CAP_PROP_EXPOSURE)
+        images = []
+        for value in exposures:
+            Webcam.set_property(CAP_PROP_EXPOSURE, value)
+            changed = time.time()
+            # The first image after changing the exposure may still use the old exposure
+            Webcam.snap(changed if after is None else max(after, changed))
+            images.append(Webcam.snap())
+        Webcam.set_property(CAP_PROP_EXPOSURE, exposure)
+        return clip(createMergeMertens().process(images) * 255, 0, 255).astype(uint8)
+
+    @staticmethod
+    def snap_settled(previous: Optional[ndarray] = None, min_changed: int = 20, max_changed: int = 20,
+                     timeout: float = 2.0) -> Tuple[ndarray, bool]:
+        """
+        Snap an image as soon as a newly rendered led frame is visible and the image stopped changing.
+        Images are grabbed until 2 successive images differ in at most max_changed pixels.
+        If a previous image is given, the settled image should also differ from it in at least min_changed pixels.
+        Without this check a stale image, buffered before the leds changed, would be considered settled.
+        :param previous: Image of the previous led frame
+        :param min_changed: Minimum number of pixels changed compared to the previous image
+        :param max_changed: Maximum number of pixels changing between 2 successive images of a settled frame
+        :param timeout: Maximum time in seconds to wait for a settled image
+        :return: The image, and a flag which is False if the image did not settle before the timeout.
+        """
+        end = time.time() + timeout
+        last = Webcam.snap()
+        while time.time() < end:
+            image = Webcam.snap()
+            stable = changed_pixels(image, last) <= max_changed
+            visible = previous is None or changed_pixels(image, previous) >= min_changed
+            if stable and visible:
+                return image, True
+            last = image
+        return last, False
+
+
+def changed_pixels(image: ndarray, other: ndarray, threshold: int = 30) -> int:
+    """
+    Count the number of pixels with a grayscale difference above threshold between 2 images.
+    """
+    return count_nonzero(cvtColor(absdiff(image, other), COLOR_BGR2GRAY) > threshold)
+
 
 def store_im(name, image):
     location = storage / f'{name}.png'
@@ -30,6 +251,28 @@ def read_im(name, folder=''):
     return imread(str(storage / folder / f'{name}.png'))
 
 
+def create_stack(name, shape, num_frames) -> memmap:
+    """
+    Create a memory mapped frame stack for a series
+    :param name: Name of the series
+    :param shape: Shape (X, Y) of a single image
+    :param num_frames: Number of bit images in the series
+    """
+    (storage / name).mkdir(exist_ok=True, parents=True)
+    return open_memmap(str(storage / name / STACK_FILE), mode='w+', dtype=uint8, shape=(*shape, num_frames + 2))
+
+
+def read_stack(name) -> Optional[memmap]:
+    """
+    Open the frame stack of a series read only. Data is only loaded from disk when it is used.
+    :return: The frame stack, or None if the series is not stored as stack
+    """
+    try:
+        return load(str(storage / name / STACK_FILE), mmap_mode='r')
+    except FileNotFoundError:
+        return None
+
+
 def show_im(image):
     imshow('image', image)
     waitKey(0)
@@ -2,21 +2,22 @@ import numpy as np
 import pandas as pd
 from statistics import mean, median
 from scipy.optimize import curve_fit
-from typing import Generator, Tuple
+from typing import Generator, List, Tuple
 import matplotlib.pyplot as plt
 
 from analyze_data import DataContainer
 from config import IMAGE, NUM_PIXELS
-from height import SNAPS, HEIGHT
+from pipeline import PIPELINE
 
 
-def estimate_distance(snap: DataContainer):
+def estimate_distance(snap: DataContainer, height: pd.Series):
     """
     Estimate the distance of the camera to the tree
+    :param height: Height of each led, see height.estimate_led_height
     """
     store = {}
     for led in snap.data.values():
-        store[led] = abs(HEIGHT[led.led_id] - 0.5)
+        store[led] = abs(height[led.led_id] - 0.5)
 
     center_tree = mean([k.x for k, v in sorted(store.items(), key=lambda item: item[1])][:10])
 
@@ -24,7 +25,7 @@ def estimate_distance(snap: DataContainer):
     y = []
     for led in snap.data.values():
         x.append((led.x - center_tree) / IMAGE[1])
-        y.append(HEIGHT[led.led_id])
+        y.append(height[led.led_id])
 
     def fun(x, h, d):
         return h + d * np.tan(x)
@@ -35,28 +36,31 @@ def estimate_distance(snap: DataContainer):
     snap.estimate.camera_distance = popt[1]
 
 
-def estimate_led_radius(snap: DataContainer) -> Generator[Tuple[int, float], None, None]:
+def estimate_led_radius(snap: DataContainer, height: pd.Series) -> Generator[Tuple[int, float], None, None]:
     """
     Estimate the distance of the led to tree trunk.
+    :param height: Height of each led, with the height estimates of the snap filled (see height.fill_height_estimates)
     """
     for led in snap.data.values():
-        if abs(snap.estimate.scaled_led_height(led) - HEIGHT[led.led_id]) > 0.1:
+        if abs(snap.estimate.scaled_led_height(led) - height[led.led_id]) > 0.1:
             continue  # Exclude leds far away from estimation
 
         dist = abs(snap.m * led.x + snap.c - led.y) * snap.estimate.pixelscale
         yield led.led_id, dist
 
 
-def estimate_led_width(plot_raw_data=False):
+def estimate_led_width(snaps: List[DataContainer], height: pd.Series, plot_raw_data=False):
     """
     Calculate an estimate of a smoothed distance of all leds to the trunk of the tree.
     For all detected leds the distance to the trunk is added to a dataframe.
     When the trunk, led and ca
+    :param snaps: List of all DataContainers
+    :param height: Height of each led, see Pipeline.height
     """
 
-    df = pd.DataFrame(index=np.arange(NUM_PIXELS), columns=[snap.snap_name.stem for snap in SNAPS])
-    for snap in SNAPS:
-        for lid, dist in estimate_led_radius(snap):
+    df = pd.DataFrame(index=np.arange(NUM_PIXELS), columns=[snap.snap_name.stem for snap in snaps])
+    for snap in snaps:
+        for lid, dist in estimate_led_radius(snap, height):
             df.loc[lid, snap.snap_name.stem] = dist
 
     def average_above_median(row):
@@ -80,27 +84,24 @@ def estimate_led_width(plot_raw_data=False):
 
     series = df['above'].dropna()
 
-    z = np.polyfit(HEIGHT[list(series.index)], series, 5)
+    z = np.polyfit(height[list(series.index)], series, 5)
     p = np.poly1d(z)
 
     return pd.Series([p(i) for i in np.linspace(0, 1, 600)])
 
 
-WIDTH = estimate_led_width()
-
-
 if __name__ == "__main__":
     """
-    buur = SNAPS[0]
+    buur = PIPELINE.snaps[0]
     for i in range(600):
         try:
             led = buur.data[i]
-            print(f"{led.led_id} {HEIGHT[i]:.2f} {buur.estimate.scaled_led_height(led)}")
+            print(f"{led.led_id} {PIPELINE.height[i]:.2f} {buur.estimate.scaled_led_height(led)}")
         except KeyError:
             pass
     """
-    plt.plot(np.linspace(0, 1, 600), HEIGHT, "b--")
-    plt.plot(np.linspace(0, 1, 600), WIDTH, "r--")
+    plt.plot(np.linspace(0, 1, 600), PIPELINE.height, "b--")
+    plt.plot(np.linspace(0, 1, 600), PIPELINE.width, "r--")
     plt.title('Width')
 
     plt.show()